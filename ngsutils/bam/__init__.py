@@ -1,8 +1,10 @@
 import sys
 import os
 import re
+import struct
 import pysam
-from eta import ETA
+from ngsutils.support import prefetch
+from ngsutils.support.metrics import Progress
 
 
 def bam_open(fname, mode='r', *args, **kwargs):
@@ -12,25 +14,19 @@ def bam_open(fname, mode='r', *args, **kwargs):
 
 
 def bam_pileup_iter(bam, mask=1796, quiet=False, callback=None):
-    if not quiet and bam.filename:
-        eta = ETA(os.stat(bam.filename).st_size)
+    if callback:
+        extra = callback
     else:
-        eta = None
+        def extra(pileup):
+            return '%s:%s' % (bam.getrname(pileup.tid), pileup.pos)
 
-    for pileup in bam.pileup(mask=mask):
-        pos = bam.tell()
-        bgz_offset = pos >> 16
-
-        if not quiet:
-            if callback:
-                eta.print_status(bgz_offset, extra=callback(pileup))
-            else:
-                eta.print_status(bgz_offset, extra='%s:%s' % (bam.getrname(pileup.tid), pileup.pos))
+    progress = Progress(os.stat(bam.filename).st_size if bam.filename else 0, position=lambda: bam.tell() >> 16, extra=extra, stage='pileup', quiet=quiet or not bam.filename)
 
+    for pileup in bam.pileup(mask=mask):
+        progress.update(pileup)
         yield pileup
 
-    if eta:
-        eta.done()
+    progress.done()
 
 
 def bam_iter(bam, quiet=False, show_ref_pos=False, callback=None):
@@ -38,34 +34,165 @@ def bam_iter(bam, quiet=False, show_ref_pos=False, callback=None):
     >>> [x.qname for x in bam_iter(bam_open(os.path.join(os.path.dirname(__file__), 't', 'test.bam')), quiet=True)]
     ['A', 'B', 'E', 'C', 'D', 'F', 'Z']
     '''
-    if not quiet and bam.filename:
-        eta = ETA(os.stat(bam.filename).st_size)
-    else:
-        eta = None
-
     if os.path.exists('%s.bai' % bam.filename):
         # This is an indexed file, so it is ref sorted...
         # Meaning that we should show chrom:pos, instead of read names
         show_ref_pos = True
 
+    if callback:
+        extra = callback
+    elif show_ref_pos:
+        def extra(read):
+            if read.tid > -1:
+                return '%s:%s %s' % (bam.getrname(read.tid), read.pos, read.qname)
+            return 'unmapped %s' % (read.qname)
+    else:
+        def extra(read):
+            return read.qname
+
+    # the status is only built (and the position only checked) when the
+    # progress meter is updated, not for every read
+    progress = Progress(os.stat(bam.filename).st_size if bam.filename else 0, position=lambda: bam.tell() >> 16, extra=extra, stage='bam', quiet=quiet or not bam.filename)
+
     for read in bam:
-        pos = bam.tell()
-        bgz_offset = pos >> 16
-
-        if not quiet and eta:
-            if callback:
-                eta.print_status(bgz_offset, extra=callback(read))
-            elif (show_ref_pos):
-                if read.tid > -1:
-                    eta.print_status(bgz_offset, extra='%s:%s %s' % (bam.getrname(read.tid), read.pos, read.qname))
-                else:
-                    eta.print_status(bgz_offset, extra='unmapped %s' % (read.qname))
-            else:
-                eta.print_status(bgz_offset, extra='%s' % read.qname)
+        progress.update(read)
         yield read
 
-    if eta:
-        eta.done()
+    progress.done()
+
+
+def bam_unmapped_iter(bam):
+    '''
+    Yields the reads at the end of a sorted and indexed BAM file that aren't
+    placed on a reference (tid -1). The BAM index is used to find where these
+    reads start, so the mapped reads don't need to be read.
+
+    >>> [x.qname for x in bam_unmapped_iter(bam_open(os.path.join(os.path.dirname(__file__), 't', 'test.bam')))]
+    ['Z']
+    '''
+    offset = bai_unmapped_offset('%s.bai' % bam.filename)
+    if offset:
+        bam.seek(offset)
+
+    for read in bam:
+        # the offset from the index may be before the end of the mapped reads
+        if read.tid < 0:
+            yield read
+
+
+def bai_unmapped_offset(fname):
+    '''
+    Returns the virtual offset in the BAM file where the unplaced reads start
+    (or a place before that, but after the header), using a BAI index. This
+    is the end of the reads for the last reference (from the index's
+    pseudo-bin), or if there is no pseudo-bin, the start of the last chunk
+    of reads. Returns 0 if there aren't any mapped reads.
+    '''
+    offset = 0
+    with open(fname, 'rb') as f:
+        if f.read(4) != 'BAI\1':
+            raise ValueError("Invalid BAM index: %s" % fname)
+
+        n_ref, = struct.unpack('<i', f.read(4))
+        for i in xrange(n_ref):
+            n_bin, = struct.unpack('<i', f.read(4))
+            for j in xrange(n_bin):
+                bin, n_chunk = struct.unpack('<Ii', f.read(8))
+                chunks = struct.unpack('<%sQ' % (n_chunk * 2), f.read(16 * n_chunk))
+                if bin == 37450:
+                    # pseudo-bin: (start, end) of the reads, (mapped, unmapped) counts
+                    offset = max(offset, chunks[1])
+                elif chunks:
+                    offset = max(offset, max(chunks[::2]))
+
+            n_intv, = struct.unpack('<i', f.read(4))
+            f.seek(8 * n_intv, 1)
+
+    return offset
+
+
+class ReadGroup(object):
+    '''
+    A run of consecutive reads with the same name (see bam_read_groups).
+
+    The tags of each read are only read (from read.tags) once, the first time
+    that one of its tag values is looked up.
+    '''
+    def __init__(self):
+        self.qname = None
+        self.reads = []
+        self._tags = []
+
+    def _reset(self, qname):
+        self.qname = qname
+        del self.reads[:]
+        del self._tags[:]
+
+    def __len__(self):
+        return len(self.reads)
+
+    def __iter__(self):
+        return iter(self.reads)
+
+    def __getitem__(self, idx):
+        return self.reads[idx]
+
+    def tag(self, idx, tag, default=None):
+        '''
+        Returns the value of a tag for one of the reads in the group, or default
+        if the read doesn't have the tag. 'MAPQ' returns the mapping quality.
+        '''
+        if tag == 'MAPQ':
+            return self.reads[idx].mapq
+
+        while len(self._tags) <= idx:
+            self._tags.append(None)
+
+        if self._tags[idx] is None:
+            self._tags[idx] = dict(self.reads[idx].tags)
+
+        return self._tags[idx].get(tag, default)
+
+    def tag_values(self, tag, default=None):
+        'Returns the values of a tag for each of the reads in the group'
+        return [self.tag(i, tag, default) for i in xrange(len(self.reads))]
+
+
+def bam_read_groups(reads, threads=False):
+    '''
+    Yields a ReadGroup for each run of consecutive reads with the same name
+    (qname). reads can be a BAM file or any other iterator of reads.
+
+    Only two ReadGroups are used, in turn, so a group is only valid until the
+    group after it has been read. Copy group.reads to keep the reads longer.
+
+    If threads is True, the reads are read in a background thread (see
+    ngsutils.support.prefetch).
+
+    >>> [(x.qname, len(x)) for x in bam_read_groups(bam_open(os.path.join(os.path.dirname(__file__), 't', 'test.bam')))]
+    [('A', 1), ('B', 1), ('E', 1), ('C', 1), ('D', 1), ('F', 1), ('Z', 1)]
+    '''
+    if threads:
+        reads = prefetch(iter(reads))
+
+    groups = [ReadGroup(), ReadGroup()]
+    cur = None
+    idx = 0
+
+    for read in reads:
+        qname = read.qname
+        if cur is None or qname != cur.qname:
+            if cur is not None:
+                yield cur
+
+            idx = 1 - idx
+            cur = groups[idx]
+            cur._reset(qname)
+
+        cur.reads.append(read)
+
+    if cur is not None:
+        yield cur
 
 
 bam_cigar = ['M', 'I', 'D', 'N', 'S', 'H', 'P', '=', 'X']
@@ -480,9 +607,6 @@ def read_calc_mismatches_ref(ref, read, chrom):
     return edits
 
 
-__region_cache = {}
-
-
 def region_pos_to_genomic_pos(name, start, cigar):
     '''
         converts a junction position to a genomic location given a junction
@@ -498,19 +622,29 @@ def region_pos_to_genomic_pos(name, start, cigar):
 
     '''
 
-    if name in __region_cache:
-        chrom, fragments = __region_cache[name]
-    else:
-        c1 = name.split(':')
-        chrom = c1[0]
+    c1 = name.split(':')
+    chrom = c1[0]
+
+    fragments = []
+    for fragment in c1[1].split(','):
+        s, e = fragment.split('-')
+        fragments.append((int(s), int(e)))
 
-        fragments = []
-        for fragment in c1[1].split(','):
-            s, e = fragment.split('-')
-            fragments.append((int(s), int(e)))
+    return region_fragments_to_genomic_pos(chrom, fragments, start, cigar)
 
-        __region_cache[name] = (chrom, fragments)
 
+def region_fragments_to_genomic_pos(chrom, fragments, start, cigar):
+    '''
+        converts a junction position to a genomic location given the genomic
+        chrom and (start, end) fragments of the junction, the junction
+        position, and the cigar alignment. (See ngsutils.bam.regionindex for
+        a compiled index of the fragments for each reference in a BAM file.)
+
+        returns: (genomic ref, genomic pos, genomic cigar)
+
+    >>> region_fragments_to_genomic_pos('chr1', [(1000, 1050), (2000, 2050), (3000, 4000)], 25, [(0, 100)])
+    ('chr1', 1025, [(0, 25), (3, 950), (0, 50), (3, 950), (0, 25)])
+    '''
     chr_cigar = []
     chr_start = fragments[0][0]
 
@@ -551,7 +685,7 @@ def region_pos_to_genomic_pos(name, start, cigar):
                     cur_pos = frag_end
                     frag_idx += 1
                     if len(fragments) <= frag_idx:
-                        print 'ERROR converting: ', name, fragments 
+                        print 'ERROR converting: ', chrom, fragments
                         return (chrom, 0, chr_cigar)
                     frag_start, frag_end = fragments[frag_idx]
                     chr_cigar.append((3, frag_start - cur_pos))
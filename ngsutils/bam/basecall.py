@@ -56,10 +56,13 @@ import sys
 import math
 import collections
 import datetime
+import numpy
 from ngsutils.bam import bam_iter, bam_open
+import ngsutils.bam.parallel
 from ngsutils.bed import BedFile
+from ngsutils.support.reference import open_reference
+from ngsutils.support import positive_int_arg
 from eta import ETA
-import pysam
 
 
 def usage():
@@ -92,6 +95,10 @@ Options:
                (*must* be sorted and reduced with the -nostrand option)
 
 -variants      Only output positions that differ from reference
+
+-p     num     Use {num} processes (the genome, or the regions in the BED
+               file, is split into shards that are processed in parallel)
+               (default 1)
 """
     sys.exit(1)
 
@@ -122,12 +129,50 @@ def calc_entropy(a, c, t, g):
     return acc
 
 MappingRecord = collections.namedtuple('MappingRecord', 'qpos cigar_op base qual read')
-MappingPos = collections.namedtuple('MappingPos', 'tid pos records')
-BasePosition = collections.namedtuple('BasePosition', 'tid pos total a c g t n deletions gaps insertions reads a_minor c_minor g_minor t_minor n_minor del_minor ins_minor')
+BasePosition = collections.namedtuple('BasePosition', 'tid pos total a c g t n deletions gaps insertions reads a_minor c_minor g_minor t_minor n_minor del_minor ins_minor read_count plus_count ih_acc')
+
+# Rows in the BamBaseCaller window:
+#   A, C, G, T, N counts (quality filtered), the same counts for reads on the
+#   plus strand, deletions, plus-strand deletions, gaps, number of reads,
+#   number of plus-strand reads, and the sum of the IH tags for the reads.
+_BASES = 'ACGTN'
+_PLUS = 5
+_DEL = 10
+_PLUS_DEL = 11
+_GAPS = 12
+_READS = 13
+_PLUS_READS = 14
+_IH = 15
+_ROWS = 16
+
+# positions are flushed (yielded) in blocks of at least this size
+_FLUSH_SIZE = 4096
+
+_base_idx = numpy.zeros(256, dtype=numpy.int64) + 4
+for _i, _base in enumerate('ACGT'):
+    _base_idx[ord(_base)] = _i
+    _base_idx[ord(_base.lower())] = _i
 
 
 class BamBaseCaller(object):
-    def __init__(self, bam, min_qual=0, min_count=0, regions=None, mask=1540, quiet=False):
+    '''
+    Tallies the bases at each position covered by reads in a BAM file.
+
+    The counts are kept in a window of numpy arrays (one row for each count,
+    one column for each position) instead of keeping a record for every base
+    of every read. Inserted sequences are kept in a separate table, only for
+    the positions that have an insertion. Positions are yielded as
+    BasePosition tuples once all of the reads that cover them have been read.
+
+    If keep_reads is True, the MappingRecords for each position are also kept
+    (BasePosition.reads). This is only needed if the individual reads are
+    required, such as for building a pileup.
+
+    If span is given (chrom, start, end), only the positions from start to end
+    (zero-based, half-open) are reported. This is used to process one shard of
+    the genome (see ngsutils.bam.parallel).
+    '''
+    def __init__(self, bam, min_qual=0, min_count=0, regions=None, mask=1540, quiet=False, keep_reads=False, span=None):
         self.bam = bam
         self.min_qual = min_qual
         self.min_count = 0
@@ -139,6 +184,8 @@ class BamBaseCaller(object):
 
         self.mask = mask
         self.quiet = quiet
+        self.keep_reads = keep_reads
+        self.span = span
 
         def _gen1():
             if not self.quiet:
@@ -147,6 +194,8 @@ class BamBaseCaller(object):
                 eta = None
 
             count = 0
+            last_chrom = None
+            last_end = 0
             for region in self.regions:
                 working_chrom = None
                 if region.chrom in self.bam.references:
@@ -163,8 +212,17 @@ class BamBaseCaller(object):
                 self.cur_start = region.start
                 self.cur_end = region.end
 
+                if working_chrom != last_chrom:
+                    last_chrom = working_chrom
+                    last_end = 0
+
                 laststart = 0
                 for read in self.bam.fetch(working_chrom, region.start, region.end):
+                    # reads that span more than one region were already used
+                    # for the previous region
+                    if read.pos < last_end:
+                        continue
+
                     if read.pos != laststart:
                         count += 1
                         laststart = read.pos
@@ -173,79 +231,80 @@ class BamBaseCaller(object):
                         eta.print_status(count, extra='%s/%s %s:%s' % (count, self.regions.total, self.bam.references[read.tid], read.pos))
 
                     yield read
+
+                if region.end > last_end:
+                    last_end = region.end
+
             if eta:
                 eta.done()
 
         def _gen2():
             def callback(read):
-                return '%s:%s (%s) %s:%s-%s' % (self.bam.getrname(read.tid), read.pos, len(self.buffer), self.cur_chrom, self.cur_start, self.cur_end)
+                return '%s:%s (%s) %s:%s-%s' % (self.bam.getrname(read.tid), read.pos, self.win_end + 1 - self.win_start, self.cur_chrom, self.cur_start, self.cur_end)
             for read in bam_iter(self.bam, quiet=self.quiet, callback=callback):
                 yield read
 
-        if regions:
+        def _gen3():
+            chrom, start, end = self.span
+            if not chrom in self.bam.references:
+                return
+
+            self.cur_chrom = chrom
+            self.cur_start = start
+            self.cur_end = end - 1  # the end bound is inclusive
+
+            for read in self.bam.fetch(chrom, start, end):
+                yield read
+
+        if span:
+            self._gen = _gen3
+        elif regions:
             self._gen = _gen1
         else:
             self._gen = _gen2
 
-        self.buffer = None
         self.current_tid = None
+        self.win_start = 0
+        self.win_end = -1
+        self._counts = None
+        self._inserts = None
+        self._records = None
 
     def close(self):
         pass
 
-    def _calc_pos(self, tid, pos, records):
-        if self.cur_start and pos < self.cur_start:
-            return None
-        if self.cur_end and self.cur_end < pos:
+    def _calc_pos(self, tid, pos, row, inserts, records):
+        for start, end in self._bounds:
+            if (not start or start <= pos) and (not end or pos <= end):
+                break
+        else:
             return None
 
-        counts = {'A': 0, 'C': 0, 'G': 0, 'T': 0, 'N': 0, 'ins': 0, 'del': 0}
-        plus_counts = {'A': 0, 'C': 0, 'G': 0, 'T': 0, 'N': 0, 'ins': 0, 'del': 0}
+        counts = dict(zip(_BASES, row[:5]))
+        plus_counts = dict(zip(_BASES, row[_PLUS:_PLUS + 5]))
+        counts['del'] = row[_DEL]
+        plus_counts['del'] = row[_PLUS_DEL]
 
-        insertions = {}
-        gaps = 0
-        total = 0
-        reads = []
-
-        for record in records:
-            qpos, cigar_op, base, qual, read = record
-            if cigar_op == 0:  # M
-                if qual >= self.min_qual and (read.flag & self.mask) == 0:
-                    total += 1
-                    reads.append(record)
-
-                    counts[base] += 1
-                    if not read.is_reverse:
-                        plus_counts[base] += 1
-            elif cigar_op == 1:  # I
-                if qual >= self.min_qual and (read.flag & self.mask) == 0:
+        if inserts:
+            insertions, counts['ins'], plus_counts['ins'] = inserts
+        else:
+            insertions = {}
+            counts['ins'] = 0
+            plus_counts['ins'] = 0
+
+        total = sum(row[:5])
+        gaps = row[_GAPS]
+
+        reads = None
+        if self.keep_reads:
+            reads = []
+            for record in records:
+                if record.cigar_op in [0, 1]:
+                    if record.qual >= self.min_qual and (record.read.flag & self.mask) == 0:
+                        reads.append(record)
+                elif record.cigar_op in [2, 3]:
                     reads.append(record)
 
-                    if not base in insertions:
-                        insertions[base] = 1
-                    else:
-                        insertions[base] += 1
-
-                        counts['ins'] += 1
-                    if not read.is_reverse:
-                        plus_counts['ins'] += 1
-            elif cigar_op == 2:  # D
-                #total += 1 # not sure these should be included,
-                           # samtools mpileup includes them
-                           # IGV doesn't
-
-                counts['del'] += 1
-                reads.append(record)
-                if not read.is_reverse:
-                    plus_counts['del'] += 1
-            elif cigar_op == 3:  # N
-                gaps += 1
-                reads.append(record)
-            elif cigar_op == 4:  # S - soft clipping
-                pass
-            elif cigar_op == 5:  # H - hard clipping
-                pass
-
         pcts = {'A': 0.0, 'C': 0.0, 'G': 0.0, 'T': 0.0, 'N': 0.0, 'ins': 0.0, 'del': 0.0}
         for k in pcts:
             if counts[k] > 0:
@@ -255,100 +314,196 @@ class BamBaseCaller(object):
                     pcts[k] = 1 - pcts[k]
 
         if total >= self.min_count:
-            return BasePosition(tid, pos, total, counts['A'], counts['C'], counts['G'], counts['T'], counts['N'], counts['del'], gaps, insertions, reads, pcts['A'], pcts['C'], pcts['G'], pcts['T'], pcts['N'], pcts['del'], pcts['ins'])
+            return BasePosition(tid, pos, total, counts['A'], counts['C'], counts['G'], counts['T'], counts['N'], counts['del'], gaps, insertions, reads, pcts['A'], pcts['C'], pcts['G'], pcts['T'], pcts['N'], pcts['del'], pcts['ins'], row[_READS], row[_PLUS_READS], row[_IH])
 
     def fetch(self):
-        self.current_tid = None
-        self.buffer = collections.deque()
+        self._counts = numpy.zeros((_ROWS, _FLUSH_SIZE * 4), dtype=numpy.int64)
+        self._inserts = {}
+        self._records = {}
+        self._bounds = []
+        self._reset(None, 0)
 
         for read in self._gen():
             if (read.flag & self.mask) > 0:
                 continue
+
             if self.current_tid != read.tid:  # new chromosome
-                while self.buffer:
-                    tid, pos, records = self.buffer.popleft()
-                    y = self._calc_pos(tid, pos, records)
-                    if y:
-                        yield y
-
-                self.current_tid = read.tid
-
-            # handle all positions that are 5' of the current one
-            while self.buffer and read.pos > self.buffer[0].pos:
-                tid, pos, records = self.buffer.popleft()
-                y = self._calc_pos(tid, pos, records)
-                if y:
+                for y in self._flush():
+                    yield y
+                self._bounds = []
+                self._reset(read.tid, read.pos)
+
+            # positions are reported if they are in any of the regions that
+            # are still in the window
+            if not self._bounds or self._bounds[-1] != (self.cur_start, self.cur_end):
+                self._bounds.append((self.cur_start, self.cur_end))
+
+            if read.pos > self.win_end:
+                # nothing is left to pile up on
+                for y in self._flush():
+                    yield y
+                self._reset(read.tid, read.pos)
+
+            elif read.pos - self.win_start >= _FLUSH_SIZE:
+                # handle all positions that are 5' of the current one
+                for y in self._flush(read.pos):
                     yield y
 
             self._push_read(read)
 
         # flush buffer for the end
-        while self.buffer:
-            tid, pos, records = self.buffer.popleft()
-            y = self._calc_pos(tid, pos, records)
+        for y in self._flush():
+            yield y
+
+    def _reset(self, tid, pos):
+        self.current_tid = tid
+        self.win_start = pos
+        self.win_end = pos - 1
+
+    def _flush(self, upto=None):
+        'Yields the positions in the window before upto (or all of them)'
+        end = self.win_end + 1
+        if upto is not None and upto < end:
+            end = upto
+
+        n = end - self.win_start
+        if n <= 0:
+            return
+
+        tid = self.current_tid
+        start = self.win_start
+        rows = zip(*self._counts[:, :n].tolist())
+        inserts = [self._inserts.pop(pos, None) for pos in xrange(start, end)] if self._inserts else None
+        records = [self._records.pop(pos, []) for pos in xrange(start, end)] if self.keep_reads else None
+
+        # shift the rest of the window to the front
+        used = self.win_end + 1 - self.win_start
+        self._counts[:, :used - n] = self._counts[:, n:used].copy()
+        self._counts[:, used - n:used] = 0
+        self.win_start = end
+
+        for i, row in enumerate(rows):
+            y = self._calc_pos(tid, start + i, row, inserts[i] if inserts else None, records[i] if records else None)
             if y:
                 yield y
 
-    def _push_read(self, read):
-        if not self.buffer:
-            self.buffer.append(MappingPos(read.tid, read.pos, []))
+        while len(self._bounds) > 1 and self._bounds[0][1] and self._bounds[0][1] < self.win_start:
+            self._bounds.pop(0)
+
+    def _read_error(self, read, msg):
+        sys.stderr.write('\n%s\nIf there is a BED file, is it sorted and reduced?\n' % msg)
+        sys.stderr.write('read: %s (%s:%s-%s)\n' % (read.qname, self.bam.references[read.tid], read.pos, read.aend))
+        sys.stderr.write('%s\n' % str(read))
+        if self.cur_chrom:
+            sys.stderr.write('current range: %s:%s-%s\n' % (self.cur_chrom, self.cur_start, self.cur_end))
+        sys.exit(1)
 
-        while self.buffer[-1].pos < read.aend:
-            self.buffer.append(MappingPos(read.tid, self.buffer[-1].pos + 1, []))
+    def _push_read(self, read):
+        if read.aend > self.win_end:
+            self.win_end = read.aend
+
+        if self.win_end - self.win_start >= self._counts.shape[1]:
+            grown = numpy.zeros((_ROWS, max(self._counts.shape[1] * 2, self.win_end - self.win_start + 1)), dtype=numpy.int64)
+            grown[:, :self._counts.shape[1]] = self._counts
+            self._counts = grown
+
+        counts = self._counts
+        seq = read.seq or ''
+        bases = _base_idx[numpy.frombuffer(seq, dtype=numpy.uint8)]
+        if read.qual:
+            quals = numpy.frombuffer(read.qual, dtype=numpy.uint8).astype(numpy.int64) - 33
+        else:
+            quals = numpy.zeros(len(seq), dtype=numpy.int64)
+        passed = quals >= self.min_qual
 
-        buf_idx = 0
-        while self.buffer[buf_idx].pos < read.pos:
-            buf_idx += 1
+        try:
+            ih = int(read.opt('IH'))
+        except KeyError:
+            ih = 1
 
+        plus = not read.is_reverse
+        ref_idx = read.pos - self.win_start
         read_idx = 0
+
+        if ref_idx < 0:
+            self._read_error(read, 'Read is out of order')
+
         for op, length in read.cigar:
-            if op == 0:  # M
-                for i in xrange(length):
-                    try:
-                        if read.qual:
-                            qualval = ord(read.qual[read_idx]) - 33
-                        else:
-                            qualval = 0
-                        self.buffer[buf_idx].records.append(MappingRecord(read_idx, op, read.seq[read_idx], qualval, read))
-                    except Exception, e:
-                        print e
-                        sys.stderr.write('\n%s\nIf there is a BED file, is it sorted and reduced?\n' % e)
-                        sys.stderr.write('read: %s (%s:%s-%s)\n' % (read.qname, self.bam.references[read.tid], read.pos, read.aend))
-                        sys.stderr.write('%s\n' % str(read))
-                        if self.cur_chrom:
-                            sys.stderr.write('current range: %s:%s-%s\n' % (self.cur_chrom, self.cur_start, self.cur_end))
-                        sys.exit(1)
-                    buf_idx += 1
-                    read_idx += 1
+            if op in [0, 7, 8]:  # M, =, X
+                if read_idx + length > len(seq):
+                    self._read_error(read, 'Read sequence is shorter than the CIGAR alignment')
+
+                ok = passed[read_idx:read_idx + length]
+                offsets = numpy.arange(ref_idx, ref_idx + length)[ok]
+                base_rows = bases[read_idx:read_idx + length][ok]
+
+                counts[base_rows, offsets] += 1
+                counts[_READS, ref_idx:ref_idx + length] += ok
+                counts[_IH, ref_idx:ref_idx + length] += ok * ih
+                if plus:
+                    counts[base_rows + _PLUS, offsets] += 1
+                    counts[_PLUS_READS, ref_idx:ref_idx + length] += ok
+
+                if self.keep_reads:
+                    for i in xrange(length):
+                        self._records.setdefault(self.win_start + ref_idx + i, []).append(MappingRecord(read_idx + i, op, seq[read_idx + i], int(quals[read_idx + i]), read))
+
+                ref_idx += length
+                read_idx += length
 
             elif op == 1:  # I
-                inseq = ''
-                inqual = 0
-                for i in xrange(length):
-                    inseq += read.seq[read_idx]
-                    if read.qual:
-                        inqual += ord(read.qual[read_idx]) - 33
-                    read_idx += 1
-
-                inqual = inqual / len(inseq)  # use an average of the entire inserted bases
-                                              # as the quality for the whole insert
-
-                self.buffer[buf_idx].records.append(MappingRecord(read_idx, op, inseq, inqual, read))
-
-            elif op == 2:  # D
-                mr = MappingRecord(read_idx, op, None, None, read)
-                for i in xrange(length):
-                    self.buffer[buf_idx].records.append(mr)
-                    buf_idx += 1
-
-            elif op == 3:  # N
-                mr = MappingRecord(read_idx, op, None, None, read)
-                for i in xrange(length):
-                    self.buffer[buf_idx].records.append(mr)
-                    buf_idx += 1
+                inseq = seq[read_idx:read_idx + length]
+
+                # use an average of the entire inserted bases
+                # as the quality for the whole insert
+                inqual = int(quals[read_idx:read_idx + length].sum()) / len(inseq)
+
+                read_idx += length
+
+                if self.keep_reads:
+                    self._records.setdefault(self.win_start + ref_idx, []).append(MappingRecord(read_idx, op, inseq, inqual, read))
+
+                if inqual >= self.min_qual:
+                    pos = self.win_start + ref_idx
+                    if not pos in self._inserts:
+                        self._inserts[pos] = [{}, 0, 0]
+
+                    insert = self._inserts[pos]
+                    if not inseq in insert[0]:
+                        insert[0][inseq] = 1
+                    else:
+                        insert[0][inseq] += 1
+                        insert[1] += 1
+                    if plus:
+                        insert[2] += 1
+
+                    counts[_READS, ref_idx] += 1
+                    counts[_IH, ref_idx] += ih
+                    if plus:
+                        counts[_PLUS_READS, ref_idx] += 1
+
+            elif op in [2, 3]:  # D, N
+                if op == 2:
+                    counts[_DEL, ref_idx:ref_idx + length] += 1
+                    counts[_IH, ref_idx:ref_idx + length] += ih
+                    if plus:
+                        counts[_PLUS_DEL, ref_idx:ref_idx + length] += 1
+                else:
+                    counts[_GAPS, ref_idx:ref_idx + length] += 1
+
+                counts[_READS, ref_idx:ref_idx + length] += 1
+                if plus:
+                    counts[_PLUS_READS, ref_idx:ref_idx + length] += 1
+
+                if self.keep_reads:
+                    mr = MappingRecord(read_idx, op, None, None, read)
+                    for i in xrange(length):
+                        self._records.setdefault(self.win_start + ref_idx + i, []).append(mr)
+
+                ref_idx += length
+
             elif op == 4:  # S - soft clipping
                 read_idx += length
-                pass
             elif op == 5:  # H - hard clipping
                 pass
 
@@ -406,12 +561,7 @@ def _calculate_heterozygosity(a, c, g, t):
     return float(minor - background) / (major - background + minor - background)
 
 
-def bam_basecall(bam, ref_fname, min_qual=0, min_count=0, regions=None, mask=1540, quiet=False, showgaps=False, showstrand=False, minorpct=0.01, altfreq=False, variants=False, profiler=None, out=sys.stdout):
-    if ref_fname:
-        ref = pysam.Fastafile(ref_fname)
-    else:
-        ref = None
-
+def bam_basecall(bam, ref_fname, min_qual=0, min_count=0, regions=None, mask=1540, quiet=False, showgaps=False, showstrand=False, minorpct=0.01, altfreq=False, variants=False, profiler=None, out=sys.stdout, procs=1):
     out.write('chrom\tpos\tref\tcount\tconsensus call\tminor call\tave mappings')
     if altfreq:
         out.write('\talt. allele freq')
@@ -422,8 +572,48 @@ def bam_basecall(bam, ref_fname, min_qual=0, min_count=0, regions=None, mask=154
 
     out.write('\n')
 
-    bbc = BamBaseCaller(bam, min_qual, min_count, regions, mask, quiet)
-    ebi_chr_convert = False
+    if procs > 1:
+        if ref_fname:
+            # convert the reference once, before the workers open it
+            open_reference(ref_fname, quiet=quiet).close()
+
+        if regions:
+            shards = ngsutils.bam.parallel.region_shards(regions)
+        else:
+            shards = ngsutils.bam.parallel.genome_shards(bam)
+
+        lines = ngsutils.bam.parallel.shard_map(bam, _basecall_shard, shards, procs, (ref_fname, min_qual, min_count, mask, showgaps, showstrand, minorpct, altfreq, variants), quiet=quiet)
+    else:
+        bbc = BamBaseCaller(bam, min_qual, min_count, regions, mask, quiet)
+        lines = _basecall_lines(bbc, ref_fname, min_count, showgaps, showstrand, minorpct, altfreq, variants, profiler)
+
+    for line in lines:
+        out.write(line)
+
+
+class _ShardRegions(list):
+    'The regions for one shard (a list of BedRegions with a total, like a BedFile)'
+    @property
+    def total(self):
+        return sum([x.end - x.start for x in self])
+
+
+def _basecall_shard(bam, shard, ref_fname, min_qual, min_count, mask, showgaps, showstrand, minorpct, altfreq, variants):
+    'Worker: the output lines for one shard of the genome or regions (see bam_basecall)'
+    if shard.regions:
+        bbc = BamBaseCaller(bam, min_qual, min_count, _ShardRegions(shard.regions), mask, quiet=True)
+    else:
+        bbc = BamBaseCaller(bam, min_qual, min_count, mask=mask, quiet=True, span=(shard.chrom, shard.start, shard.end))
+
+    return _basecall_lines(bbc, ref_fname, min_count, showgaps, showstrand, minorpct, altfreq, variants)
+
+
+def _basecall_lines(bbc, ref_fname, min_count=0, showgaps=False, showstrand=False, minorpct=0.01, altfreq=False, variants=False, profiler=None):
+    'Yields the output line for each position from a BamBaseCaller'
+    if ref_fname:
+        ref = open_reference(ref_fname)
+    else:
+        ref = None
 
     for basepos in bbc.fetch():
         if profiler and profiler.abort():
@@ -439,29 +629,16 @@ def bam_basecall(bam, ref_fname, min_qual=0, min_count=0, regions=None, mask=154
 
         refbase = ''
         if ref:
-            if not ebi_chr_convert:
-                refbase = ref.fetch(bbc.bam.references[basepos.tid], basepos.pos, basepos.pos + 1).upper()
-                if not refbase and not bbc.bam.references[basepos.tid].startswith('chr'):
-                    ebi_chr_convert = True
-            if not refbase and ebi_chr_convert:
-                refbase = ref.fetch('chr%s' % bbc.bam.references[basepos.tid], basepos.pos, basepos.pos + 1).upper()
+            # EBI style names (1, 2, ...) are converted to chr1, chr2... by the reference
+            refbase = ref.fetch(bbc.bam.references[basepos.tid], basepos.pos, basepos.pos + 1).upper()
         else:
             refbase = 'N'
 
         entropy = calc_entropy(basepos.a, basepos.c, basepos.g, basepos.t)
 
-        read_ih_acc = 0
-        plus_count = 0.0  # needs to be float
-        total_count = 0
-        for qpos, cigar_op, base, qual, read in basepos.reads:
-            total_count += 1
-            if not read.is_reverse:
-                plus_count += 1.0
-            if cigar_op in [0, 1, 2]:
-                try:
-                    read_ih_acc += int(read.opt('IH'))
-                except KeyError:
-                    read_ih_acc += 1
+        read_ih_acc = basepos.ih_acc
+        plus_count = float(basepos.plus_count)  # needs to be float
+        total_count = basepos.read_count
 
         inserts = []
         for insert in basepos.insertions:
@@ -519,7 +696,7 @@ def bam_basecall(bam, ref_fname, min_qual=0, min_count=0, regions=None, mask=154
             cols.append(basepos.del_minor)
             cols.append(basepos.ins_minor)
 
-        out.write('%s\n' % '\t'.join([str(x) for x in cols]))
+        yield '%s\n' % '\t'.join([str(x) for x in cols])
 
     bbc.close()
     if ref:
@@ -598,6 +775,7 @@ if __name__ == '__main__':
     variants = False
     minorpct = 0.04
     regions = None
+    procs = 1
 
     profile = None
 
@@ -633,6 +811,9 @@ if __name__ == '__main__':
             elif last == '-profile':
                 profile = arg
                 last = None
+            elif last == '-p':
+                procs = positive_int_arg('-p', arg, usage)
+                last = None
             elif arg == '-h':
                 usage()
             elif arg == '-showstrand':
@@ -645,7 +826,7 @@ if __name__ == '__main__':
                 variants = True
             elif arg == '-altfreq':
                 altfreq = True
-            elif arg in ['-qual', '-count', '-mask', '-ref', '-minorpct', '-profile', '-bed']:
+            elif arg in ['-qual', '-count', '-mask', '-ref', '-minorpct', '-profile', '-bed', '-p']:
                 last = arg
             elif not bam and os.path.exists(arg):
                 if os.path.exists('%s.bai' % arg):
@@ -680,5 +861,5 @@ if __name__ == '__main__':
             sys.stderr.write('Profiling...\n')
             cProfile.run('func()', profile)
         else:
-                bam_basecall(bamobj, ref, min_qual, min_count, regions, mask, quiet, showgaps, showstrand, minorpct, altfreq, variants, None)
+                bam_basecall(bamobj, ref, min_qual, min_count, regions, mask, quiet, showgaps, showstrand, minorpct, altfreq, variants, None, procs=procs)
         bamobj.close()
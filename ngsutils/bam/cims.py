@@ -17,11 +17,23 @@ See: Zhang and Darnell, Nature Biotechnology (2011)
      pmid:21633356
 """
 
+import multiprocessing
 import os
 import sys
-from ngsutils.bam import bam_pileup_iter
+import numpy
+from ngsutils.bam import bam_iter
+import ngsutils.bam.parallel
+from ngsutils.support.reference import open_reference
+from ngsutils.support import positive_int_arg
 import pysam
 
+# the initial size of the per-strand count windows
+_WINDOW_SIZE = 65536
+
+# the counts are checked (and the window moved) once the reads have moved
+# this far along the reference
+_FLUSH_SIZE = 16384
+
 
 def usage():
     print __doc__
@@ -44,6 +56,11 @@ Options:
 
     -window N        The maximum length of a deletion window
                      [default: 20]
+
+    -p N             Use N processes. With more than one BAM file, the
+                     files are read at the same time. Otherwise, the genome
+                     is split into shards that are processed in parallel.
+                     [default: 1]
 """
     sys.exit(1)
 
@@ -71,7 +88,7 @@ class BEDEmitter(object):
 class FASTAEmitter(object):
     def __init__(self, ref_fname, flanking=12, out=None):
         self.num = 1
-        self.ref = pysam.Fastafile(ref_fname)
+        self.ref = open_reference(ref_fname)
         assert flanking > 0
         self.flanking = flanking
 
@@ -123,8 +140,6 @@ class RegionManager(object):
         self.last_chrom = None
         self.start = 0
         self.end = 0
-        self.del_reads = set()
-        self.total_reads = set()
 
     def emit(self):
         if self.last_chrom:
@@ -134,10 +149,8 @@ class RegionManager(object):
         self.last_chrom = new_chrom
         self.start = new_pos
         self.end = new_pos
-        self.del_reads = set()
-        self.total_reads = set()
 
-    def add(self, chrom, pos, strand, del_reads, total_reads):
+    def add(self, chrom, pos, strand):
         if self.strand and strand != self.strand:
             # ignore this if the strand doesn't match
             return
@@ -150,94 +163,233 @@ class RegionManager(object):
             self.reset(chrom, pos)
 
         self.end = pos
-        self.del_reads |= del_reads
-        self.total_reads |= total_reads
 
     def close(self):
         self.emit()
 
 
-def is_read_del_at_pos(read, pos, ppos=0):
-    last_op = None
-    idx = 0
-    for op, length in read.cigar:
-        if op in [0, 1]:
-            idx += length
-
-        if pos < idx:
-            if op == 2 and last_op != 3:
-                return True
-        last_op = op
-
-    return False
-
-
-#TODO: Check this...
-def is_read_match_at_pos(read, pos):
-    idx = 0
-    for op, length in read.cigar:
-        if op in [0, 1]:
-            idx += length
-
-        if pos < idx:
-            if op == 2 or op == 0:
-                return True
+class StrandCounts(object):
+    '''
+    Per-base coverage and deletion counts for one strand of a reference. Only
+    a window of positions is kept, and the window moves along the reference
+    with the reads.
+
+    The counts are kept as difference arrays: each aligned block (or deletion)
+    of a read adds one at its first position and subtracts one after its last
+    position. Reads must be added in order, so all of the positions before the
+    start of the last read are final and can be removed with flush().
+    '''
+    def __init__(self, start=0, size=_WINDOW_SIZE):
+        self.start = start
+        self.coverage = numpy.zeros(size, dtype=numpy.int32)
+        self.deletions = numpy.zeros(size, dtype=numpy.int32)
+
+        # the counts at the position before the window
+        self._coverage_base = 0
+        self._deletion_base = 0
+
+    def _grow(self, end):
+        size = len(self.coverage)
+        while end - self.start >= size:
+            size *= 2
+
+        if size > len(self.coverage):
+            extra = size - len(self.coverage)
+            self.coverage = numpy.concatenate((self.coverage, numpy.zeros(extra, dtype=numpy.int32)))
+            self.deletions = numpy.concatenate((self.deletions, numpy.zeros(extra, dtype=numpy.int32)))
+
+    def add(self, read):
+        self._grow(read.aend)
+
+        pos = read.pos - self.start
+        last_op = None
+        for op, length in read.cigar:
+            if op in [0, 7, 8]:  # M, =, X
+                self.coverage[pos] += 1
+                self.coverage[pos + length] -= 1
+                pos += length
+            elif op == 2:  # D
+                self.coverage[pos] += 1
+                self.coverage[pos + length] -= 1
+                if last_op != 3:
+                    self.deletions[pos] += 1
+                    self.deletions[pos + length] -= 1
+                pos += length
+            elif op == 3:  # N
+                pos += length
+            last_op = op
+
+    def flush(self, cutoff, end=None):
+        '''
+        Removes the positions before end (or all of the positions) from the
+        window. Returns the positions where the fraction of reads with a
+        deletion is above the cutoff.
+        '''
+        start = self.start
+        if end is None:
+            end = start + len(self.coverage)
+
+        count = min(end - start, len(self.coverage))
+        if count <= 0:
+            return []
+
+        coverage = numpy.cumsum(self.coverage[:count]) + self._coverage_base
+        deletions = numpy.cumsum(self.deletions[:count]) + self._deletion_base
+
+        pct = deletions / numpy.maximum(coverage, 1).astype(float)
+        hits = numpy.flatnonzero((coverage > 0) & (pct > cutoff))
+
+        self._coverage_base = coverage[-1]
+        self._deletion_base = deletions[-1]
+
+        self.coverage[:-count] = self.coverage[count:]
+        self.coverage[-count:] = 0
+        self.deletions[:-count] = self.deletions[count:]
+        self.deletions[-count:] = 0
+        self.start = end
+
+        return (hits + start).tolist()
+
+
+def bam_cims_finder(bam_fnames, output='bed', ref_fname=None, flanking=12, cutoff=0.1, stranded=True, window_size=20, procs=1):
+    global _cims_state
+
+    if stranded:
+        strands = ['+', '-']
+    else:
+        strands = ['']
+
+    pool = None
+    file_hits = None
+    if procs > 1 and len(bam_fnames) > 1:
+        # Each file is read by its own process. The hits for each file are
+        # still written in file order.
+        _cims_state = (strands, cutoff)
+        pool = multiprocessing.Pool(min(procs, len(bam_fnames)))
+        file_hits = pool.imap(_cims_file, bam_fnames, 1)
+        pool.close()
+
+    try:
+        for bam_fname in bam_fnames:
+            sys.stderr.write('%s\n' % bam_fname)
+
+            if output == 'fasta':
+                emitter = FASTAEmitter(ref_fname, flanking)
+            else:
+                emitter = BEDEmitter()
+
+            if file_hits:
+                _cims_regions(emitter, file_hits.next(), strands, window_size)
+            else:
+                bam = pysam.Samfile(bam_fname, "rb")
+                if procs > 1:
+                    shards = ngsutils.bam.parallel.genome_shards(bam)
+                    hits = ngsutils.bam.parallel.shard_map(bam, _cims_shard, shards, procs, (strands, cutoff))
+                else:
+                    hits = _cims_hits(bam, bam_iter(bam), strands, cutoff)
+
+                _cims_regions(emitter, hits, strands, window_size)
+                bam.close()
+
+            emitter.close()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        _cims_state = None
+
+
+def _cims_regions(emitter, hits, strands, window_size):
+    '''
+    Writes the regions for the hits. The regions are written one strand at a
+    time, so the hits for the later strands are held back.
+    '''
+    managers = dict([(strand, RegionManager(emitter, strand, window_size)) for strand in strands])
+    held = dict([(strand, []) for strand in strands[1:]])
+
+    for strand, chrom, pos in hits:
+        if strand == strands[0]:
+            managers[strand].add(chrom, pos, strand)
+        else:
+            held[strand].append((chrom, pos))
+
+    managers[strands[0]].close()
+    for strand in strands[1:]:
+        for chrom, pos in held[strand]:
+            managers[strand].add(chrom, pos, strand)
+        managers[strand].close()
+
+
+_cims_state = None
+
+
+def _cims_file(bam_fname):
+    'Worker: the deletion hotspots for one BAM file (see bam_cims_finder)'
+    strands, cutoff = _cims_state
+    bam = pysam.Samfile(bam_fname, "rb")
+    hits = list(_cims_hits(bam, bam_iter(bam, quiet=True), strands, cutoff))
+    bam.close()
+    return hits
+
+
+def _cims_shard(bam, shard, strands, cutoff):
+    'Worker: the deletion hotspots for one shard of the genome (see bam_cims_finder)'
+    if not shard.chrom in bam.references:
+        return []
+    return _cims_hits(bam, bam.fetch(shard.chrom, shard.start, shard.end), strands, cutoff, (shard.start, shard.end))
+
+
+def _cims_hits(bam, reads, strands, cutoff, span=None):
+    '''
+    Yields (strand, chrom, pos) for each position where the % of reads with a
+    deletion is above the cutoff. The reads must be sorted. If a span
+    (start, end) is given, only positions in the span are returned.
+
+    Unmapped, QC failed and duplicate reads are skipped (like a pileup with
+    mask=1540).
+    '''
+    tid = None
+    chrom = None
+    counts = {}
+
+    for read in reads:
+        if read.is_unmapped or read.flag & 1540:
+            continue
+
+        if read.tid != tid:
+            for strand in strands:
+                if strand in counts:
+                    for hit in _cims_flush(counts[strand], cutoff, None, span):
+                        yield (strand, chrom, hit)
+
+            tid = read.tid
+            chrom = bam.getrname(tid)
+            counts = dict([(strand, StrandCounts(read.pos)) for strand in strands])
+
+        elif read.pos - counts[strands[0]].start >= _FLUSH_SIZE:
+            for strand in strands:
+                for hit in _cims_flush(counts[strand], cutoff, read.pos, span):
+                    yield (strand, chrom, hit)
+
+        if not strands[0]:
+            counts[''].add(read)
+        elif read.is_reverse:
+            counts['-'].add(read)
+        else:
+            counts['+'].add(read)
 
-    return False
+    for strand in strands:
+        if strand in counts:
+            for hit in _cims_flush(counts[strand], cutoff, None, span):
+                yield (strand, chrom, hit)
 
 
-def bam_cims_finder(bam_fnames, output='bed', ref_fname=None, flanking=12, cutoff=0.1, stranded=True, window_size=20):
-    for bam_fname in bam_fnames:
-        sys.stderr.write('%s\n' % bam_fname)
-        bam = pysam.Samfile(bam_fname, "rb")
+def _cims_flush(counts, cutoff, end, span):
+    for pos in counts.flush(cutoff, end):
+        if span and (pos < span[0] or pos >= span[1]):
+            continue
+        yield pos
 
-        if output == 'fasta':
-            emitter = FASTAEmitter(ref_fname, flanking)
-        else:
-            emitter = BEDEmitter()
-
-        if stranded:
-            strands = ['+', '-']
-        else:
-            strands = ['']
-
-        for strand in strands:
-            manager = RegionManager(emitter, strand, window_size)
-            for pileup in bam_pileup_iter(bam, mask=1540):
-                chrom = bam.getrname(pileup.tid)
-
-                deletions = 0.0
-                total = 0.0
-
-                del_reads = set()
-                total_reads = set()
-
-                for pileupread in pileup.pileups:
-                    if not strand or (strand == '+' and not pileupread.alignment.is_reverse) or (strand == '-' and pileupread.alignment.is_reverse):
-                        if is_read_match_at_pos(pileupread.alignment, pileupread.qpos):
-                            total += 1
-                            total_reads.add(pileupread.alignment.qname)
-
-                        if is_read_del_at_pos(pileupread.alignment, pileupread.qpos):
-                            deletions += 1
-                            del_reads.add(pileupread.alignment.qname)
-                            # print ""
-                            # print chrom
-                            # print pileup.pos
-                            # print pileupread.alignment.qname
-                            # print pileupread.alignment.pos
-                            # print pileupread.alignment.cigar
-                            # print pileupread.qpos
-
-                if total > 0:
-                    pct = deletions / total
-
-                    if pct > cutoff:
-                        manager.add(chrom, pileup.pos, strand, del_reads, total_reads)
-
-            manager.close()
-        bam.close()
-        emitter.close()
 
 if __name__ == '__main__':
     bams = []
@@ -247,6 +399,7 @@ if __name__ == '__main__':
     flanking = 12
     stranded = True
     window = 20
+    procs = 1
 
     last = None
     for arg in sys.argv[1:]:
@@ -259,13 +412,16 @@ if __name__ == '__main__':
         elif last == '-window':
             window = float(arg)
             last = None
-        elif last == '-fasta' and not ref and os.path.exists(arg) and os.path.exists('%s.fai' % arg):
+        elif last == '-p':
+            procs = positive_int_arg('-p', arg, usage)
+            last = None
+        elif last == '-fasta' and not ref and os.path.exists(arg):
             output = 'fasta'
             ref = arg
             last = None
         elif arg == '-h':
             usage()
-        elif arg in ['-flanking', '-fasta', '-cutoff', '-window']:
+        elif arg in ['-flanking', '-fasta', '-cutoff', '-window', '-p']:
             last = arg
         elif arg == '-ns':
             stranded = False
@@ -278,4 +434,4 @@ if __name__ == '__main__':
     if not bams:
         usage()
     else:
-        bam_cims_finder(bams, output, ref, flanking, cutoff, stranded, window)
+        bam_cims_finder(bams, output, ref, flanking, cutoff, stranded, window, procs)
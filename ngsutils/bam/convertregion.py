@@ -14,6 +14,9 @@ be named: chrom:start-end,start-end,etc...
 In this is the case, this script will ensure the proper conversion of
 reference, start position, and CIGAR alignment.
 
+The reference names are only parsed once. The parsed regions are saved next
+to the BAM file (in.bam.ngsregions) and reused for later runs.
+
 Example 1:
 chr1:1000-2000    20    50M
 
@@ -32,6 +35,7 @@ import os
 import sys
 import pysam
 import ngsutils.bam
+from ngsutils.bam.regionindex import RegionIndex
 
 
 def usage():
@@ -46,24 +50,6 @@ Options:
     sys.exit(1)
 
 
-def bam_batch_reads(bam):
-    '''
-    Batches mapping for the same reads (qname) together, this way
-    they can all be compared/converted together.
-    '''
-    reads = []
-    last = None
-    for read in bam:
-        if last and read.qname != last:
-            yield reads
-            reads = []
-        last = read.qname
-        reads.append(read)
-
-    if reads:
-        yield reads
-
-
 def bam_convertregion(infile, outfname, chrom_sizes, enforce_overlap=False, quiet=False):
     bamfile = pysam.Samfile(infile, "rb")
     header = bamfile.header
@@ -77,13 +63,20 @@ def bam_convertregion(infile, outfname, chrom_sizes, enforce_overlap=False, quie
 
     outfile = pysam.Samfile('%s.tmp' % outfname, "wb", header=header)
 
+    index = RegionIndex(bamfile, quiet=quiet)
+    out_tids = dict([(name, i) for i, name in enumerate(outfile.references)])
+
     converted_count = 0
     invalid_count = 0
     unmapped_count = 0
 
-    for batch in bam_batch_reads(bamfile):
+    # mappings for the same read are converted together
+    for batch in ngsutils.bam.bam_read_groups(bamfile):
         outreads = []
 
+        mapped = [read for read in batch if not read.is_unmapped or read.is_secondary]
+        converted = iter(index.convert_many([x.tid for x in mapped], [x.pos for x in mapped], [x.cigar for x in mapped]))
+
         for read in batch:
             if read.is_unmapped and not read.is_secondary:
                 unmapped_count += 1
@@ -91,7 +84,7 @@ def bam_convertregion(infile, outfname, chrom_sizes, enforce_overlap=False, quie
                     outfile.write(read)
                 continue
 
-            chrom, pos, cigar = ngsutils.bam.region_pos_to_genomic_pos(bamfile.getrname(read.tid), read.pos, read.cigar)
+            chrom, pos, cigar = converted.next()
 
             read.pos = pos
             try:
@@ -99,15 +92,10 @@ def bam_convertregion(infile, outfname, chrom_sizes, enforce_overlap=False, quie
             except:
                 print "Error trying to set CIGAR: %s to %s (%s, %s, %s)" % (read.cigar, cigar, read.qname, bamfile.getrname(read.tid), read.pos)
 
-            chrom_found = False
-            for i, name in enumerate(outfile.references):
-                if name == chrom:
-                    read.tid = i
-                    chrom_found = True
-                    break
-            if not chrom_found:
+            if not chrom in out_tids:
                 print "Can't find chrom: %s" % chrom
                 sys.exit(1)
+            read.tid = out_tids[chrom]
 
             if not enforce_overlap:
                 outfile.write(read)
@@ -155,6 +143,7 @@ def bam_convertregion(infile, outfname, chrom_sizes, enforce_overlap=False, quie
         #
         #     outfile.write(read)
 
+    index.close()
     bamfile.close()
     outfile.close()
 
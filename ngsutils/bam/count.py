@@ -89,6 +89,9 @@ Possible annotation models: gtf, exon, bed, repeat, repeatfam, or bin
     normalization options: total, quantile, none. If quantile normalization
     is performed, only bins that include a read will be used.
 
+    Each chromosome is read once and all of its bins are counted together
+    (unless -coverage is used, which is calculated for each bin separately).
+
     Requires: bin-size
     Calculates: # reads
 
@@ -123,9 +126,15 @@ Other options:
     -nostrand          ignore strand in counting reads
     -rev_read2         for paired-end reads, reverse the strand of the second fragment
     -coverage          calculate average coverage for genes/regions
+                       (mean, stdev, and median depth of the aligned bases)
     -uniq              only count unique starting positions
                        (avoids possible PCR artifacts, not recommended)
     -startonly         Only take into account the start pos of the read to assign counts
+    -sweep             Count all regions with a single pass through the BAM file
+                       (each reference is read once, instead of once per region;
+                       faster for models with many or overlapping regions)
+    -p num             Use {num} processes to count the regions (default: 1)
+                       (regions are split up by chromosome)
     -fpkm              calculate FPKM values based on millions of mapped reads
                        and the length of the region in kb (number of mapped reads
                        determined by -norm value)
@@ -172,6 +181,8 @@ if __name__ == '__main__':
     blacklist = None
     rev_read2 = False
     startonly = False
+    sweep = False
+    procs = 1
     model = None
     model_arg = None
     bamfile = None
@@ -193,6 +204,14 @@ if __name__ == '__main__':
                 usage('Invalid option for -multiple: %s' % arg)
             multiple = arg
             last = None
+        elif last == '-p':
+            try:
+                procs = int(arg)
+            except ValueError:
+                usage('Invalid value for -p: %s' % arg)
+            if procs < 1:
+                usage('Invalid value for -p: %s' % arg)
+            last = None
         elif last == '-whitelist':
             whitelist = []
             if not os.path.exists(arg):
@@ -210,12 +229,14 @@ if __name__ == '__main__':
         elif arg in ['-%s' % x for x in count.models]:
             model = arg[1:]
             last = arg
-        elif arg in ['-norm', '-multiple', '-whitelist', '-blacklist']:
+        elif arg in ['-norm', '-multiple', '-whitelist', '-blacklist', '-p']:
             last = arg
         elif arg == '-rev_read2':
             rev_read2 = True
         elif arg == '-startonly':
             startonly = True
+        elif arg == '-sweep':
+            sweep = True
         elif arg == '-nostrand':
             stranded = False
         elif arg == '-coverage':
@@ -241,5 +262,5 @@ if __name__ == '__main__':
 
     modelobj = count.models[model](model_arg)
     bam = bam_open(bamfile)
-    modelobj.count(bam, stranded, coverage, uniq_only, fpkm, norm, multiple, whitelist, blacklist, rev_read2=rev_read2, start_only=startonly)
+    modelobj.count(bam, stranded, coverage, uniq_only, fpkm, norm, multiple, whitelist, blacklist, rev_read2=rev_read2, start_only=startonly, sweep=sweep, procs=procs)
     bam.close()
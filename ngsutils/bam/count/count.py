@@ -1,15 +1,29 @@
 import ngsutils.support.stats
+import bisect
+import heapq
+import multiprocessing
+import os
+import shutil
 import sys
 import tempfile
+import numpy
 import ngsutils
+import ngsutils.bam
+import ngsutils.bam.coverage
+import ngsutils.bam.summary
 
 from ngsutils.bam.t import MockBam
 assert(MockBam)  # just for linting... it is used in a doctest
 
 
 class TmpCountFile(object):
-    def __init__(self):
-        self.tmpfile = tempfile.TemporaryFile()
+    def __init__(self, fname=None):
+        self.fname = fname
+        if fname:
+            # named files are used to pass counts back from worker processes
+            self.tmpfile = open(fname, 'a+')
+        else:
+            self.tmpfile = tempfile.TemporaryFile()
 
     def write(self, count, coding_len, cols):
         self.tmpfile.write('%s\t%s\t%s\n' % (count, coding_len, '\t'.join([str(x) for x in cols])))
@@ -21,8 +35,10 @@ class TmpCountFile(object):
             cols = line.strip('\n').split('\t')
             yield (int(cols[0]), int(cols[1]), cols[2:])
 
-    def close(self):
+    def close(self, keep=False):
         self.tmpfile.close()
+        if self.fname and not keep and os.path.exists(self.fname):
+            os.unlink(self.fname)
 
 
 class Model(object):
@@ -59,18 +75,116 @@ class Model(object):
     def get_postheaders(self):
         return None
 
-    def count(self, bam, stranded=False, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, rev_read2=False, start_only=False):
+    def count(self, bam, stranded=False, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, rev_read2=False, start_only=False, sweep=False, procs=1):
         # bam = pysam.Samfile(bamfile, 'rb')
 
         # region_counts = []
         # multireads = set()
         # single_count = 0
-        tmpcounts = TmpCountFile()
 
+        if procs > 1 and bam.filename:
+            tmpcounts, total_count, counts_tally = self._count_parallel(bam.filename, procs, stranded, coverage, uniq_only, multiple, whitelist, blacklist, rev_read2, start_only, sweep)
+        else:
+            tmpcounts = TmpCountFile()
+            total_count, counts_tally = self._count_regions(bam, self.get_regions(), tmpcounts, stranded, coverage, uniq_only, multiple, whitelist, blacklist, rev_read2, start_only, sweep)
+
+        try:
+            if not quiet:
+                sys.stderr.write('Calculating normalization...')
+
+            norm_val = None
+            norm_val_orig = None
+
+            if norm == 'all':
+                norm_val_orig = _find_mapped_count(bam, whitelist, blacklist, quiet)
+            elif norm == 'mapped':
+                # norm_val_orig = single_count + len(multireads)
+                norm_val_orig = total_count
+            # elif norm == 'quantile':
+            #     norm_val_orig = _find_mapped_count_pcts([x[0] for x in region_counts])
+            elif norm == 'median':
+                norm_val_orig = ngsutils.support.stats.count_median(counts_tally)
+                # norm_val_orig = _find_mapped_count_median([x[0] for x in region_counts])
+
+            if norm_val_orig:
+                norm_val = float(norm_val_orig) / 1000000
+
+            if not quiet:
+                sys.stderr.write('\n')
+
+            out.write('## %s\n' % (ngsutils.version()))
+            out.write('## input%s%s\n' % (' ' if bam.filename else '', bam.filename))
+            out.write('## model %s %s\n' % (self.get_name(), self.get_source()))
+            out.write('## stranded %s\n' % stranded)
+            out.write('## multiple %s\n' % multiple)
+            if start_only:
+                out.write('## start_only\n')
+            if norm_val:
+                out.write('## norm %s %s\n' % (norm, float(norm_val_orig)))
+                out.write('## CPM-factor %s\n' % norm_val)
+            if rev_read2:
+                out.write('## rev_read2\n')
+
+            out.write('#')
+            out.write('\t'.join(self.get_headers()))
+            out.write('\tlength\tcount')
+            if norm_val:
+                out.write('\tcount (CPM)')
+                if fpkm:
+                    out.write('\tRPKM')
+
+            if coverage:
+                out.write('\tcoverage mean\tcoverage stdev\tcoverage median')
+
+            if self.get_postheaders():
+                out.write('\t')
+                out.write('\t'.join(self.get_postheaders()))
+
+            out.write('\n')
+
+            for count, coding_len, outcols in tmpcounts.fetch():
+                first = True
+                for col in outcols:
+                    if not first:
+                        out.write('\t')
+                    first = False
+
+                    if col == '' or col is None:  # this is the marker for the 'count' col
+                        out.write('%s' % count)
+
+                        if norm_val:
+                            out.write('\t')
+                            out.write(str(count / norm_val))
+                            if fpkm:
+                                out.write('\t')
+                                out.write(str(count / (coding_len / 1000.0) / norm_val))
+
+                    else:
+                        out.write(str(col))
+
+                out.write('\n')
+        finally:
+            tmpcounts.close()
+
+    def _count_regions(self, bam, regions, tmpcounts, stranded, coverage, uniq_only, multiple, whitelist, blacklist, rev_read2, start_only, sweep, region_idxs=None):
+        '''
+        Counts the reads for each region and writes the output columns to tmpcounts.
+
+        If region_idxs is given, the model index for each region is written as the
+        first output column (this is used to merge the results from multiple
+        processes back into model order).
+
+        Returns the total count and a tally of the region counts (for normalization).
+        '''
         counts_tally = {}
         total_count = 0.0
 
-        for chrom, starts, ends, strand, cols, callback in self.get_regions():
+        if sweep:
+            region_counts = _sweep_region_counts(bam, regions, stranded, multiple, whitelist, blacklist, uniq_only, rev_read2, start_only)
+        else:
+            region_counts = _fetch_region_counts(bam, regions, stranded, multiple, whitelist, blacklist, uniq_only, rev_read2, start_only)
+
+        for i, (chrom, starts, ends, strand, cols, callback, count, reads) in enumerate(region_counts):
             outcols = cols[:]
 
             coding_len = 0
@@ -78,7 +192,6 @@ class Model(object):
                 coding_len += e - s
             outcols.append(coding_len)
 
-            count, reads = _fetch_reads(bam, chrom, strand if stranded else None, starts, ends, multiple, False, whitelist, blacklist, uniq_only, rev_read2, start_only)
             outcols.append('')
             total_count += count
 
@@ -107,87 +220,119 @@ class Model(object):
 
             if callback:
                 for callback_cols in callback(bam, count, reads, outcols):
+                    if region_idxs:
+                        callback_cols = [region_idxs[i]] + callback_cols
                     tmpcounts.write(count, coding_len, callback_cols)
                     # region_counts.append((count, coding_len, callback_cols))
             else:
-                    tmpcounts.write(count, coding_len, outcols)
+                if region_idxs:
+                    outcols = [region_idxs[i]] + outcols
+                tmpcounts.write(count, coding_len, outcols)
                 # region_counts.append((count, coding_len, outcols))
 
-        if not quiet:
-            sys.stderr.write('Calculating normalization...')
-
-        norm_val = None
-        norm_val_orig = None
+        return total_count, counts_tally
 
-        if norm == 'all':
-            norm_val_orig = _find_mapped_count(bam, whitelist, blacklist, quiet)
-        elif norm == 'mapped':
-            # norm_val_orig = single_count + len(multireads)
-            norm_val_orig = total_count
-        # elif norm == 'quantile':
-        #     norm_val_orig = _find_mapped_count_pcts([x[0] for x in region_counts])
-        elif norm == 'median':
-            norm_val_orig = ngsutils.support.stats.count_median(counts_tally)
-            # norm_val_orig = _find_mapped_count_median([x[0] for x in region_counts])
+    def _count_parallel(self, bamfile, procs, stranded, coverage, uniq_only, multiple, whitelist, blacklist, rev_read2, start_only, sweep):
+        '''
+        Counts the regions using a pool of worker processes, with the regions
+        sharded by chromosome. Each worker opens its own copy of the BAM file
+        and writes its own TmpCountFile. The shards are then merged back into
+        the original model order.
 
-        if norm_val_orig:
-            norm_val = float(norm_val_orig) / 1000000
+        The shard files are written to a temporary directory, which is removed
+        if a worker fails, or when the merged counts are closed.
 
-        if not quiet:
-            sys.stderr.write('\n')
-
-        out.write('## %s\n' % (ngsutils.version()))
-        out.write('## input%s%s\n' % (' ' if bam.filename else '', bam.filename))
-        out.write('## model %s %s\n' % (self.get_name(), self.get_source()))
-        out.write('## stranded %s\n' % stranded)
-        out.write('## multiple %s\n' % multiple)
-        if start_only:
-            out.write('## start_only\n')
-        if norm_val:
-            out.write('## norm %s %s\n' % (norm, float(norm_val_orig)))
-            out.write('## CPM-factor %s\n' % norm_val)
-        if rev_read2:
-            out.write('## rev_read2\n')
-
-        out.write('#')
-        out.write('\t'.join(self.get_headers()))
-        out.write('\tlength\tcount')
-        if norm_val:
-            out.write('\tcount (CPM)')
-            if fpkm:
-                out.write('\tRPKM')
-
-        if coverage:
-            out.write('\tcoverage mean\tcoverage stdev\tcoverage median')
-
-        if self.get_postheaders():
-            out.write('\t')
-            out.write('\t'.join(self.get_postheaders()))
-
-        out.write('\n')
-
-        for count, coding_len, outcols in tmpcounts.fetch():
-            first = True
-            for col in outcols:
-                if not first:
-                    out.write('\t')
-                first = False
-
-                if col == '' or col is None:  # this is the marker for the 'count' col
-                    out.write('%s' % count)
-
-                    if norm_val:
-                        out.write('\t')
-                        out.write(str(count / norm_val))
-                        if fpkm:
-                            out.write('\t')
-                            out.write(str(count / (coding_len / 1000.0) / norm_val))
+        Returns the merged counts, the total count, and a count tally for all shards.
+        '''
+        global _shard_state
+
+        shards = {}
+        shard_order = []
+        for idx, region in enumerate(self.get_regions()):
+            chrom = region[0]
+            if not chrom in shards:
+                shards[chrom] = ([], [])
+                shard_order.append(chrom)
+            shards[chrom][0].append(idx)
+            shards[chrom][1].append(region)
+
+        # largest shards first, so one big chromosome doesn't hold up the end
+        shard_order.sort(key=lambda x: -len(shards[x][0]))
+
+        # The worker processes are forked, so they inherit the model, the
+        # regions and any callbacks without needing to pickle them.
+        tmpdir = tempfile.mkdtemp(prefix='.ngsutils_count')
+        _shard_state = (self, bamfile, [shards[x] for x in shard_order], tmpdir, (stranded, coverage, uniq_only, multiple, whitelist, blacklist, rev_read2, start_only, sweep))
+
+        pool = multiprocessing.Pool(procs)
+        try:
+            results = pool.map(_count_shard, range(len(shard_order)), 1)
+            pool.close()
+        except:
+            shutil.rmtree(tmpdir, True)
+            raise
+        finally:
+            pool.terminate()
+            pool.join()
+            _shard_state = None
 
+        counts_tally = {}
+        total_count = 0.0
+        fnames = []
+
+        for fname, shard_total, shard_tally in results:
+            fnames.append(fname)
+            total_count += shard_total
+            for k in shard_tally:
+                if not k in counts_tally:
+                    counts_tally[k] = shard_tally[k]
                 else:
-                    out.write(str(col))
+                    counts_tally[k] += shard_tally[k]
 
-            out.write('\n')
-        tmpcounts.close()
+        return _MergedCountFiles(fnames, tmpdir), total_count, counts_tally
+
+
+_shard_state = None
+
+
+def _count_shard(shard_num):
+    'Worker process: counts the regions for one chromosome shard (see Model._count_parallel)'
+    model, bamfile, shards, tmpdir, args = _shard_state
+    region_idxs, regions = shards[shard_num]
+
+    fd, fname = tempfile.mkstemp(suffix='.counts', dir=tmpdir)
+    os.close(fd)
+
+    bam = ngsutils.bam.bam_open(bamfile)
+    tmpcounts = TmpCountFile(fname)
+    total_count, counts_tally = model._count_regions(bam, regions, tmpcounts, *args, region_idxs=region_idxs)
+    tmpcounts.close(keep=True)
+    bam.close()
+
+    return (fname, total_count, counts_tally)
+
+
+class _MergedCountFiles(object):
+    'Merges the TmpCountFiles written by the worker processes back into model order'
+    def __init__(self, fnames, tmpdir):
+        self.countfiles = [TmpCountFile(fname) for fname in fnames]
+        self.tmpdir = tmpdir
+
+    def fetch(self):
+        for idx, count, coding_len, cols in heapq.merge(*[_indexed_counts(x) for x in self.countfiles]):
+            yield (count, coding_len, cols)
+
+    def close(self):
+        try:
+            for countfile in self.countfiles:
+                countfile.close()
+        finally:
+            shutil.rmtree(self.tmpdir, True)
+
+
+def _indexed_counts(countfile):
+    for count, coding_len, cols in countfile.fetch():
+        yield (int(cols[0]), count, coding_len, cols[1:])
 
 
 def _calc_read_regions(read):
@@ -212,6 +357,74 @@ def _calc_read_regions(read):
     return regions
 
 
+class CachedRead(object):
+    '''
+    The parts of a read needed for counting (see ReadCache)
+
+    regions are the reference regions covered by the read (_calc_read_regions)
+    '''
+    __slots__ = ['qname', 'pos', 'aend', 'end', 'is_reverse', 'is_read2', 'tags', 'regions']
+
+    def __init__(self, read):
+        self.qname = read.qname
+        self.pos = read.pos
+        self.aend = read.aend
+        self.is_reverse = read.is_reverse
+        self.is_read2 = read.is_read2
+        self.tags = [(tag, val) for tag, val in read.tags if tag in ['IH', 'NH']]
+        self.regions = tuple(_calc_read_regions(read)) if read.cigar else ((read.pos, read.pos),)
+
+        # unmapped reads placed next to their mate cover one base
+        if read.aend is None:
+            self.end = read.pos + 1
+        else:
+            self.end = read.aend
+
+
+class ReadCache(object):
+    '''
+    Holds the reads for one span of a chromosome in memory, so that the same
+    reads can be counted for many sub-regions without fetching (and decoding)
+    them from the BAM file each time.
+
+    This can be used in place of the BAM file for _fetch_reads and
+    _fetch_reads_excluding, as long as all of the regions are within the
+    cached span.
+    '''
+    def __init__(self, bam, chrom, start, end):
+        self.chrom = chrom
+        self.references = bam.references
+        self._reads = []
+        self._starts = []
+        self._maxlen = 0
+
+        if chrom in bam.references:
+            for read in bam.fetch(chrom, start, end):
+                cached = CachedRead(read)
+                self._reads.append(cached)
+                self._starts.append(cached.pos)
+                if cached.end - cached.pos > self._maxlen:
+                    self._maxlen = cached.end - cached.pos
+
+    def fetch(self, chrom, start, end):
+        'Reads that overlap start-end (in the same order as bam.fetch)'
+        if chrom != self.chrom:
+            raise ValueError("ReadCache only holds reads for: %s" % self.chrom)
+
+        lo = bisect.bisect_left(self._starts, start - self._maxlen)
+        hi = bisect.bisect_left(self._starts, end)
+
+        for read in self._reads[lo:hi]:
+            if read.end > start:
+                yield read
+
+
+def _read_regions(read):
+    if isinstance(read, CachedRead):
+        return read.regions
+    return _calc_read_regions(read)
+
+
 def _fetch_reads_excluding(bam, chrom, strand, start, end, multiple, whitelist=None, blacklist=None, rev_read2=False):
     '''
     Find reads that exclude this region.
@@ -237,7 +450,7 @@ def _fetch_reads_excluding(bam, chrom, strand, start, end, multiple, whitelist=N
 
         if not strand or strand == read_strand:
             excl = True
-            for s, e in _calc_read_regions(read):
+            for s, e in _read_regions(read):
                 if start <= s <= end or start <= e <= end:
                     excl = False
                     break
@@ -348,17 +561,7 @@ def _fetch_reads(bam, chrom, strand, starts, ends, multiple, exclusive, whitelis
                         start_pos.add(k)
                         reads.add(read.qname)
 
-                        ih = 0
-                        for tag, val in read.tags:
-                            if tag == 'IH':
-                                ih = int(val)
-                                break
-                            elif tag == 'NH':
-                                ih = int(val)
-                                break
-
-                        if not ih:
-                            ih = 1
+                        ih = _read_ih(read)
 
                         if ih == 1 or multiple == 'complete':
                             count += 1
@@ -369,31 +572,405 @@ def _fetch_reads(bam, chrom, strand, starts, ends, multiple, exclusive, whitelis
     return count, reads
 
 
-def calc_coverage(bam, chrom, strand, starts, ends, whitelist, blacklist, rev_read2=False):
-    if not chrom in bam.references:
-        return 0, 0, 0
+def _fetch_region_counts(bam, regions, stranded, multiple, whitelist=None, blacklist=None, uniq=False, rev_read2=False, start_only=False):
+    '''
+    Counts each region with its own set of bam.fetch calls (see _fetch_reads).
+
+    Yields the region tuple from Model.get_regions with the count and read names appended:
+    chrom, starts, ends, strand, cols, callback, count, reads
+    '''
+    for chrom, starts, ends, strand, cols, callback in regions:
+        count, reads = _fetch_reads(bam, chrom, strand if stranded else None, starts, ends, multiple, False, whitelist, blacklist, uniq, rev_read2, start_only)
+        yield (chrom, starts, ends, strand, cols, callback, count, reads)
+
+
+class _SweepRegion(object):
+    'Running count for one model region while the sweep is active'
+    __slots__ = ['region', 'count', 'reads', 'start_pos', 'done']
+
+    def __init__(self, region):
+        self.region = region
+        self.count = 0
+        self.reads = set()
+        self.start_pos = {}
+        self.done = False
+
+
+def _sweep_region_counts(bam, regions, stranded, multiple, whitelist=None, blacklist=None, uniq=False, rev_read2=False, start_only=False):
+    '''
+    Counts all regions with a single pass over a coordinate-sorted BAM file.
+
+    Instead of calling bam.fetch for each region (and decoding reads that
+    overlap many regions over and over), the regions are sorted per
+    chromosome and each chromosome is streamed once. Each read is assigned to
+    every overlapping region using a list of active intervals.
+
+    The counts are the same as _fetch_region_counts: each start/end span of a
+    region is treated like a separate fetch, so reads are counted once per
+    span they overlap, and -uniq keeps the read that the per-span fetches
+    would have seen first.
+
+    Results are yielded in the same order as the model's regions, with the
+    same tuple format as _fetch_region_counts. The regions for a chromosome
+    are only yielded after that chromosome has been completely read, so
+    callbacks are free to use the BAM file.
+    '''
+    assert multiple in ['complete', 'partial', 'ignore']
+
+    if blacklist:
+        blacklist = set(blacklist)
+    if whitelist:
+        whitelist = set(whitelist)
+
+    references = set(bam.references)
+    chrom_order = []
+    chrom_spans = {}
+    results = []
+
+    for idx, region in enumerate(regions):
+        result = _SweepRegion(region)
+        results.append(result)
+        chrom, starts, ends = region[:3]
+        if not chrom in references or not starts:
+            result.done = True
+            continue
+        if not chrom in chrom_spans:
+            chrom_order.append(chrom)
+            chrom_spans[chrom] = []
+        for span_idx, (s, e) in enumerate(zip(starts, ends)):
+            chrom_spans[chrom].append((s, e, idx, span_idx))
+
+    next_idx = 0
+
+    for chrom in chrom_order:
+        spans = chrom_spans.pop(chrom)
+        spans.sort()
+        max_end = max([x[1] for x in spans])
+
+        active = []
+        span_i = 0
+
+        for read in bam.fetch(chrom, spans[0][0], max_end):
+            if blacklist and read.qname in blacklist:
+                continue
+            if whitelist and not read.qname in whitelist:
+                continue
+
+            read_start = read.pos
+            read_aend = read.aend
+
+            # unmapped reads placed next to their mate cover one base
+            if read_aend is None:
+                read_end = read_start + 1
+            else:
+                read_end = read_aend
+
+            while span_i < len(spans) and spans[span_i][0] < read_end:
+                active.append(spans[span_i])
+                span_i += 1
+
+            if not active:
+                continue
+
+            active = [x for x in active if x[1] > read_start]
+            overlapping = [x for x in active if x[0] < read_end]
+
+            if not overlapping:
+                continue
+
+            if read.is_reverse:
+                k = (read_aend, '-')
+            else:
+                k = (read_start, '+')
+
+            if read.is_read2 and rev_read2:
+                read_strand = '-' if not read.is_reverse else '+'
+            else:
+                read_strand = '+' if not read.is_reverse else '-'
+
+            ih = _read_ih(read)
 
-    coverage = []
-    for start, end in zip(starts, ends):
-        for pileup in bam.pileup(chrom, start, end):
-            count = 0
-            for pileupread in pileup.pileups:
-                if blacklist and pileupread.alignment.qname in blacklist:
+            if ih == 1 or multiple == 'complete':
+                val = 1
+            elif multiple == 'partial':
+                val = 1.0 / ih
+            else:
+                val = 0
+
+            # visit spans in model order, so that -uniq keeps the same read
+            # as the per-span fetches.
+            overlapping.sort(key=lambda x: (x[2], x[3]))
+
+            for s, e, idx, span_idx in overlapping:
+                result = results[idx]
+                r_chrom, r_starts, r_ends, r_strand = result.region[:4]
+
+                if stranded and r_strand and r_strand != read_strand:
                     continue
-                if not whitelist or pileupread.alignment.qname in whitelist:
-                    if strand:
-                        if pileupread.alignment.is_read2 and rev_read2:
-                            read_strand = '-' if not pileupread.alignment.is_reverse else '+'
+
+                if start_only:
+                    start_ok = False
+                    for s1, e1 in zip(r_starts, r_ends):
+                        if not read.is_reverse:
+                            if s1 <= read_start <= e1:
+                                start_ok = True
+                                break
                         else:
-                            read_strand = '+' if not pileupread.alignment.is_reverse else '-'
+                            if s1 <= read_aend <= e1:
+                                start_ok = True
+                                break
+
+                    if not start_ok:
+                        continue
 
-                        if strand != read_strand:
+                if uniq:
+                    if k in result.start_pos:
+                        prev_idx, prev_val, prev_qname = result.start_pos[k]
+                        if prev_idx <= span_idx:
                             continue
+                        # an earlier span would have seen this read first
+                        result.count -= prev_val
+                        del result.start_pos[k]
+                        if not any(x[2] == prev_qname for x in result.start_pos.itervalues()):
+                            result.reads.discard(prev_qname)
+                    result.start_pos[k] = (span_idx, val, read.qname)
+
+                result.reads.add(read.qname)
+                result.count += val
+
+        for s, e, idx, span_idx in spans:
+            results[idx].done = True
+
+        while next_idx < len(results) and results[next_idx].done:
+            result = results[next_idx]
+            results[next_idx] = None
+            next_idx += 1
+            yield tuple(result.region) + (result.count, result.reads)
+
+    while next_idx < len(results):
+        result = results[next_idx]
+        results[next_idx] = None
+        next_idx += 1
+        yield tuple(result.region) + (result.count, result.reads)
+
+
+def _read_ih(read):
+    'Number of mappings for a read (IH or NH tag, defaults to 1)'
+    ih = 0
+    for tag, val in read.tags:
+        if tag == 'IH':
+            ih = int(val)
+            break
+        elif tag == 'NH':
+            ih = int(val)
+            break
+
+    if not ih:
+        ih = 1
+
+    return ih
+
+
+# reads are tallied into the bins in chunks of this many reads (see _BinTally)
+_BIN_CHUNK = 65536
+
+
+class _BinTally(object):
+    '''
+    Running per-bin counts for one strand (see _bin_counts). Reads are added
+    to fixed-size numpy chunks, and each chunk is tallied into the bins with
+    numpy.bincount when it fills up.
+
+    For -uniq, the (bin, start) pairs that have already been counted are
+    kept between chunks. Reads are sorted by position, so only the pairs that
+    a later read could still have are kept.
+    '''
+    def __init__(self, nbins, binsize, multiple, uniq, size=_BIN_CHUNK):
+        self.nbins = nbins
+        self.binsize = binsize
+        self.multiple = multiple
+        self.uniq = uniq
+
+        self._first = numpy.zeros(size, dtype=numpy.int64)
+        self._last = numpy.zeros(size, dtype=numpy.int64)
+        self._keys = numpy.zeros(size, dtype=numpy.int64)
+        self._ihs = numpy.zeros(size, dtype=numpy.int64)
+        self._n = 0
+        self._pos = 0
+
+        self._seen_bins = numpy.zeros(0, dtype=numpy.int64)
+        self._seen_keys = numpy.zeros(0, dtype=numpy.int64)
+
+        if multiple == 'partial':
+            self._totals = numpy.zeros(nbins, dtype=numpy.float64)
+            self._has_partial = numpy.zeros(nbins, dtype=numpy.int64)
+        else:
+            self._totals = numpy.zeros(nbins, dtype=numpy.int64)
+
+    def add(self, pos, first, last, key, ih):
+        i = self._n
+        self._first[i] = first
+        self._last[i] = last
+        self._keys[i] = key
+        self._ihs[i] = ih
+        self._n += 1
+        self._pos = pos
+
+        if self._n == len(self._first):
+            self.flush()
+
+    def flush(self):
+        n = self._n
+        if not n:
+            return
+
+        first = self._first[:n]
+        last = self._last[:n]
+
+        # one entry for each bin that each read is in (in read order)
+        spans = last - first + 1
+        offsets = numpy.cumsum(spans) - spans
+        read_idx = numpy.repeat(numpy.arange(n), spans)
+        bins = numpy.repeat(first, spans) + numpy.arange(len(read_idx)) - numpy.repeat(offsets, spans)
+
+        if self.uniq:
+            uniq_idx = self._uniq(bins, self._keys[read_idx])
+            bins = bins[uniq_idx]
+            read_idx = read_idx[uniq_idx]
+
+        bin_ih = self._ihs[read_idx]
+
+        if self.multiple == 'complete':
+            self._totals += numpy.bincount(bins, minlength=self.nbins)
+        elif self.multiple == 'ignore':
+            self._totals += numpy.bincount(bins[bin_ih == 1], minlength=self.nbins)
+        else:
+            weights = numpy.where(bin_ih > 1, 1.0 / numpy.maximum(bin_ih, 1), 1.0)
+            self._totals += numpy.bincount(bins, weights=weights, minlength=self.nbins)
+            self._has_partial += numpy.bincount(bins[bin_ih > 1], minlength=self.nbins)
+
+        self._n = 0
+
+    def _uniq(self, bins, keys):
+        '''
+        Returns the indexes of the (bin, start) pairs that are seen for the
+        first time (in this chunk or an earlier one).
+        '''
+        nseen = len(self._seen_bins)
+        all_bins = numpy.concatenate([self._seen_bins, bins])
+        all_keys = numpy.concatenate([self._seen_keys, keys])
+
+        key_span = all_keys.max() + 2
+        # return_index gives the first occurrence of each bin/start pair
+        idx = numpy.unique(all_bins * key_span + all_keys + 1, return_index=True)[1]
+        idx.sort()
+
+        # later reads start at or after the last position, so they can only
+        # share a pair in a bin from there on, with a start from there on
+        # (or a reverse read without an end)
+        kept_bins = all_bins[idx]
+        kept_keys = all_keys[idx]
+        valid = (kept_bins >= self._pos // self.binsize) & ((kept_keys >= self._pos * 2) | (kept_keys == -1))
+        self._seen_bins = kept_bins[valid]
+        self._seen_keys = kept_keys[valid]
+
+        return idx[idx >= nseen] - nseen
+
+    def counts(self):
+        self.flush()
+        if self.multiple != 'partial':
+            return self._totals.tolist()
+
+        # bins without any multiple-mapped reads keep an integer count
+        has_partial = self._has_partial.tolist()
+        return [val if has_partial[i] else int(val) for i, val in enumerate(self._totals.tolist())]
+
+
+def _bin_counts(bam, chrom, chrom_len, binsize, stranded, multiple, whitelist=None, blacklist=None, uniq=False, rev_read2=False, start_only=False, chunk_size=_BIN_CHUNK):
+    '''
+    Counts the reads in every bin of a chromosome with a single pass over the
+    chromosome's reads (see BinModel).
+
+    Each read is assigned to the range of bins that it overlaps (or just the
+    bin with its starting position for start_only), and the bins are tallied
+    with numpy.bincount, one chunk of reads at a time (see _BinTally). The
+    counts are the same as calling _fetch_reads for each bin: reads that span
+    a bin boundary are counted in each bin, and -uniq keeps the first read
+    with a given start in each bin.
+
+    Returns a dictionary of strand ('+', '-' or None if not stranded) to a
+    list of the counts for each bin.
+    '''
+    assert multiple in ['complete', 'partial', 'ignore']
+
+    if blacklist:
+        blacklist = set(blacklist)
+    if whitelist:
+        whitelist = set(whitelist)
+
+    nbins = (chrom_len + binsize - 1) // binsize
+    strands = ['+', '-'] if stranded else [None]
+
+    tallies = dict([(x, _BinTally(nbins, binsize, multiple, uniq, chunk_size)) for x in strands])
+
+    if chrom in bam.references:
+        for read in bam.fetch(chrom, 0, chrom_len):
+            if blacklist and read.qname in blacklist:
+                continue
+            if whitelist and not read.qname in whitelist:
+                continue
 
-                    if not pileupread.is_del:
-                        count += 1
+            if stranded:
+                if read.is_read2 and rev_read2:
+                    strand = '-' if not read.is_reverse else '+'
+                else:
+                    strand = '+' if not read.is_reverse else '-'
+            else:
+                strand = None
+
+            # unmapped reads placed next to their mate cover one base
+            if read.aend is None:
+                read_end = read.pos + 1
+            else:
+                read_end = read.aend
+
+            if start_only:
+                if not read.is_reverse:
+                    first = last = read.pos // binsize
+                elif read.aend is None:
+                    continue
+                else:
+                    first = last = (read.aend - 1) // binsize
+            else:
+                first = read.pos // binsize
+                last = min((read_end - 1) // binsize, nbins - 1)
+
+            # strand specific start position (for -uniq)
+            if not read.is_reverse:
+                key = read.pos * 2
+            elif read.aend is None:
+                key = -1
+            else:
+                key = read.aend * 2 + 1
+
+            tallies[strand].add(read.pos, first, last, key, _read_ih(read))
 
-            coverage.append(count)
+    counts = {}
+    for strand in strands:
+        counts[strand] = tallies[strand].counts()
+
+    return counts
+
+
+def calc_coverage(bam, chrom, strand, starts, ends, whitelist, blacklist, rev_read2=False):
+    '''
+    Mean, stdev, and median of the per-base coverage across the regions
+    (see ngsutils.bam.coverage)
+    '''
+    if not chrom in bam.references:
+        return 0, 0, 0
+
+    coverage = ngsutils.bam.coverage.regions_depth(bam, chrom, starts, ends, strand, whitelist, blacklist, rev_read2).tolist()
 
     if coverage:
         mean, stdev = ngsutils.support.stats.mean_stdev(coverage)
@@ -454,6 +1031,13 @@ def _find_mapped_count(bam, whitelist=None, blacklist=None, quiet=False):
     >>> _find_mapped_count(MockBam(['chr1']).add_read('foo1', tid=0, pos=100, cigar='50M', tags=[('IH', 2)]).add_read('foo1', tid=0, pos=200, cigar='50M', tags=[('IH', 2)]).add_read('foo2', tid=0, pos=100, cigar='50M').add_read('foo3', tid=0, pos=100, cigar='50M').add_read('foo4'), quiet=True)
     3
     '''
+    if not whitelist and not blacklist and bam.filename:
+        # the total is stored in the BAM summary sidecar (.ngsstats)
+        mapped_count = ngsutils.bam.summary.BamSummary(bam.filename, quiet=quiet).mapped_reads
+        if not quiet:
+            sys.stderr.write("%s mapped reads\n" % mapped_count)
+        return mapped_count
+
     if not quiet:
         sys.stderr.write('Finding number of mapped reads\n')
     bam.seek(0)
@@ -1,4 +1,4 @@
-from count import Model, _fetch_reads, _find_mapped_count, _fetch_reads_excluding
+from count import Model, ReadCache, _bin_counts, _fetch_reads, _find_mapped_count, _fetch_reads_excluding
 from eta import ETA
 from ngsutils.gtf import GTF
 from ngsutils.bed import BedFile
@@ -85,7 +85,13 @@ class ExonModel(Model):
                 else:
                     was_last_const = False
 
-            def callback(bam, common_count, common_reads, common_cols):
+            # gene and const_spans are bound here, so the callback is still valid
+            # if it is called after the next gene is read (-sweep)
+            def callback(bam, common_count, common_reads, common_cols, gene=gene, const_spans=const_spans):
+                # fetch the reads for the gene once - all of the constant
+                # span / region / excluding counts come from this cache
+                cache = ReadCache(bam, gene.chrom, gene.start, gene.end)
+
                 # gather constant reads
                 const_count = 0
                 for span in const_spans:
@@ -96,13 +102,13 @@ class ExonModel(Model):
                         starts.append(start)
                         ends.append(end)
 
-                    count, reads = _fetch_reads(bam, gene.chrom, gene.strand if self.stranded else None, starts, ends, self.multiple, False, self.whitelist, self.blacklist, self.uniq_only, self.rev_read2)
+                    count, reads = _fetch_reads(cache, gene.chrom, gene.strand if self.stranded else None, starts, ends, self.multiple, False, self.whitelist, self.blacklist, self.uniq_only, self.rev_read2)
                     const_count += count
 
                 #find counts for each region
                 for num, start, end, const, names in gene.regions:
-                    count, reads = _fetch_reads(bam, gene.chrom, gene.strand if self.stranded else None, [start], [end], self.multiple, False, self.whitelist, self.blacklist, self.uniq_only, self.rev_read2)
-                    excl_count, excl_reads = _fetch_reads_excluding(bam, gene.chrom, gene.strand if self.stranded else None, start, end, self.multiple, self.whitelist, self.blacklist, self.rev_read2)
+                    count, reads = _fetch_reads(cache, gene.chrom, gene.strand if self.stranded else None, [start], [end], self.multiple, False, self.whitelist, self.blacklist, self.uniq_only, self.rev_read2)
+                    excl_count, excl_reads = _fetch_reads_excluding(cache, gene.chrom, gene.strand if self.stranded else None, start, end, self.multiple, self.whitelist, self.blacklist, self.rev_read2)
 
                     # remove reads that exclude this region
                     for read in excl_reads:
@@ -144,7 +150,7 @@ class ExonModel(Model):
             yield (gene.chrom, starts, ends, gene.strand, [gene.gene_name, gene.gene_id, gene.isoform_id, gene.chrom, gene.strand, gene.start, gene.end], callback)
         eta.done()
 
-    def count(self, bam, stranded=False, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, rev_read2=False, start_only=False):
+    def count(self, bam, stranded=False, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, rev_read2=False, start_only=False, sweep=False, procs=1):
         self.stranded = stranded
         self.uniq_only = uniq_only
         self.multiple = multiple
@@ -152,7 +158,7 @@ class ExonModel(Model):
         self.blacklist = blacklist
         self.rev_read2 = rev_read2
 
-        Model.count(self, bam, stranded, coverage, uniq_only, fpkm, norm, multiple, whitelist, blacklist, out, quiet, rev_read2, start_only)
+        Model.count(self, bam, stranded, coverage, uniq_only, fpkm, norm, multiple, whitelist, blacklist, out, quiet, rev_read2, start_only, sweep, procs)
 
 
 class BinModel(Model):
@@ -194,17 +200,58 @@ class BinModel(Model):
             yield (chrom, [pos], [chrom_len], '+', [chrom, pos, chrom_len, '+'], None)
             if self.stranded:
                 eta.print_status(pos_acc, extra='%s:%s[-]' % (chrom, bin))
-                yield (chrom, [pos], [chrom_len], '- ', [chrom, pos, chrom_len, '-'], None)
+                yield (chrom, [pos], [chrom_len], '-', [chrom, pos, chrom_len, '-'], None)
 
         eta.done()
 
-    def count(self, bam, stranded=False, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, rev_read2=False, start_only=False):
+    def count(self, bam, stranded=False, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, rev_read2=False, start_only=False, sweep=False, procs=1):
         self.stranded = stranded
         self.chrom_lens = []
 
         for chrom, chrom_len in zip(bam.references, bam.lengths):
             self.chrom_lens.append((chrom, chrom_len))
-        Model.count(self, bam, stranded, coverage, uniq_only, fpkm, norm, multiple, whitelist, blacklist, out, quiet, rev_read2, start_only)
+        Model.count(self, bam, stranded, coverage, uniq_only, fpkm, norm, multiple, whitelist, blacklist, out, quiet, rev_read2, start_only, sweep, procs)
+
+    def _count_regions(self, bam, regions, tmpcounts, stranded, coverage, uniq_only, multiple, whitelist, blacklist, rev_read2, start_only, sweep, region_idxs=None):
+        '''
+        Instead of fetching the reads for each bin, the reads for each
+        chromosome are read once and the bins are all counted at the same
+        time (see _bin_counts).
+
+        Coverage is still calculated for each bin separately, so this uses
+        the normal per-region counting.
+        '''
+        if coverage:
+            return Model._count_regions(self, bam, regions, tmpcounts, stranded, coverage, uniq_only, multiple, whitelist, blacklist, rev_read2, start_only, sweep, region_idxs)
+
+        chrom_lens = dict(self.chrom_lens)
+        counts_tally = {}
+        total_count = 0.0
+
+        last_chrom = None
+        bin_counts = None
+
+        for i, (chrom, starts, ends, strand, cols, callback) in enumerate(regions):
+            if chrom != last_chrom:
+                bin_counts = _bin_counts(bam, chrom, chrom_lens[chrom], self.binsize, stranded, multiple, whitelist, blacklist, uniq_only, rev_read2, start_only)
+                last_chrom = chrom
+
+            count = bin_counts[strand if stranded else None][starts[0] // self.binsize]
+            coding_len = ends[0] - starts[0]
+            total_count += count
+
+            if count > 0:
+                if not count in counts_tally:
+                    counts_tally[count] = 1
+                else:
+                    counts_tally[count] += 1
+
+            outcols = cols + [coding_len, '']
+            if region_idxs:
+                outcols = [region_idxs[i]] + outcols
+            tmpcounts.write(count, coding_len, outcols)
+
+        return total_count, counts_tally
 
 
 class BEDModel(Model):
@@ -292,7 +339,7 @@ class RepeatFamilyModel(Model):
         for family, member, chrom, start, end, strand in _repeatreader(self.fname):
             yield (chrom, [start], [end], strand, [family, member, chrom, start, end, strand], None)
 
-    def count(self, bam, stranded=False, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, rev_read2=False, start_only=False):
+    def count(self, bam, stranded=False, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, rev_read2=False, start_only=False, sweep=False, procs=1):
         # This is a separate count implementation because for repeat families,
         # we need to combine the counts from multiple regions in the genome,
         # so the usual chrom, starts, ends loop breaks down.
@@ -301,6 +348,14 @@ class RepeatFamilyModel(Model):
             sys.stderr.write('Coverage calculations not supported with repeatmasker family models\n')
             sys.exit(1)
 
+        if sweep:
+            sys.stderr.write('Single-pass counting (-sweep) not supported with repeatmasker family models\n')
+            sys.exit(1)
+
+        if procs > 1:
+            sys.stderr.write('Parallel counting (-p) not supported with repeatmasker family models\n')
+            sys.exit(1)
+
         if norm and norm not in ['all', 'mapped']:
             sys.stderr.write('Normalization "%s" not supported with repeatmasker family models\n' % norm)
             sys.exit(1)
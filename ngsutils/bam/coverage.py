@@ -0,0 +1,111 @@
+'''
+Per-base read coverage for regions of a BAM file
+
+Instead of walking a pileup column by column, the coverage for a region is
+built from the aligned blocks of each read. The start and end of each block
+are tallied in a difference array (numpy.bincount), and the running sum
+(numpy.cumsum) of this array is the depth at each base.
+
+Only aligned bases (CIGAR M, =, X) are counted. Deletions and introns (N)
+don't count towards the coverage of a position.
+'''
+
+import numpy
+
+# unmapped, secondary, QC fail, duplicate (same as the pileup default)
+DEFAULT_MASK = 1796
+
+
+def read_blocks(read):
+    '''
+    Returns the [start, end) reference positions for each aligned block in a read.
+    '''
+    return _read_blocks(read.pos, read.cigar)
+
+
+def _read_blocks(pos, cigar):
+    '''
+    >>> _read_blocks(1, [(0, 50)])
+    [(1, 51)]
+
+    5S20M1D4M100N10M5I10M5S
+    >>> _read_blocks(1, [(4, 5), (0, 20), (2, 1), (0, 4), (3, 100), (0, 10), (1, 5), (0, 10), (4, 5)])
+    [(1, 21), (22, 26), (126, 136), (136, 146)]
+    '''
+    blocks = []
+    ref_pos = pos
+
+    for op, length in cigar:
+        if op in [0, 7, 8]:
+            blocks.append((ref_pos, ref_pos + length))
+            ref_pos += length
+        elif op in [2, 3]:
+            ref_pos += length
+
+    return blocks
+
+
+def region_depth(bam, chrom, start, end, strand=None, whitelist=None, blacklist=None, rev_read2=False, mask=DEFAULT_MASK, reads=None):
+    '''
+    Returns a numpy array with the number of reads covering each base of a
+    region (zero-based, start to end).
+
+    strand        - only count reads on this strand ('+' or '-')
+    whitelist     - only count these reads (by name)
+    blacklist     - don't count these reads (by name)
+    rev_read2     - reverse the strand of the second read in a pair
+    mask          - skip reads with any of these flags set
+    reads         - if this is a set, the names of the reads that cover at
+                    least one base in the region are added to it
+    '''
+    length = end - start
+    if length <= 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    block_starts = []
+    block_ends = []
+
+    if chrom in bam.references:
+        for read in bam.fetch(chrom, start, end):
+            if read.flag & mask or not read.cigar:
+                continue
+            if blacklist and read.qname in blacklist:
+                continue
+            if whitelist and not read.qname in whitelist:
+                continue
+
+            if strand:
+                if read.is_read2 and rev_read2:
+                    read_strand = '-' if not read.is_reverse else '+'
+                else:
+                    read_strand = '+' if not read.is_reverse else '-'
+
+                if strand != read_strand:
+                    continue
+
+            found = False
+            for s, e in read_blocks(read):
+                if e <= start or s >= end:
+                    continue
+
+                block_starts.append(max(s, start) - start)
+                block_ends.append(min(e, end) - start)
+                found = True
+
+            if found and reads is not None:
+                reads.add(read.qname)
+
+    diff = numpy.bincount(numpy.array(block_starts, dtype=numpy.int64), minlength=length + 1)
+    diff -= numpy.bincount(numpy.array(block_ends, dtype=numpy.int64), minlength=length + 1)
+
+    return numpy.cumsum(diff[:length])
+
+
+def regions_depth(bam, chrom, starts, ends, strand=None, whitelist=None, blacklist=None, rev_read2=False, mask=DEFAULT_MASK, reads=None):
+    '''
+    Returns the coverage for multiple regions (exons) as one array (see region_depth).
+    '''
+    depths = [region_depth(bam, chrom, s, e, strand, whitelist, blacklist, rev_read2, mask, reads) for s, e in zip(starts, ends)]
+    if not depths:
+        return numpy.zeros(0, dtype=numpy.int64)
+    return numpy.concatenate(depths)
@@ -7,92 +7,360 @@ Outputs information about reads in a BAM file.
 This can be used to optionally extract various fields from a BAM file on a
 read-by-read basis. By default this will export the read-name, the mapped
 reference, the mapped position, and the CIGAR alignment string for a read.
+
+The fields can also be written as columns to a NumPy .npz file (one array
+per field), so that they can be loaded without parsing a text file.
+
+For a sorted and indexed BAM file, the references can be exported by more
+than one process (-p). Each reference is read from the index by a worker
+process and the results are written out in the same order as the BAM file.
 '''
 
 import sys
 import os
-from ngsutils.bam import bam_iter, cigar_tostr, bam_open
+import multiprocessing
+import operator
+import shutil
+import tempfile
+
+import numpy
+
+from ngsutils.bam import bam_iter, cigar_tostr, bam_open, bam_unmapped_iter
+from ngsutils.support import positive_int_arg
+from eta import ETA
+
+# lines (or values) are written out in batches of this size
+_BATCH_SIZE = 4096
+
+# fields that are exported as integer columns (-npz); everything else is a string
+_INT_FIELDS = set(['-pos', '-flags', '-mapq', '-nextpos', '-tlen', '-isize'])
+
+_TAG_TYPES = {int: 'i', long: 'i', float: 'f'}
+
+
+def bam_export(bam, mapped=True, unmapped=True, whitelist=None, blacklist=None, fields=None, out=sys.stdout, quiet=False, procs=1, npz=None):
+    '''
+    Exports the fields for each read in a BAM file. The fields are written as
+    tab-delimited text to out, or if npz is given, as columns to a NumPy .npz
+    file.
+    '''
+    if not fields:
+        fields = ['-name', '-ref', '-pos', '-cigar']
+
+    if whitelist:
+        whitelist = set(whitelist)
+    if blacklist:
+        blacklist = set(blacklist)
 
+    if procs > 1 and bam.filename and os.path.exists('%s.bai' % bam.filename):
+        _bam_export_parallel(bam.filename, mapped, unmapped, whitelist, blacklist, fields, out, quiet, procs, npz)
+        return
 
-def bam_export(bam, mapped=True, unmapped=True, whitelist=None, blacklist=None, fields=None, out=sys.stdout, quiet=False):
-    for read in bam_iter(bam, quiet=quiet):
+    if npz:
+        writer = ColumnWriter(fields)
+    else:
+        writer = TextWriter(out, fields)
+
+    try:
+        _export_reads(bam, bam_iter(bam, quiet=quiet), fields, mapped, unmapped, whitelist, blacklist, writer)
+        writer.close()
+    except IOError:
+        return
+
+    if npz:
+        writer.save(npz)
+
+
+def _export_reads(bam, reads, fields, mapped, unmapped, whitelist, blacklist, writer):
+    extractors = compile_fields(bam, fields)
+
+    for read in reads:
         if whitelist and not read.qname in whitelist:
             continue
         if blacklist and read.qname in blacklist:
             continue
 
-        try:
-            if mapped and not read.is_unmapped:
-                export_read(bam, read, fields, out)
-            elif unmapped and read.is_unmapped:
-                export_read(bam, read, fields, out)
-        except IOError:
-            break
+        if read.is_unmapped:
+            if not unmapped:
+                continue
+        elif not mapped:
+            continue
 
+        writer.add([func(read) for func in extractors])
 
-def export_read(bamfile, read, fields, out=sys.stdout):
-    cols = []
+
+def _bam_export_parallel(fname, mapped, unmapped, whitelist, blacklist, fields, out, quiet, procs, npz):
+    '''
+    Exports each reference of a sorted and indexed BAM file (and the unplaced
+    reads at the end of the file) in a separate worker process. Each worker
+    writes to a temporary file, and these are combined in reference order.
+    '''
+    global _export_state
+
+    bamfile = bam_open(fname)
+    jobs = range(len(bamfile.references))
+    bamfile.close()
+
+    # reads that are unmapped, but placed with their mate, are exported with
+    # the reference, so the references are always needed
+    if unmapped:
+        jobs.append(-1)
+
+    tmpdir = tempfile.mkdtemp(prefix='.ngsutils_export')
+    _export_state = (fname, mapped, unmapped, whitelist, blacklist, fields, tmpdir, npz is not None)
+
+    if not quiet:
+        eta = ETA(len(jobs))
+    else:
+        eta = None
+
+    if npz:
+        writer = ColumnWriter(fields)
+
+    pool = multiprocessing.Pool(procs)
+    try:
+        for i, tmpname in enumerate(pool.imap(_export_ref, jobs, 1)):
+            if eta:
+                eta.print_status(i)
+
+            if npz:
+                arrays = numpy.load(tmpname)
+                writer.extend(arrays)
+                arrays.close()
+            else:
+                with open(tmpname) as f:
+                    shutil.copyfileobj(f, out)
+            os.unlink(tmpname)
+
+        pool.close()
+    except IOError:
+        pass
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(tmpdir, True)
+        _export_state = None
+
+    if eta:
+        eta.done()
+
+    if npz:
+        writer.save(npz)
+
+
+_export_state = None
+
+
+def _export_ref(tid):
+    'Worker process: exports the reads for one reference (or the unplaced reads if tid is -1)'
+    fname, mapped, unmapped, whitelist, blacklist, fields, tmpdir, columns = _export_state
+
+    bamfile = bam_open(fname)
+    if tid >= 0:
+        reads = bamfile.fetch(bamfile.references[tid], 0, bamfile.lengths[tid])
+    else:
+        reads = bam_unmapped_iter(bamfile)
+
+    if columns:
+        tmpname = os.path.join(tmpdir, 'ref%s.npz' % tid)
+        writer = ColumnWriter(fields)
+        _export_reads(bamfile, reads, fields, mapped, unmapped, whitelist, blacklist, writer)
+        writer.save(tmpname)
+    else:
+        tmpname = os.path.join(tmpdir, 'ref%s.txt' % tid)
+        with open(tmpname, 'w') as out:
+            writer = TextWriter(out, fields)
+            _export_reads(bamfile, reads, fields, mapped, unmapped, whitelist, blacklist, writer)
+            writer.close()
+
+    bamfile.close()
+    return tmpname
+
+
+class TextWriter(object):
+    '''
+    Writes the values for each read as a tab-delimited line. Missing values
+    (None) are written as empty columns. The list of tags from -tag:* is
+    written as one column per tag. Lines are written in batches.
+    '''
+    def __init__(self, out, fields):
+        self.out = out
+        self._lines = []
+        self._splice = '-tag:*' in fields
+
+    def add(self, vals):
+        if self._splice:
+            cols = []
+            for x in vals:
+                if type(x) == list:
+                    cols.extend(x)
+                else:
+                    cols.append('' if x is None else str(x))
+        else:
+            cols = ['' if x is None else str(x) for x in vals]
+
+        self._lines.append('\t'.join(cols))
+        if len(self._lines) >= _BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            self._lines.append('')
+            self.out.write('\n'.join(self._lines))
+            self._lines = []
+
+    def close(self):
+        self.flush()
+
+
+class ColumnWriter(object):
+    '''
+    Collects the values for each field as a column, and saves them as arrays
+    in a NumPy .npz file. The arrays are named after the fields (-pos is
+    "pos", -tag:AS is "tag_AS").
+    '''
+    def __init__(self, fields):
+        for field in fields:
+            if field == '-tag:*':
+                raise ValueError("-tag:* can't be exported to columns (use -tag:tag_name)")
+
+        self.names = [field_column_name(x) for x in fields]
+        self.dtypes = [numpy.int64 if x in _INT_FIELDS else str for x in fields]
+        self._columns = [[] for x in fields]
+        self._chunks = [[] for x in fields]
+
+    def add(self, vals):
+        for column, val in zip(self._columns, vals):
+            column.append(val)
+
+        if len(self._columns[0]) >= _BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        for column, chunks, dtype in zip(self._columns, self._chunks, self.dtypes):
+            if column:
+                if dtype is str:
+                    column[:] = ['' if x is None else x for x in column]
+                chunks.append(numpy.array(column, dtype=dtype))
+                del column[:]
+
+    def extend(self, arrays):
+        'Adds the columns from another set of arrays (a loaded .npz file)'
+        self.flush()
+        for name, chunks in zip(self.names, self._chunks):
+            chunks.append(arrays[name])
+
+    def close(self):
+        self.flush()
+
+    def arrays(self):
+        self.flush()
+        out = {}
+        for name, chunks, dtype in zip(self.names, self._chunks, self.dtypes):
+            if chunks:
+                out[name] = numpy.concatenate(chunks)
+            else:
+                out[name] = numpy.array([], dtype=dtype)
+        return out
+
+    def save(self, fname):
+        numpy.savez(fname, **self.arrays())
+
+
+def field_column_name(field):
+    '''
+    The name of the column for a field
+
+    >>> field_column_name('-pos')
+    'pos'
+    >>> field_column_name('-tag:AS')
+    'tag_AS'
+    '''
+    return field[1:].replace(':', '_')
+
+
+def compile_fields(bamfile, fields):
+    '''
+    Converts a list of fields (-name, -pos, -tag:AS, etc) into a tuple of
+    functions that each return the value of one field for a read.
+    '''
+    if bamfile:
+        refs = list(bamfile.references)
+    else:
+        refs = None
+
+    def _ref(tid):
+        if tid == -1:
+            return '*'
+        elif refs:
+            return refs[tid]
+        return '?'
+
+    extractors = []
     for field in fields:
         if field == '-name':
-            cols.append(read.qname)
+            func = operator.attrgetter('qname')
         elif field == '-ref':
-            if read.tid == -1:
-                cols.append('*')
-            elif bamfile:
-                cols.append(bamfile.getrname(read.tid))
-            else:
-                cols.append('?')
+            func = lambda read: _ref(read.tid)
         elif field == '-pos':
-            cols.append(read.pos + 1)  # output 1-based
+            func = lambda read: read.pos + 1  # output 1-based
         elif field == '-strand':
-            cols.append('-' if read.is_reverse else '+')
+            func = lambda read: '-' if read.is_reverse else '+'
         elif field == '-cigar':
-            if read.cigar:
-                cols.append(cigar_tostr(read.cigar))
-            else:
-                cols.append('*')
+            func = lambda read: cigar_tostr(read.cigar) if read.cigar else '*'
         elif field == '-flags':
-            cols.append(read.flag)
+            func = operator.attrgetter('flag')
         elif field == '-seq':
-            cols.append(read.seq)
+            func = operator.attrgetter('seq')
         elif field == '-qual':
-            cols.append(read.qual)
+            func = operator.attrgetter('qual')
         elif field == '-mapq':
-            cols.append(read.mapq)
+            func = operator.attrgetter('mapq')
         elif field == '-nextref':
-            if read.rnext == -1:
-                cols.append('*')
-            elif bamfile:
-                cols.append(bamfile.getrname(read.rnext))
-            else:
-                cols.append('?')
+            func = lambda read: _ref(read.rnext)
         elif field == '-nextpos':
-            if read.rnext == -1:
-                cols.append(0)
-            else:
-                cols.append(read.pnext + 1)  # output 1-based
+            func = lambda read: read.pnext + 1 if read.rnext != -1 else 0  # output 1-based
         elif field == '-tlen':
-            cols.append(read.tlen)
+            func = operator.attrgetter('tlen')
         elif field == '-isize':
-            cols.append(read.isize)
+            func = operator.attrgetter('isize')
+        elif field == '-tag:*':
+            func = _all_tags
         elif field[:5] == '-tag:':
-            if field[5:] == '*':
-                for tag, val in read.tags:
-                    if type(val) == int:
-                        cols.append('%s:i:%s' % (tag, val))
-                    elif type(val) == float:
-                        cols.append('%s:f:%s' % (tag, val))
-                    elif len(val) == 1:
-                        cols.append('%s:A:%s' % (tag, val))
-                    else:
-                        cols.append('%s:Z:%s' % (tag, val))
-            else:
-                try:
-                    cols.append(read.opt(field[5:]))
-                except KeyError:
-                    cols.append('')
+            func = _tag_value(field[5:])
+        else:
+            raise ValueError('Unknown field: %s' % field)
+
+        extractors.append(func)
+
+    return tuple(extractors)
+
+
+def _tag_value(tag):
+    def func(read):
+        try:
+            return read.opt(tag)
+        except KeyError:
+            return ''
+    return func
+
+
+def _all_tags(read):
+    'The list of tags for a read in SAM format (one column per tag)'
+    cols = []
+    for tag, val in read.tags:
+        code = _TAG_TYPES.get(type(val))
+        if not code:
+            code = 'A' if len(val) == 1 else 'Z'
+        cols.append('%s:%s:%s' % (tag, code, val))
+
+    return cols
+
 
-    out.write('%s\n' % '\t'.join([str(x) for x in cols]))
+def export_read(bamfile, read, fields, out=sys.stdout):
+    writer = TextWriter(out, fields)
+    writer.add([func(read) for func in compile_fields(bamfile, fields)])
+    writer.close()
 
 
 def usage():
@@ -107,6 +375,15 @@ Options:
   -whitelist file.txt  Output only reads that are listed in a text file
   -blacklist file.txt  Output only reads that are not listed in a text file
 
+  -npz out.npz         Write the fields as columns (arrays) to a NumPy .npz
+                       file instead of as text. The arrays are named after
+                       the fields (-pos is "pos", -tag:AS is "tag_AS").
+                       (-tag:* can't be used)
+
+  -p num               Export the references using {num} processes. Each
+                       reference is read from the BAM index by its own
+                       process. (The BAM file must be sorted and indexed.)
+
 Fields:
   -name          Read name
   -ref           Mapped reference (chrom)
@@ -139,6 +416,8 @@ if __name__ == "__main__":
     bl = None
     last = None
     fields = []
+    procs = 1
+    npz = None
 
     for arg in sys.argv[1:]:
         if last == '-whitelist':
@@ -155,7 +434,13 @@ if __name__ == "__main__":
             with open(arg) as f:
                 bl = [x.strip() for x in f]
             last = None
-        elif arg in ['-blacklist', '-whitelist']:
+        elif last == '-p':
+            procs = positive_int_arg('-p', arg, usage)
+            last = None
+        elif last == '-npz':
+            npz = arg
+            last = None
+        elif arg in ['-blacklist', '-whitelist', '-p', '-npz']:
             last = arg
         elif arg == '-h':
             usage()
@@ -178,6 +463,16 @@ if __name__ == "__main__":
         unmapped = True
         mapped = True
 
+    try:
+        compile_fields(None, fields)
+    except ValueError, e:
+        print "Error: %s" % e
+        usage()
+
     bamfile = bam_open(fname)
-    bam_export(bamfile, mapped, unmapped, wl, bl, fields)
+    try:
+        bam_export(bamfile, mapped, unmapped, wl, bl, fields, procs=procs, npz=npz)
+    except ValueError, e:
+        print "Error: %s" % e
+        usage()
     bamfile.close()
@@ -11,7 +11,10 @@ for peak-finding in ChIP-seq experiments.
 '''
 import sys
 import os
-from ngsutils.bam import bam_pileup_iter, bam_open
+import heapq
+from ngsutils.bam import bam_iter, bam_open
+import ngsutils.bam.parallel
+from ngsutils.support import positive_int_arg
 
 import pysam
 
@@ -21,7 +24,8 @@ class ExpressedRegion(object):
 
     def __init__(self, chrom, only_uniq_starts=False):
         ExpressedRegion._count += 1
-        self.name = 'region_%s' % ExpressedRegion._count
+        self.num = ExpressedRegion._count
+        self.name = 'region_%s' % self.num
 
         self.chrom = chrom
         self.start = None
@@ -29,92 +33,272 @@ class ExpressedRegion(object):
         self.fwd_count = 0
         self.rev_count = 0
 
-        self.reads = set()
         self.read_count = 0
 
         self.only_uniq_starts = only_uniq_starts
         self.uniq_starts = set()
 
-    def add_column(self, read, pos):
-        if not self.start:
-            self.start = pos
-        if not self.end or pos >= self.end:
-            self.end = pos + 1
-
-        if not read.alignment.qname in self.reads:
-            self.reads.add(read.alignment.qname)
-            self.read_count += 1
-
-            if self.only_uniq_starts:
-                if not read.alignment.is_reverse:
-                    if not read.alignment.pos in self.uniq_starts:
-                        self.uniq_starts.add(read.alignment.pos)
-                        self.fwd_count += 1
-                else:
-                    if not read.alignment.aend in self.uniq_starts:
-                        self.uniq_starts.add(read.alignment.aend)
-                        self.rev_count += 1
+    def add_block(self, start, end):
+        'Adds an aligned block (start, end) of a read to the region'
+        if self.start is None:
+            self.start = start
+        if self.end is None or end > self.end:
+            self.end = end
 
+    def add_read(self, read):
+        'Counts a read (call this only once for each read in the region)'
+        self.read_count += 1
+
+        if self.only_uniq_starts:
+            if not read.is_reverse:
+                if not read.pos in self.uniq_starts:
+                    self.uniq_starts.add(read.pos)
+                    self.fwd_count += 1
             else:
-                if read.alignment.is_reverse:
+                if not read.aend in self.uniq_starts:
+                    self.uniq_starts.add(read.aend)
                     self.rev_count += 1
-                else:
-                    self.fwd_count += 1
 
-    def write(self, fs):
-        cols = []
-        cols.append(self.chrom)
-        cols.append(str(self.start))
-        cols.append(str(self.end))
-        cols.append(self.name)
+        else:
+            if read.is_reverse:
+                self.rev_count += 1
+            else:
+                self.fwd_count += 1
+
+    def summary(self):
+        'Returns chrom, start, end, count, strand'
         if self.only_uniq_starts:
-            cols.append(str(len(self.uniq_starts)))
+            count = len(self.uniq_starts)
         else:
-            cols.append(str(self.read_count))
+            count = self.read_count
 
         if self.fwd_count > self.rev_count:
-            cols.append('+')
+            strand = '+'
         else:
-            cols.append('-')
+            strand = '-'
 
-        fs.write('\t'.join(cols))
-        fs.write('\n')
+        return (self.chrom, self.start, self.end, count, strand)
 
+    def write(self, fs):
+        _write_region(fs, self.name, self.summary())
+
+
+def _write_region(fs, name, summary):
+    chrom, start, end, count, strand = summary
+    fs.write('\t'.join([chrom, str(start), str(end), name, str(count), strand]))
+    fs.write('\n')
 
-def bam_find_regions(bam_name, merge_distance=10, min_read_count=2, only_uniq_starts=False, nostrand=False, out=sys.stdout):
-    bamfile = bam_open(bam_name)
-    region_plus = None
-    region_minus = None
-
-    for pileup in bam_pileup_iter(bamfile, mask=1540):
-        chrom = bamfile.getrname(pileup.tid)
-
-        for read in pileup.pileups:
-            if read.is_del:
-                continue
-            if nostrand or not read.alignment.is_reverse:
-                if not region_plus or region_plus.chrom != chrom or (region_plus.end + merge_distance) < pileup.pos:
-                    if region_plus and region_plus.read_count >= min_read_count:
-                        region_plus.write(out)
-
-                    region_plus = ExpressedRegion(chrom, only_uniq_starts)
-                region_plus.add_column(read, pileup.pos)
-            else:
-                if not region_minus or region_minus.chrom != chrom or (region_minus.end + merge_distance) < pileup.pos:
-                    if region_minus and region_minus.read_count >= min_read_count:
-                        region_minus.write(out)
 
-                    region_minus = ExpressedRegion(chrom, only_uniq_starts)
-                region_minus.add_column(read, pileup.pos)
+def bam_find_regions(bam_name, merge_distance=10, min_read_count=2, only_uniq_starts=False, nostrand=False, out=sys.stdout, procs=1):
+    bamfile = bam_open(bam_name)
 
-    if region_plus and region_plus.read_count >= min_read_count:
-        region_plus.write(out)
-    if region_minus and region_minus.read_count >= min_read_count:
-        region_minus.write(out)
+    if procs > 1:
+        _find_regions_parallel(bamfile, merge_distance, min_read_count, only_uniq_starts, nostrand, out, procs)
+    else:
+        for strand, region, nextregion in _find_regions(bamfile, _aligned_blocks(bam_iter(bamfile)), merge_distance, only_uniq_starts, nostrand):
+            if region.read_count >= min_read_count:
+                region.write(out)
 
     bamfile.close()
 
 
+def _aligned_blocks(reads):
+    '''
+    Yields (tid, start, end, read, counted) for each aligned block (M, =, X) of
+    the reads, ordered by position. The reads must be sorted. Blocks are
+    separated by deletions and gaps (N), so the blocks of a spliced read can
+    be yielded after the blocks of reads that start after it. counted is a
+    list that is shared by all of the blocks of a read.
+
+    Unmapped, QC failed and duplicate reads are skipped (like a pileup with
+    mask=1540).
+    '''
+    heap = []
+    tid = None
+
+    for num, read in enumerate(reads):
+        if read.is_unmapped or read.flag & 1540:
+            continue
+
+        if read.tid != tid:
+            while heap:
+                start, n, end, r, counted = heapq.heappop(heap)
+                yield (tid, start, end, r, counted)
+            tid = read.tid
+
+        counted = [None]
+        pos = read.pos
+        for op, length in read.cigar:
+            if op in [0, 7, 8]:
+                heapq.heappush(heap, (pos, num, pos + length, read, counted))
+            if op in [0, 2, 3, 7, 8]:
+                pos += length
+
+        # no more blocks can start before this read
+        while heap and heap[0][0] <= read.pos:
+            start, n, end, r, counted = heapq.heappop(heap)
+            yield (tid, start, end, r, counted)
+
+    while heap:
+        start, n, end, r, counted = heapq.heappop(heap)
+        yield (tid, start, end, r, counted)
+
+
+def _find_regions(bamfile, blocks, merge_distance=10, only_uniq_starts=False, nostrand=False):
+    '''
+    Yields (strand, region, nextregion) for each region in the order that they
+    are finished. A region is finished when the next region on the same strand
+    (nextregion) is started. Regions that are still open at the end are
+    yielded last (plus strand first), with a nextregion of None.
+
+    The regions are built from the aligned blocks of the reads (see
+    _aligned_blocks). Each read is counted once in each region that one of
+    its blocks is in.
+    '''
+    regions = {'+': None, '-': None}
+    tid = None
+    chrom = None
+
+    for block_tid, start, end, read, counted in blocks:
+        if block_tid != tid:
+            tid = block_tid
+            chrom = bamfile.getrname(tid)
+
+        if nostrand or not read.is_reverse:
+            strand = '+'
+        else:
+            strand = '-'
+
+        region = regions[strand]
+        if not region or region.chrom != chrom or (region.end + merge_distance) < start:
+            last = region
+            region = ExpressedRegion(chrom, only_uniq_starts)
+            regions[strand] = region
+            if last:
+                yield (strand, last, region)
+
+        region.add_block(start, end)
+        if counted[0] is not region:
+            counted[0] = region
+            region.add_read(read)
+
+    if regions['+']:
+        yield ('+', regions['+'], None)
+    if regions['-']:
+        yield ('-', regions['-'], None)
+
+
+def _find_regions_parallel(bamfile, merge_distance, min_read_count, only_uniq_starts, nostrand, out, procs):
+    '''
+    Finds the regions using a pool of worker processes (see ngsutils.bam.parallel).
+
+    The edges of each shard are moved to the next gap in coverage that is
+    wider than merge_distance, so that a region never spans two shards.
+    Regions are numbered in the order they are started and are written in the
+    order they are finished, so the output is the same as for one process.
+    For each shard, a worker returns the regions it finished (keyed by the
+    number of the region that finished it), followed by the number of regions
+    it started, the first region started on each strand, and the regions that
+    were still open at the end of the shard.
+    '''
+    shards = ngsutils.bam.parallel.genome_shards(bamfile)
+    vals = ngsutils.bam.parallel.shard_map(bamfile, _expressed_shard, shards, procs, (merge_distance, min_read_count, only_uniq_starts, nostrand))
+
+    offset = ExpressedRegion._count
+    pending = {}
+    finished = []
+
+    for val in vals:
+        if val[0] is not None:
+            key, num, summary = val
+            finished.append((key, offset + num, summary))
+            continue
+
+        # end of a shard
+        created, first, shard_open = val[1:]
+
+        # regions left open by an earlier shard are finished by the first
+        # region on the same strand in this shard
+        for strand in first:
+            if strand in pending:
+                num, summary = pending.pop(strand)
+                finished.append((first[strand], num, summary))
+
+        finished.sort()
+        for key, num, summary in finished:
+            _write_region(out, 'region_%s' % num, summary)
+        finished = []
+
+        for strand in shard_open:
+            num, summary = shard_open[strand]
+            pending[strand] = (offset + num, summary)
+
+        offset += created
+
+    for strand in '+-':
+        if strand in pending:
+            num, summary = pending[strand]
+            _write_region(out, 'region_%s' % num, summary)
+
+    ExpressedRegion._count = offset
+
+
+def _expressed_shard(bamfile, shard, merge_distance, min_read_count, only_uniq_starts, nostrand):
+    'Worker: the regions for one shard of the genome (see _find_regions_parallel)'
+    start = shard.start
+    end = shard.end
+    chrom_len = bamfile.lengths[bamfile.references.index(shard.chrom)]
+
+    if start > 0:
+        start = _next_gap(bamfile, shard.chrom, start, chrom_len, merge_distance)
+    if end < chrom_len:
+        end = _next_gap(bamfile, shard.chrom, end, chrom_len, merge_distance)
+
+    blocks = []
+    if start < end:
+        blocks = (x for x in _aligned_blocks(bamfile.fetch(shard.chrom, start, end)) if start <= x[1] < end)
+
+    base = ExpressedRegion._count
+    first = {}
+    shard_open = {}
+
+    for strand, region, nextregion in _find_regions(bamfile, blocks, merge_distance, only_uniq_starts, nostrand):
+        num = region.num - base
+        if not strand in first or num < first[strand]:
+            first[strand] = num
+
+        if region.read_count < min_read_count:
+            continue
+
+        if nextregion:
+            yield (nextregion.num - base, num, region.summary())
+        else:
+            shard_open[strand] = (num, region.summary())
+
+    yield (None, ExpressedRegion._count - base, first, shard_open)
+
+
+def _next_gap(bamfile, chrom, pos, chrom_len, merge_distance):
+    '''
+    Returns the first position (at or after pos) that starts a new region,
+    because it is more than merge_distance away from the previous covered
+    position (also at or after pos). If there isn't one, the length of the
+    chromosome is returned.
+    '''
+    last = None
+    for tid, start, end, read, counted in _aligned_blocks(bamfile.fetch(chrom, pos, chrom_len)):
+        if end <= pos:
+            continue
+        start = max(start, pos)
+
+        if last is not None and last + merge_distance < start:
+            return start
+        if last is None or end > last:
+            last = end
+
+    return chrom_len
+
+
 def usage():
     print __doc__
     print """\
@@ -133,6 +317,9 @@ Options:
 
 -mincount N     The minimum number of reads required in a region
                 (default: 2)
+
+-p N            Use N processes (the genome is split into shards that are
+                processed in parallel) (default: 1)
 """
     sys.exit(1)
 
@@ -143,6 +330,7 @@ if __name__ == "__main__":
     fname = None
     last = None
     nostrand = False
+    procs = 1
 
     for arg in sys.argv[1:]:
         if last == '-dist':
@@ -151,13 +339,16 @@ if __name__ == "__main__":
         elif last == '-mincount':
             mincount = int(arg)
             last = None
+        elif last == '-p':
+            procs = positive_int_arg('-p', arg, usage)
+            last = None
         elif arg == '-h':
             usage()
         elif arg == '-uniq':
             uniq = True
         elif arg == '-ns':
             nostrand = True
-        elif arg in ['-dist', '-mincount']:
+        elif arg in ['-dist', '-mincount', '-p']:
             last = arg
         elif not fname and os.path.exists(arg):
             fname = arg
@@ -167,4 +358,4 @@ if __name__ == "__main__":
     if not fname:
         usage()
 
-    bam_find_regions(fname, dist, mincount, uniq, nostrand)
+    bam_find_regions(fname, dist, mincount, uniq, nostrand, procs=procs)
@@ -102,28 +102,52 @@ Common tags to filter by:
 
 import os
 import sys
+import time
 import pysam
 from ngsutils.bam import bam_iter
-from ngsutils.support.dbsnp import DBSNP
+from ngsutils.support.dbsnp import DBSNP, DEFAULT_WINDOW
 from ngsutils.bam import read_calc_mismatches, read_calc_mismatches_ref, read_calc_mismatches_gen, read_calc_variations
 from ngsutils.bed import BedFile
+from ngsutils.support.intervals import IntervalIndex
+from ngsutils.support.reference import open_reference
+from ngsutils.support import metrics
+from ngsutils.support.metrics import Progress
+
+DEFAULT_SAMPLE_SIZE = 1000
 
 
 def usage():
     print __doc__
     print """
-Usage: bamutils filter in.bam out.bam {-failed out.txt} criteria...
+Usage: bamutils filter in.bam out.bam {-failed out.txt} {-stats out.txt} criteria...
 
 Options:
   -failed fname    A text file containing the read names of all reads
                    that were removed with filtering
 
+  -stats fname     Write the number of reads checked and rejected by each
+                   criterion (and the time spent) to a file
+
+  -noreorder       Check the criteria in the order given. By default, after
+                   the first %s reads, the criteria are reordered so that
+                   the ones that reject the most reads for the least time
+                   are checked first. (Reads may then be listed in the
+                   -failed file with a different criterion.) -uniq and
+                   -uniq_start are never moved, and the other criteria are
+                   never moved past them.
+
+  -noindex         Always scan the entire BAM file. By default, if there is
+                   an -include or -includebed criterion and the BAM file is
+                   indexed, only the reads in those regions are read from
+                   the file. (The reads outside of the regions are counted
+                   as failed, but aren't written to the -failed file.)
+
 Example:
 bamutils filter filename.bam output.bam -mapped -gte AS:i 1000
 
 This will remove all unmapped reads, as well as any reads that have an AS:i
 value less than 1000.
-"""
+""" % DEFAULT_SAMPLE_SIZE
     sys.exit(1)
 
 
@@ -255,25 +279,27 @@ class Whitelist(object):
 
 
 class IncludeRegion(object):
+    # all of the -include regions are checked together (a read can be in any
+    # of them)
     _excludes = []
-    _last = None
+    _index = None
 
     def __init__(self, region):
-        IncludeRegion._excludes.append(ExcludeRegion(region))
-        # self.excl = ExcludeRegion(region)
+        self.excl = ExcludeRegion(region)
+        IncludeRegion._excludes.append(self.excl)
+        IncludeRegion._index = None
 
     def filter(self, bam, read):
-        if read == IncludeRegion._last:
-            return True
+        if read.is_unmapped:
+            return False
 
-        IncludeRegion._last = read
+        if IncludeRegion._index is None:
+            IncludeRegion._index = IntervalIndex(bam.references)
+            for excl in IncludeRegion._excludes:
+                IncludeRegion._index.add(excl.chrom, excl.start, excl.end)
 
-        for excl in IncludeRegion._excludes:
-            if not excl.filter(bam, read):
-                return True
-        return False
+        return IncludeRegion._index.overlaps(read.tid, read.pos, read.aend)
 
-        # return not self.excl.filter(bam,read)
     def __repr__(self):
         return 'Including: %s' % (self.excl.region)
 
@@ -303,14 +329,16 @@ class ExcludeRegion(object):
         se = [int(x) for x in spl[1].split('-')]
         self.start = se[0] - 1
         self.end = se[1]
+        self.index = None
 
     def filter(self, bam, read):
         if not read.is_unmapped:
-            if bam.getrname(read.tid) == self.chrom:
-                if self.start <= read.pos <= self.end:
-                    return False
-                if self.start <= read.aend <= self.end:
-                    return False
+            if self.index is None:
+                self.index = IntervalIndex(bam.references)
+                self.index.add(self.chrom, self.start, self.end)
+
+            if self.index.overlaps(read.tid, read.pos, read.aend):
+                return False
         return True
 
     def __repr__(self):
@@ -347,6 +375,7 @@ class ExcludeBED(object):
             self.nostrand = False
 
         self.bed = BedFile(fname)
+        self.index = None
         # with open(fname) as f:
         #     for line in f:
         #         if not line:
@@ -373,6 +402,11 @@ class ExcludeBED(object):
 
     def filter(self, bam, read):
         if not read.is_unmapped:
+            if self.index is None:
+                self.index = IntervalIndex(bam.references)
+                for region in self.bed:
+                    self.index.add(region.chrom, region.start, region.end, region.strand)
+
             if self.nostrand:
                 strand = None
             elif read.is_reverse:
@@ -380,10 +414,10 @@ class ExcludeBED(object):
             else:
                 strand = '+'
 
-            for region in self.bed.fetch(bam.getrname(read.tid), read.pos, read.aend, strand):
+            if self.index.overlaps(read.tid, read.pos, read.aend, strand):
                 # region found, exclude read
                 return False
-            return True
+        return True
 
         #     bin = read.pos / 100000
         #     ref = bam.getrname(read.tid)
@@ -435,10 +469,7 @@ class MismatchRef(object):
         self.num = int(num)
         self.refname = refname
 
-        if not os.path.exists('%s.fai' % refname):
-            pysam.faidx(refname)
-
-        self.ref = pysam.Fastafile(refname)
+        self.ref = open_reference(refname)
 
     def filter(self, bam, read):
         if read.is_unmapped:
@@ -463,7 +494,7 @@ class MismatchDbSNP(object):
 
         self.num = int(num)
         self.fname = fname
-        self.dbsnp = DBSNP(fname)
+        self.dbsnp = DBSNP(fname, window=DEFAULT_WINDOW)
         if verbose == 'verbose':
             self.verbose = True
         else:
@@ -507,12 +538,10 @@ class MismatchRefDbSNP(object):
         sys.stderr.write('Note: MismatchRefDbSNP is considered *experimental*\n')
         self.num = int(num)
         self.refname = refname
-        self.dbsnp = DBSNP(dbsnpname)
-
-        if not os.path.exists('%s.fai' % refname):
-            pysam.faidx(refname)
+        self.dbsnpname = dbsnpname
+        self.dbsnp = DBSNP(dbsnpname, window=DEFAULT_WINDOW)
 
-        self.ref = pysam.Fastafile(refname)
+        self.ref = open_reference(refname)
 
     def filter(self, bam, read):
         if read.is_unmapped:
@@ -762,7 +791,183 @@ _criteria = {
 }
 
 
-def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False):
+class FilterChain(object):
+    '''
+    Checks reads against a list of criteria.
+
+    For the first sample_size reads, every criterion is checked and timed.
+    The criteria are then sorted by the time spent per read rejected, so
+    that cheap criteria that reject many reads are checked first.
+
+    Unique and UniqueStart keep track of the reads that they have seen, so
+    they must see the same reads as they would with the criteria in the
+    original order. The criteria are only reordered between them.
+    '''
+    def __init__(self, criteria, sample_size=DEFAULT_SAMPLE_SIZE, reorder=True, timed=False):
+        self.criteria = criteria
+        self.sample_size = sample_size if reorder else 0
+        self.timed = timed
+
+        self.reads = 0
+        self.evaluations = [0] * len(criteria)
+        self.rejections = [0] * len(criteria)
+        self.times = [0.0] * len(criteria)
+
+        self.segments = []
+        segment = []
+        for i, criterion in enumerate(criteria):
+            if isinstance(criterion, Unique) or isinstance(criterion, UniqueStart):
+                if segment:
+                    self.segments.append(segment)
+                self.segments.append([i])
+                segment = []
+            else:
+                segment.append(i)
+
+        if segment:
+            self.segments.append(segment)
+
+    @property
+    def order(self):
+        'The indexes of the criteria in the order they are checked'
+        return [i for segment in self.segments for i in segment]
+
+    def filter(self, bam, read):
+        '''
+        Returns the index of the criterion that rejected the read, or None if
+        the read passed all of them.
+        '''
+        self.reads += 1
+        if self.reads <= self.sample_size:
+            failed = self._sample(bam, read)
+            if self.reads == self.sample_size:
+                self._reorder()
+            return failed
+
+        if self.timed:
+            for i in self.order:
+                self.evaluations[i] += 1
+                start = time.time()
+                passed = self.criteria[i].filter(bam, read)
+                self.times[i] += time.time() - start
+                if not passed:
+                    self.rejections[i] += 1
+                    return i
+            return None
+
+        for i in self.order:
+            self.evaluations[i] += 1
+            if not self.criteria[i].filter(bam, read):
+                self.rejections[i] += 1
+                return i
+        return None
+
+    def _sample(self, bam, read):
+        # every criterion in a segment is checked, so the rejection rates
+        # don't depend on the current order
+        for segment in self.segments:
+            failed = None
+            for i in segment:
+                self.evaluations[i] += 1
+                start = time.time()
+                passed = self.criteria[i].filter(bam, read)
+                self.times[i] += time.time() - start
+
+                if not passed:
+                    self.rejections[i] += 1
+                    if failed is None:
+                        failed = i
+
+            if failed is not None:
+                return failed
+        return None
+
+    def _reorder(self):
+        def cost(i):
+            if not self.rejections[i]:
+                return float('inf')
+            return self.times[i] / self.rejections[i]
+
+        for segment in self.segments:
+            segment.sort(key=cost)
+
+    def write_stats(self, out):
+        order = self.order
+        out.write('Criteria\tOrder\tEvaluations\tRejections\tSeconds\n')
+        for i, criterion in enumerate(self.criteria):
+            out.write('%s\t%s\t%s\t%s\t%.3f\n' % (criterion, order.index(i) + 1, self.evaluations[i], self.rejections[i], self.times[i]))
+
+
+def _region_plan(bam, criteria):
+    '''
+    If the criteria include reads only from a set of regions (-include or
+    -includebed), returns the (tid, start, end) intervals of the BAM file
+    that contain all of the reads that could pass. The intervals are merged
+    and sorted. Otherwise, returns None.
+
+    Unique / UniqueStart need to see every read, so if they are checked
+    before the regions, there is no plan.
+    '''
+    intervals = None
+    for criterion in criteria:
+        if isinstance(criterion, Unique) or isinstance(criterion, UniqueStart):
+            return None
+        if isinstance(criterion, IncludeRegion):
+            intervals = [(excl.chrom, excl.start, excl.end) for excl in IncludeRegion._excludes]
+            break
+        if isinstance(criterion, IncludeBED):
+            intervals = [(region.chrom, region.start, region.end) for region in criterion.excl.bed]
+            break
+
+    if intervals is None:
+        return None
+
+    excluded_refs = set([criterion.ref for criterion in criteria if isinstance(criterion, ExcludeRef)])
+    tids = dict([(ref, tid) for tid, ref in enumerate(bam.references)])
+
+    # the region criteria include the end points (a read that starts at the
+    # end of a region, or ends at the start), so the intervals are padded
+    # by one base
+    padded = []
+    for chrom, start, end in intervals:
+        if chrom in tids and not chrom in excluded_refs:
+            padded.append((tids[chrom], max(0, start - 1), end + 1))
+
+    plan = []
+    for tid, start, end in sorted(padded):
+        if plan and plan[-1][0] == tid and start <= plan[-1][2]:
+            plan[-1] = (tid, plan[-1][1], max(end, plan[-1][2]))
+        else:
+            plan.append((tid, start, end))
+
+    return plan
+
+
+def _fetch_plan(bam, plan, quiet=False, callback=None):
+    '''
+    Yields the reads from each interval in the plan (in order). Reads that
+    span more than one interval are only returned once.
+    '''
+    progress = Progress(len(plan), extra=callback, stage='bam', quiet=quiet)
+
+    for i, (tid, start, end) in enumerate(plan):
+        if i > 0 and plan[i - 1][0] == tid:
+            last_end = plan[i - 1][2]
+        else:
+            last_end = None
+
+        for read in bam.fetch(bam.references[tid], start, end):
+            if last_end is not None and read.pos < last_end:
+                # this read was also in the last interval
+                continue
+
+            progress.update(read, i)
+            yield read
+
+    progress.done()
+
+
+def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False, use_index=True, reorder=True, stats_fname=None):
     if verbose:
         sys.stderr.write('Input file  : %s\n' % infile)
         sys.stderr.write('Output file : %s\n' % outfile)
@@ -784,24 +989,40 @@ def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False):
 
     passed = 0
     failed = 0
+    criteria_failed = [0] * len(criteria)
 
     def _callback(read):
         return "%s | %s kept,%s failed" % ('%s:%s' % (bamfile.getrname(read.tid), read.pos) if read.tid > -1 else 'unk', passed, failed)
 
-    for read in bam_iter(bamfile):
-        p = True
+    plan = None
+    if use_index and os.path.exists('%s.bai' % infile):
+        plan = _region_plan(bamfile, criteria)
 
-        for criterion in criteria:
-            if not criterion.filter(bamfile, read):
-                p = False
-                failed += 1
-                if failed_out:
-                    failed_out.write('%s\t%s\n' % (read.qname, criterion))
-                #outfile.write(read_to_unmapped(read))
-                break
-        if p:
+    if plan is not None:
+        if verbose:
+            sys.stderr.write('Reading %s region(s) from the index\n\n' % len(plan))
+        reads = _fetch_plan(bamfile, plan, callback=_callback)
+    else:
+        reads = bam_iter(bamfile)
+
+    chain = FilterChain(criteria, reorder=reorder, timed=stats_fname is not None)
+
+    for read in reads:
+        i = chain.filter(bamfile, read)
+
+        if i is None:
             passed += 1
             outfile.write(read)
+        else:
+            failed += 1
+            criteria_failed[i] += 1
+            if failed_out:
+                failed_out.write('%s\t%s\n' % (read.qname, criteria[i]))
+            #outfile.write(read_to_unmapped(read))
+
+    if plan is not None:
+        # the reads that weren't read from the file all failed
+        failed = bamfile.mapped + bamfile.unmapped - passed
 
     bamfile.close()
     outfile.close()
@@ -809,6 +1030,20 @@ def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False):
         failed_out.close()
     sys.stdout.write("%s kept\n%s failed\n" % (passed, failed))
 
+    if verbose:
+        sys.stderr.write('Criteria order:\n')
+        for i in chain.order:
+            sys.stderr.write('    %s\n' % criteria[i])
+
+    if stats_fname:
+        with open(stats_fname, 'w') as f:
+            chain.write_stats(f)
+
+    metrics.count('filter', 'kept', passed)
+    metrics.count('filter', 'failed', failed)
+    for criterion, count in zip(criteria, criteria_failed):
+        metrics.count('filter', 'failed: %s' % criterion, count)
+
     for criterion in criteria:
         criterion.close()
 
@@ -841,18 +1076,28 @@ if __name__ == '__main__':
     crit_args = []
     last = None
     verbose = False
+    use_index = True
+    reorder = True
+    stats_fname = None
     fail = False
 
     for arg in sys.argv[1:]:
         if last == '-failed':
             failed = arg
             last = None
+        elif last == '-stats':
+            stats_fname = arg
+            last = None
         elif arg == '-h':
             usage()
-        elif arg == '-failed':
+        elif arg in ['-failed', '-stats']:
             last = arg
+        elif arg == '-noreorder':
+            reorder = False
         elif arg == '-v':
             verbose = True
+        elif arg == '-noindex':
+            use_index = False
         elif not infile and os.path.exists(arg):
             infile = arg
         elif not outfile:
@@ -885,4 +1130,4 @@ if __name__ == '__main__':
             print "Missing: filtering criteria"
         usage()
     else:
-        bam_filter(infile, outfile, criteria, failed, verbose)
+        bam_filter(infile, outfile, criteria, failed, verbose, use_index, reorder, stats_fname)
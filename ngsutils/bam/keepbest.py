@@ -12,46 +12,25 @@ import os
 import ngsutils.bam
 
 
-def get_read_tag_value(read, tag):
-    if tag == 'MAPQ':
-        return read.mapq
-
-    for name, value in read.tags:
-        if name == tag:
-            return value
-
-    return -1
-
-
-def _output_best(lastreads, outfile):
-    if not lastreads:
-        return
-
-    lastreads.sort()
-
-    best = lastreads[-1][0]
-    for score, read in lastreads[::-1]:
+def _output_best(group, tag, outfile):
+    '''
+    Writes the reads in a ReadGroup with the best (highest) value for the tag.
+    Reads without the tag have a value of -1.
+    '''
+    scores = group.tag_values(tag, -1)
+    best = max(scores)
+
+    for score, read in zip(scores, group):
         if score == best:
             outfile.write(read)
-        else:
-            break
 
 
 def bam_keepbest(fname, outname, tag="AS"):
     bamfile = ngsutils.bam.bam_open(fname)
     outfile = ngsutils.bam.bam_open(outname, "w", template=bamfile)
 
-    lastreads = []
-    for read in ngsutils.bam.bam_iter(bamfile):
-        if lastreads and read.qname == lastreads[0][1].qname:
-            lastreads.append((get_read_tag_value(read, tag), read))
-        else:
-            if lastreads:
-                _output_best(lastreads, outfile)
-
-            lastreads = [(get_read_tag_value(read, tag), read), ]
-
-    _output_best(lastreads, outfile)
+    for group in ngsutils.bam.bam_read_groups(ngsutils.bam.bam_iter(bamfile)):
+        _output_best(group, tag, outfile)
 
     bamfile.close()
     outfile.close()
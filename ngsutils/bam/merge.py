@@ -28,6 +28,9 @@ values.
 import os
 import sys
 import pysam
+from ngsutils.bam import bam_read_groups
+from ngsutils.support import positive_int_arg
+from ngsutils.support.bgzip import BGZipPipe
 
 
 def usage():
@@ -39,98 +42,124 @@ Options
   -tag VAL    Tag to use to determine from which file reads will be taken
               (must be type :i or :f) [default: AS]
   -discard    Discard reads that aren't mapped in any file.
+  -t num      Use {num} threads. Each input file is read in its own thread,
+              and the output is compressed using {num} threads.
+              [default: 1]
 """
     sys.exit(1)
 
 
-def bam_reads_batch(bam):
-    reads = []
-    last = None
-    for read in bam:
-        if last and read.qname != last:
-            yield reads
-            reads = []
-        last = read.qname
-        reads.append(read)
+class _MergeInputs(object):
+    '''
+    The current group of reads for each of the secondary input files. The
+    groups are indexed by read name, so finding the inputs that have a read
+    doesn't require checking every input.
+    '''
+    def __init__(self, bamgens):
+        self.bamgens = bamgens
+        self.groups = [None] * len(bamgens)
+        self.names = {}
+
+        for i in xrange(1, len(bamgens)):
+            self.advance(i)
+
+    def advance(self, i):
+        try:
+            group = self.bamgens[i].next()
+        except StopIteration:
+            self.groups[i] = None
+            return
+
+        self.groups[i] = group
+        if not group.qname in self.names:
+            self.names[group.qname] = [i]
+        else:
+            self.names[group.qname].append(i)
 
-    if reads:
-        yield reads
+    def pop(self, qname):
+        'Returns the indexes of the secondary inputs whose current group is for qname (in order)'
+        return sorted(self.names.pop(qname, []))
 
 
-def bam_merge(fname, infiles, tag='AS', discard=False, quiet=False):
+def bam_merge(fname, infiles, tag='AS', discard=False, quiet=False, threads=1):
     bams = []
-    last_reads = []
     bamgens = []
     counts = []
     unmapped = 0
 
     for infile in infiles:
         bam = pysam.Samfile(infile, "rb")
-        last_reads.append(None)
         bams.append(bam)
         counts.append(0)
-        bamgens.append(bam_reads_batch(bam))
-
-    outfile = pysam.Samfile('%s.tmp' % fname, "wb", template=bams[0])
-
-    while True:
-        found = False
-        for i, bamgen in enumerate(bamgens):
-            if last_reads[i] == None:
-                try:
-                    last_reads[i] = bamgen.next()
-                    if last_reads[i]:
-                        found = True
-                except:
-                    pass
-            else:
-                found = True
-        if not found:
-            break
-
-        best_val = None
-        best_reads = None
-        best_source = 0
-
-        first_group = last_reads[0]
-        for i in xrange(len(last_reads)):
-            if not last_reads[i]:
-                continue
-
-            match = False
-            for read in last_reads[i]:
-                if read.qname == first_group[0].qname:
-                    match = True
+        bamgens.append(bam_read_groups(bam, threads > 1))
+
+    tmpname = '%s.tmp' % fname
+    pipe = None
+    outfile = None
+
+    try:
+        if threads > 1:
+            # write an uncompressed BAM stream, which is compressed using threads
+            pipe = BGZipPipe(tmpname, threads)
+            outfile = pysam.Samfile(pipe.path, "wbu", template=bams[0])
+        else:
+            outfile = pysam.Samfile(tmpname, "wb", template=bams[0])
+
+        inputs = _MergeInputs(bamgens)
+
+        for first_group in bamgens[0]:
+            best_val = None
+            best_reads = None
+            best_source = 0
+
+            matches = inputs.pop(first_group.qname)
+
+            for i in [0] + matches:
+                group = first_group if i == 0 else inputs.groups[i]
+                for j, read in enumerate(group):
                     if not read.is_unmapped:
-                        tag_val = int(read.opt(tag))
+                        tag_val = int(group.tag(j, tag))
                         if not best_val or tag_val > best_val:
                             best_val = tag_val
-                            best_reads = last_reads[i]
+                            best_reads = group
                             best_source = i
                             break
-            if match:
-                last_reads[i] = None
 
-        if best_reads:
-            counts[best_source] += 1
-            for read in best_reads:
-                outfile.write(read)
-        else:
-            unmapped += 1
+            if best_reads:
+                counts[best_source] += 1
+                for read in best_reads:
+                    outfile.write(read)
+            else:
+                unmapped += 1
 
-            if not discard:
-                outfile.write(first_group[0])
+                if not discard:
+                    outfile.write(first_group[0])
 
-    if not quiet:
-        for fn, cnt in zip(infiles, counts):
-            print "%s\t%s" % (fn, cnt)
-        print "unmapped\t%s" % unmapped
+            for i in matches:
+                inputs.advance(i)
 
-    outfile.close()
-    for bam in bams:
-        bam.close()
+        if not quiet:
+            for fn, cnt in zip(infiles, counts):
+                print "%s\t%s" % (fn, cnt)
+            print "unmapped\t%s" % unmapped
 
-    os.rename('%s.tmp' % fname, fname)
+        outfile.close()
+        outfile = None
+
+        if pipe:
+            pipe.close()
+
+        os.rename(tmpname, fname)
+
+    finally:
+        if outfile:
+            outfile.close()
+        if pipe:
+            pipe.abort()
+        for bam in bams:
+            bam.close()
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
 
 if __name__ == '__main__':
     infiles = []
@@ -138,6 +167,7 @@ if __name__ == '__main__':
     last = None
     discard = False
     tag = 'AS'
+    threads = 1
 
     for arg in sys.argv[1:]:
         if arg == '-h':
@@ -145,7 +175,10 @@ if __name__ == '__main__':
         elif last == '-tag':
             tag = arg
             last = None
-        elif arg in ['-tag']:
+        elif last == '-t':
+            threads = positive_int_arg('-t', arg, usage)
+            last = None
+        elif arg in ['-tag', '-t']:
             last = arg
         elif arg == '-discard':
             discard = True
@@ -157,4 +190,4 @@ if __name__ == '__main__':
     if not infiles or not outfile:
         usage()
     else:
-        bam_merge(outfile, infiles, tag, discard)
+        bam_merge(outfile, infiles, tag, discard, threads=threads)
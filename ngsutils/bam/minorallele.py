@@ -23,6 +23,8 @@ import sys
 import math
 import subprocess
 from ngsutils.bam import bam_pileup_iter
+import ngsutils.bam.parallel
+from ngsutils.support import positive_int_arg
 import pysam
 
 
@@ -74,6 +76,8 @@ Options:
   -alleles val   The number of alleles included in this sample
                  If given, a Clopper-Pearson style confidence interval will
                  be calculated. (requires rpy2 or R)
+  -p       val   Use {val} processes (the genome is split into shards that
+                 are processed in parallel) (default 1)
 """
     if robjects:
         print "rpy2 detected!"
@@ -83,9 +87,8 @@ Options:
     sys.exit(1)
 
 
-def bam_minorallele(bam_fname, ref_fname, min_qual=0, min_count=0, num_alleles=0, name=None, min_ci_low=None):
+def bam_minorallele(bam_fname, ref_fname, min_qual=0, min_count=0, num_alleles=0, name=None, min_ci_low=None, procs=1):
     bam = pysam.Samfile(bam_fname, "rb")
-    ref = pysam.Fastafile(ref_fname)
 
     if not name:
         name = os.path.basename(bam_fname)
@@ -98,7 +101,27 @@ def bam_minorallele(bam_fname, ref_fname, min_qual=0, min_count=0, num_alleles=0
         sys.stdout.write("\tci_low\tci_high\tallele_lowt\tallele_high")
     sys.stdout.write('\n')
 
-    for pileup in bam_pileup_iter(bam, mask=1540):
+    if procs > 1:
+        shards = ngsutils.bam.parallel.genome_shards(bam)
+        lines = ngsutils.bam.parallel.shard_map(bam, _minorallele_shard, shards, procs, (ref_fname, min_qual, min_count, num_alleles, min_ci_low))
+    else:
+        lines = _minorallele_lines(bam, ref_fname, bam_pileup_iter(bam, mask=1540), min_qual, min_count, num_alleles, min_ci_low)
+
+    for line in lines:
+        print line
+
+    bam.close()
+
+
+def _minorallele_shard(bam, shard, ref_fname, min_qual, min_count, num_alleles, min_ci_low):
+    'Worker: the output lines for one shard of the genome (see bam_minorallele)'
+    return _minorallele_lines(bam, ref_fname, ngsutils.bam.parallel.shard_pileup(bam, shard, mask=1540), min_qual, min_count, num_alleles, min_ci_low)
+
+
+def _minorallele_lines(bam, ref_fname, pileups, min_qual=0, min_count=0, num_alleles=0, min_ci_low=None):
+    ref = pysam.Fastafile(ref_fname)
+
+    for pileup in pileups:
         chrom = bam.getrname(pileup.tid)
 
         counts = {'A': 0, 'C': 0, 'G': 0, 'T': 0}
@@ -158,9 +181,8 @@ def bam_minorallele(bam_fname, ref_fname, min_qual=0, min_count=0, num_alleles=0
                 ci_low = 0
 
             if not math.isnan(ci_low) and (min_ci_low is None or ci_low > min_ci_low):
-                print '\t'.join([str(x) for x in cols])
+                yield '\t'.join([str(x) for x in cols])
 
-    bam.close()
     ref.close()
 
 
@@ -196,6 +218,7 @@ if __name__ == '__main__':
     min_ci = None
     num_alleles = 0
     name = None
+    procs = 1
 
     last = None
     for arg in sys.argv[1:]:
@@ -214,9 +237,12 @@ if __name__ == '__main__':
         elif last == '-name':
             name = arg
             last = None
+        elif last == '-p':
+            procs = positive_int_arg('-p', arg, usage)
+            last = None
         elif arg == '-h':
             usage()
-        elif arg in ['-qual', '-count', '-alleles', '-name', '-ci-low']:
+        elif arg in ['-qual', '-count', '-alleles', '-name', '-ci-low', '-p']:
             last = arg
         elif not bam and os.path.exists(arg) and os.path.exists('%s.bai' % arg):
             bam = arg
@@ -233,4 +259,4 @@ if __name__ == '__main__':
     if not bam or not ref:
         usage()
 
-    bam_minorallele(bam, ref, min_qual, min_count, num_alleles, name, min_ci)
+    bam_minorallele(bam, ref, min_qual, min_count, num_alleles, name, min_ci, procs)
@@ -0,0 +1,183 @@
+'''
+Genome-sharded parallel execution for pileup-style commands
+
+Commands like basecall, tobedgraph, cims, expressed and minorallele walk a BAM
+file position by position. This work can be split up by genomic position:
+the references of the BAM file (or a set of regions from a BED file) are
+split into shards that don't overlap, and each shard is handled by a worker
+process with its own copy of the BAM file.
+
+Each worker writes the values for its shard to a temporary file. These are
+then read back (streamed) in genomic order, so the calling command sees the
+values in the same order as if one process had walked the entire file.
+Anything that spans the edge of a shard (a run of positions with the same
+coverage, a region of expressed reads, etc) is carried over from one shard to
+the next by the calling command.
+'''
+
+import collections
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import ngsutils.bam
+from eta import ETA
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+DEFAULT_SHARD_SIZE = 1000000
+
+# values are written to the shard files in batches of this size
+_BATCH_SIZE = 1024
+
+# chrom, start, end - the span of the shard (zero-based, half-open)
+# regions        - the regions (BedRegions) in the shard, if it was made from
+#                  a set of regions, otherwise None
+Shard = collections.namedtuple('Shard', 'chrom start end regions')
+
+
+def genome_shards(bam, shard_size=None):
+    '''
+    Splits each reference of a BAM file into shards of (at most) shard_size bases.
+    '''
+    if not shard_size:
+        shard_size = DEFAULT_SHARD_SIZE
+
+    shards = []
+    for chrom, length in zip(bam.references, bam.lengths):
+        start = 0
+        while start < length:
+            end = min(start + shard_size, length)
+            shards.append(Shard(chrom, start, end, None))
+            start = end
+
+    return shards
+
+
+def region_shards(regions):
+    '''
+    Splits a set of regions (BedFile) into shards, one for each run of regions
+    on the same reference. The regions are kept in their original order.
+
+    Regions on the same reference are kept in the same shard, so that reads
+    that span more than one region are handled the same way as they would be
+    if all of the regions were processed by one process.
+    '''
+    shards = []
+    chrom = None
+    cur = []
+
+    for region in regions:
+        if region.chrom != chrom:
+            if cur:
+                shards.append(Shard(chrom, min([x.start for x in cur]), max([x.end for x in cur]), cur))
+            chrom = region.chrom
+            cur = []
+        cur.append(region)
+
+    if cur:
+        shards.append(Shard(chrom, min([x.start for x in cur]), max([x.end for x in cur]), cur))
+
+    return shards
+
+
+def shard_pileup(bam, shard, mask=1796):
+    '''
+    Yields the pileup columns for the positions in a shard.
+    '''
+    if not shard.chrom in bam.references:
+        return
+
+    for pileup in bam.pileup(shard.chrom, shard.start, shard.end, mask=mask):
+        if pileup.pos < shard.start:
+            continue
+        if pileup.pos >= shard.end:
+            break
+        yield pileup
+
+
+def shard_map(bam, func, shards, procs=1, args=(), quiet=False):
+    '''
+    Calls func(bam, shard, *args) for each shard and yields the values that
+    it yields (func should be a generator). The shards are processed in a
+    pool of worker processes, but the values are yielded in shard order.
+
+    The worker processes are forked, so func and args don't need to be
+    pickled, but the values that func yields do.
+    '''
+    global _shard_state
+
+    if not quiet:
+        eta = ETA(len(shards))
+    else:
+        eta = None
+
+    if procs < 2 or not bam.filename:
+        for i, shard in enumerate(shards):
+            if eta:
+                eta.print_status(i, extra='%s:%s-%s' % (shard.chrom, shard.start, shard.end))
+            for val in func(bam, shard, *args):
+                yield val
+
+        if eta:
+            eta.done()
+        return
+
+    tmpdir = tempfile.mkdtemp(prefix='.ngsutils_shards')
+    _shard_state = (bam.filename, func, shards, args, tmpdir)
+
+    pool = multiprocessing.Pool(procs)
+    try:
+        for i, fname in enumerate(pool.imap(_run_shard, xrange(len(shards)), 1)):
+            if eta:
+                eta.print_status(i, extra='%s:%s-%s' % (shards[i].chrom, shards[i].start, shards[i].end))
+
+            with open(fname, 'rb') as f:
+                while True:
+                    try:
+                        batch = pickle.load(f)
+                    except EOFError:
+                        break
+                    for val in batch:
+                        yield val
+
+            os.unlink(fname)
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(tmpdir, True)
+        _shard_state = None
+
+    if eta:
+        eta.done()
+
+
+_shard_state = None
+
+
+def _run_shard(shard_num):
+    'Worker process: writes the values for one shard to a temporary file (see shard_map)'
+    bamfile, func, shards, args, tmpdir = _shard_state
+
+    fname = os.path.join(tmpdir, 'shard%s' % shard_num)
+    bam = ngsutils.bam.bam_open(bamfile)
+
+    with open(fname, 'wb') as f:
+        batch = []
+        for val in func(bam, shards[shard_num], *args):
+            batch.append(val)
+            if len(batch) >= _BATCH_SIZE:
+                pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+                batch = []
+
+        if batch:
+            pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+
+    bam.close()
+    return fname
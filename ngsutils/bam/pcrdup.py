@@ -13,12 +13,26 @@ The orientation for paired-end reads is assumed to be "FR" (forward-reverse).
 Note: The BAM file must be sorted in order to find duplicates. For paired-end
       reads, the the proper-pair (0x4) flag must be set and the isize/tlen
       field must be correctly calculated.
+
+In the mate-aware mode (-mates), fragments are instead found using the
+position and strand of both reads in a pair. This doesn't require the pairs to
+be proper (mates can be on different chromosomes). The duplicate status of
+each pair is decided at the first read of the pair, and the decisions for the
+mates that haven't been seen yet are kept in a cache. Entries are removed from
+the cache when the mate is found, or when the file has passed the mate's
+position. If the cache gets too big, it is written to a temporary file, so
+memory use is bounded.
 '''
 
 import sys
 import os
+import heapq
+import tempfile
 import pysam
 from ngsutils.bam import bam_iter
+from ngsutils.support import positive_int_arg
+
+DEFAULT_CACHE_SIZE = 1000000
 
 
 def usage(msg=None):
@@ -42,9 +56,16 @@ Options:
                          mapped to it, but they are not pcr duplicates, then
                          there each will be reported separately.
 
+    -mates               Find duplicate pairs using the position and strand
+                         of both reads (mate-aware, bounded memory)
+
+    -cache num           The maximum number of pending mates to keep in memory
+                         before writing them to a temporary file (-mates only)
+                         [default: %s]
+
     You must set either -bam or -counts (or both).
 
-''')
+''' % DEFAULT_CACHE_SIZE)
 
     sys.exit(1)
 
@@ -78,7 +99,7 @@ def pcrdup_mark(inbam, outbam, fragment=False, countfile=None):
     def callback(read):
         return '%s, %s, %s - %s' % (total, unique, duplicates, read.qname)
 
-    for read in bam_iter(bamfile, callback=callback):
+    for read in bam_iter(inbam, callback=callback):
         if not read.is_paired or read.is_read1:
             total += 1
 
@@ -134,11 +155,224 @@ def pcrdup_mark(inbam, outbam, fragment=False, countfile=None):
     sys.stdout.write('Unique reads:\t%s\n' % unique)
     sys.stdout.write('PCR duplicates:\t%s\n' % duplicates)
 
+
+class MateCache(object):
+    '''
+    The mates of duplicate reads that haven't been seen yet. Each entry is
+    the name of a read and the position of its mate (tid, pos). The BAM file
+    is sorted, so once the file has passed this position, the entry can be
+    removed (the mate is missing).
+
+    If there are more than maxsize entries in memory, they are written
+    (sorted) to a temporary file. The entries in these files are read back
+    when the file reaches their positions.
+    '''
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.peak = 0
+        self.spilled = 0
+        self.missing = 0
+
+        self._pending = set()
+        self._heap = []
+        self._runs = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, qname, tid, pos):
+        k = (tid, pos, qname)
+        if k in self._pending:
+            return
+
+        self._pending.add(k)
+        heapq.heappush(self._heap, k)
+
+        if len(self._pending) > self.peak:
+            self.peak = len(self._pending)
+
+        if len(self._pending) > self.maxsize:
+            self._spill()
+
+    def pop(self, qname, tid, pos):
+        'Returns True (and removes the entry) if this read is in the cache'
+        k = (tid, pos, qname)
+        if k in self._pending:
+            self._pending.remove(k)
+            return True
+        return False
+
+    def advance(self, tid, pos):
+        '''
+        Moves the cache to a new position (tid, pos). Entries from the
+        temporary files for this position are loaded, and entries for
+        earlier positions are removed.
+        '''
+        for run in self._runs:
+            while run[1] and run[1][:2] <= (tid, pos):
+                if run[1][:2] < (tid, pos):
+                    self.missing += 1
+                else:
+                    self._pending.add(run[1])
+                    heapq.heappush(self._heap, run[1])
+
+                run[1] = MateCache._read_entry(run[0])
+
+        while self._heap and self._heap[0][:2] < (tid, pos):
+            k = heapq.heappop(self._heap)
+            if k in self._pending:
+                self._pending.remove(k)
+                self.missing += 1
+
+    def close(self):
+        for run in self._runs:
+            if run[1]:
+                run[0].close()
+        self._runs = []
+
+    def _spill(self):
+        f = tempfile.TemporaryFile(prefix='.ngsutils_pcrdup')
+        for tid, pos, qname in sorted(self._pending):
+            f.write('%s\t%s\t%s\n' % (tid, pos, qname))
+        f.seek(0)
+
+        self.spilled += len(self._pending)
+        self._runs.append([f, MateCache._read_entry(f)])
+        self._pending = set()
+        self._heap = []
+
+    @staticmethod
+    def _read_entry(f):
+        line = f.readline()
+        if not line:
+            f.close()
+            return None
+
+        tid, pos, qname = line.rstrip('\n').split('\t', 2)
+        return (int(tid), int(pos), qname)
+
+
+def __flush_fragments(cur_reads, outbam, inbam, cache, countfile=None):
+    if cur_reads:
+        for k in cur_reads:
+            count = 0
+
+            for i, (mapq, idx, r) in enumerate(sorted(cur_reads[k])[::-1]):
+                count += 1
+                if i > 0:
+                    r.is_duplicate = True
+                    if r.is_paired:
+                        cache.add(r.qname, r.rnext, r.pnext)
+                else:
+                    isize = r.isize
+                if outbam:
+                    outbam.write(r)
+
+            if countfile:
+                countfile.write('%s\t%s\t%s\t%s\n' % (inbam.references[k[0]], k[1], isize, count))
+
+
+def pcrdup_mark_mates(inbam, outbam, countfile=None, cache_size=DEFAULT_CACHE_SIZE):
+    '''
+    Marks PCR duplicates, where a fragment is the position and strand of a
+    read and its mate (tid, pos, mate tid, mate pos, orientation). Single-end
+    reads use only their own position and strand.
+
+    The first read of each pair is marked using the fragment. The second read
+    is then marked using the cached decision for the first read.
+    '''
+    cache = MateCache(cache_size)
+
+    cur_pos = None
+    cur_reads = {}
+    held = []
+    idx = 0
+
+    total = 0
+    unique = 0
+    duplicates = 0
+
+    def callback(read):
+        return '%s, %s, %s (cache: %s) - %s' % (total, unique, duplicates, len(cache), read.qname)
+
+    def flush():
+        __flush_fragments(cur_reads, outbam, inbam, cache, countfile)
+
+        # mates in the same position as their first read
+        for r in held:
+            if cache.pop(r.qname, r.tid, r.pos):
+                r.is_duplicate = True
+            if outbam:
+                outbam.write(r)
+
+    for read in bam_iter(inbam, callback=callback):
+        if not read.is_paired or read.is_read1:
+            total += 1
+
+        start_pos = (read.tid, read.pos)
+        if start_pos != cur_pos:
+            flush()
+            cur_pos = start_pos
+            cur_reads = {}
+            held = []
+            idx = 0
+
+            if read.tid > -1:
+                cache.advance(read.tid, read.pos)
+
+        if read.is_unmapped:
+            if outbam:
+                outbam.write(read)
+            continue
+
+        if not read.is_paired:
+            dup_pos = (read.tid, read.pos, -1, -1, read.is_reverse, None)
+        elif read.mate_is_unmapped:
+            # no mate to compare, just write it out, no flags to set.
+            if outbam:
+                outbam.write(read)
+            continue
+        elif start_pos > (read.rnext, read.pnext) or (start_pos == (read.rnext, read.pnext) and read.is_read2):
+            # this is the second read in the pair, so the first has already
+            # been seen
+            if start_pos == (read.rnext, read.pnext):
+                held.append(read)
+            else:
+                if cache.pop(read.qname, read.tid, read.pos):
+                    read.is_duplicate = True
+                if outbam:
+                    outbam.write(read)
+            continue
+        else:
+            dup_pos = (read.tid, read.pos, read.rnext, read.pnext, read.is_reverse, read.mate_is_reverse)
+
+        if dup_pos in cur_reads:
+            duplicates += 1
+            cur_reads[dup_pos].append((read.mapq, -idx, read))
+        else:
+            unique += 1
+            cur_reads[dup_pos] = [(read.mapq, -idx, read), ]
+
+        idx += 1
+
+    flush()
+    cache.close()
+
+    sys.stdout.write('Total reads:\t%s\n' % total)
+    sys.stdout.write('Unique reads:\t%s\n' % unique)
+    sys.stdout.write('PCR duplicates:\t%s\n' % duplicates)
+    sys.stdout.write('Peak mate cache:\t%s\n' % cache.peak)
+    sys.stdout.write('Mates cached on disk:\t%s\n' % cache.spilled)
+    sys.stdout.write('Missing mates:\t%s\n' % cache.missing)
+
+
 if __name__ == '__main__':
     infile = None
     outfile = None
     countfname = None
     fragment = False
+    mates = False
+    cache_size = DEFAULT_CACHE_SIZE
 
     last = None
 
@@ -151,10 +385,15 @@ if __name__ == '__main__':
         elif last == '-bam':
             outfile = arg
             last = None
-        elif arg in ['-counts', '-bam']:
+        elif last == '-cache':
+            cache_size = positive_int_arg('-cache', arg, usage)
+            last = None
+        elif arg in ['-counts', '-bam', '-cache']:
             last = arg
         elif arg == '-frag':
             fragment = True
+        elif arg == '-mates':
+            mates = True
         elif not infile:
             if os.path.exists(arg):
                 infile = arg
@@ -169,6 +408,9 @@ if __name__ == '__main__':
     if not infile or not (outfile or countfname):
         usage()
 
+    if fragment and mates:
+        usage('-frag and -mates can not be used together')
+
     bamfile = pysam.Samfile(infile, "rb")
     bamout = None
     if outfile:
@@ -179,7 +421,10 @@ if __name__ == '__main__':
     else:
         countfile = None
 
-    pcrdup_mark(bamfile, bamout, fragment, countfile)
+    if mates:
+        pcrdup_mark_mates(bamfile, bamout, countfile, cache_size)
+    else:
+        pcrdup_mark(bamfile, bamout, fragment, countfile)
 
     bamfile.close()
     if bamout:
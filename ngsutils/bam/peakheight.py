@@ -7,67 +7,250 @@ Find the size of a set of defined peaks (BED) in a BED file.
 If you have a set of defined peak regions (in the form of a BED file), this
 will return the size characteristics of the region for a given BAM file.
 
-The following fields will be added to the BED file:
+The following fields will be added to the BED file (for each BAM file):
     maximum peak size
-    total unique reads
+    total reads
     total coverage (sum of coverage over each base)
     coverage density (total coverage / length)
 '''
 import sys
 import os
+import numpy
 from ngsutils.bam import bam_open
+from ngsutils.bam.coverage import read_blocks
 
 
-def bam_peakheight(bam, bed_fobj, mask=1796):
+def bam_peakheight(bams, bed_fobj, mask=1796, out=sys.stdout):
+    '''
+    Adds the size of each peak to the BED file. bams can be one BAM file or a
+    list of them - one set of columns is added for each BAM file.
+
+    The peaks on each chromosome are sorted and grouped into clusters of
+    overlapping peaks. The reads for each chromosome are read once, and each
+    read is added to the clusters that it overlaps (see _scan_clusters). The
+    sizes of all of the peaks in a cluster are taken from the same depth
+    array. The peaks are written in their original order.
+    '''
+    if not type(bams) in [list, tuple]:
+        bams = [bams]
+
+    peaks = []
+    chrom_peaks = {}
     for line in bed_fobj:
         cols = line.strip('\n').split('\t')
-        coverage_acc = 0
-        max_coverage = 0
-        reads = set()
-        ref = cols[0]
-        start = int(cols[1])
-        end = int(cols[2])
-        for pileup in bam.pileup(reference=ref, start=start, end=end, mask=mask):
-            coverage_acc += pileup.n
-            if pileup.n > max_coverage:
-                max_coverage = pileup.n
-
-            for read in pileup.pileups:
-                reads.add(read.alignment.qname)
-
-        cols.append(max_coverage)
-        cols.append(len(reads))
-        cols.append(coverage_acc)
-        cols.append(float(coverage_acc) / (end-start))
-        print '\t'.join([str(x) for x in cols])
+        chrom_peaks.setdefault(cols[0], []).append(len(peaks))
+        peaks.append(cols)
+
+    for bam in bams:
+        vals = [None, ] * len(peaks)
+        for chrom in chrom_peaks:
+            idx = sorted(chrom_peaks[chrom], key=lambda i: int(peaks[i][1]))
+            clusters = []
+            for cluster in _peak_clusters(idx, [int(peaks[i][1]) for i in idx], [int(peaks[i][2]) for i in idx]):
+                clusters.append(_PeakCluster(cluster, [int(peaks[i][1]) for i in cluster], [int(peaks[i][2]) for i in cluster]))
+
+            _scan_clusters(bam, chrom, clusters, mask)
+
+            for cluster in clusters:
+                heights, counts, totals = cluster.sizes()
+                for j, i in enumerate(cluster.idx):
+                    vals[i] = (heights[j], counts[j], totals[j])
+
+        for cols, (max_coverage, read_count, coverage_acc) in zip(peaks, vals):
+            cols.append(int(max_coverage))
+            cols.append(int(read_count))
+            cols.append(int(coverage_acc))
+            cols.append(float(coverage_acc) / (int(cols[2]) - int(cols[1])))
+
+    for cols in peaks:
+        out.write('%s\n' % '\t'.join([str(x) for x in cols]))
+
+
+def _peak_clusters(idx, starts, ends):
+    '''
+    Groups peaks (sorted by start) into clusters of overlapping peaks.
+
+    >>> list(_peak_clusters([3, 1, 2, 0], [10, 15, 30, 40], [20, 25, 50, 45]))
+    [[3, 1], [2, 0]]
+    '''
+    cluster = []
+    cluster_end = None
+    for i, start, end in zip(idx, starts, ends):
+        if cluster and start >= cluster_end:
+            yield cluster
+            cluster = []
+
+        if not cluster or end > cluster_end:
+            cluster_end = end
+        cluster.append(i)
+
+    if cluster:
+        yield cluster
+
+
+def _scan_clusters(bam, chrom, clusters, mask=1796):
+    '''
+    Adds the reads on a chromosome to each of the peak clusters (sorted by
+    start) that they overlap, with one fetch for the chromosome.
+
+    The reads are sorted by position, so only a window of active clusters
+    needs to be checked for each read: clusters are added to the window when
+    a read reaches them, and dropped once the reads have moved past them.
+    The sizes of a dropped cluster are calculated right away, so that its
+    reads aren't kept for the rest of the chromosome. Reads that don't overlap any cluster are skipped without looking at
+    their alignment blocks.
+    '''
+    clusters = [x for x in clusters if x.end > x.start]
+    if not clusters or not chrom in bam.references:
+        return
+
+    active = []
+    next_i = 0
+
+    for read in bam.fetch(chrom, clusters[0].start, max([x.end for x in clusters])):
+        if read.flag & mask or not read.cigar or read.aend is None:
+            continue
+
+        read_start = read.pos
+        read_end = read.aend
+
+        # later reads start at or after read_start
+        still_active = []
+        for cluster in active:
+            if cluster.end > read_start:
+                still_active.append(cluster)
+            else:
+                cluster.sizes()
+        active = still_active
+
+        while next_i < len(clusters) and clusters[next_i].start < read_end:
+            active.append(clusters[next_i])
+            next_i += 1
+
+        overlapping = [x for x in active if x.start < read_end]
+        if not overlapping:
+            continue
+
+        blocks = read_blocks(read)
+        if not blocks:
+            continue
+
+        for cluster in overlapping:
+            cluster.add(blocks)
+
+
+class _PeakCluster(object):
+    '''
+    The aligned blocks and spans of the reads that overlap a cluster of
+    peaks, used to find the size of each peak in the cluster.
+    '''
+    def __init__(self, idx, starts, ends):
+        self.idx = idx
+        self.starts = numpy.array(starts, dtype=numpy.int64)
+        self.ends = numpy.array(ends, dtype=numpy.int64)
+        self.start = int(self.starts.min())
+        self.end = int(self.ends.max())
+
+        self._block_starts = []
+        self._block_ends = []
+        self._read_starts = []
+        self._read_ends = []
+        self._gaps = []
+        self._sizes = None
+
+    def add(self, blocks):
+        'Adds the aligned blocks for a read'
+        for s, e in blocks:
+            if e <= self.start or s >= self.end:
+                continue
+            self._block_starts.append(max(s, self.start) - self.start)
+            self._block_ends.append(min(e, self.end) - self.start)
+
+        self._read_starts.append(blocks[0][0])
+        self._read_ends.append(blocks[-1][1])
+
+        for (s1, e1), (s2, e2) in zip(blocks[:-1], blocks[1:]):
+            if e1 < s2:
+                self._gaps.append((e1, s2))
+
+    def sizes(self):
+        '''
+        Returns numpy arrays of the max height, number of reads and total
+        coverage for each peak in the cluster.
+
+        The aligned blocks are tallied in one depth array for the cluster
+        (see ngsutils.bam.coverage). A read is counted for a peak if its span
+        overlaps the peak, unless the peak is entirely within a gap (deletion
+        or intron) of the read.
+
+        The sizes are only calculated once, and the reads are then discarded,
+        so no more reads can be added.
+        '''
+        if self._sizes is None:
+            self._sizes = self._calc_sizes()
+            self._block_starts = None
+            self._block_ends = None
+            self._read_starts = None
+            self._read_ends = None
+            self._gaps = None
+
+        return self._sizes
+
+    def _calc_sizes(self):
+        starts = self.starts
+        ends = self.ends
+        length = max(self.end - self.start, 0)
+
+        diff = numpy.bincount(numpy.array(self._block_starts, dtype=numpy.int64), minlength=length + 1)
+        diff -= numpy.bincount(numpy.array(self._block_ends, dtype=numpy.int64), minlength=length + 1)
+        depth = numpy.cumsum(diff)  # the extra value at the end is always 0
+
+        rel_starts = starts - self.start
+        rel_ends = ends - self.start
+
+        acc = numpy.concatenate(([0], numpy.cumsum(depth)))
+        totals = acc[rel_ends] - acc[rel_starts]
+
+        heights = numpy.maximum.reduceat(depth, numpy.column_stack((rel_starts, rel_ends)).ravel())[::2]
+        heights[rel_starts >= rel_ends] = 0
+
+        read_starts = sorted(self._read_starts)
+        read_ends = sorted(self._read_ends)
+        counts = numpy.searchsorted(read_starts, ends, 'left') - numpy.searchsorted(read_ends, starts, 'right')
+
+        for gap_start, gap_end in self._gaps:
+            lo = numpy.searchsorted(starts, gap_start, 'left')
+            hi = numpy.searchsorted(starts, gap_end, 'left')
+            if lo < hi:
+                counts[lo:hi] -= ends[lo:hi] <= gap_end
+
+        return heights, counts, totals
 
 
 def usage():
     print __doc__
     print """\
-Usage: bamutils peakheight {options} bamfile peaks.bed
+Usage: bamutils peakheight {options} bamfile {bamfile...} peaks.bed
 """
     sys.exit(1)
 
 if __name__ == "__main__":
-    bam_fname = None
-    bed_fname = None
+    fnames = []
 
     for arg in sys.argv[1:]:
         if arg == '-h':
             usage()
-        elif not bam_fname and os.path.exists(arg):
-            bam_fname = arg
-        elif not bed_fname and os.path.exists(arg):
-            bed_fname = arg
+        elif os.path.exists(arg):
+            fnames.append(arg)
         else:
             print 'Unknown argument: %s' % arg
             usage()
-    if not bam_fname or not bed_fname:
+    if len(fnames) < 2:
         usage()
 
-    bam = bam_open(bam_fname)
-    with open(bed_fname) as f:
-        bam_peakheight(bam, f)
+    bams = [bam_open(x) for x in fnames[:-1]]
+    with open(fnames[-1]) as f:
+        bam_peakheight(bams, f)
 
-    bam.close()
+    for bam in bams:
+        bam.close()
@@ -0,0 +1,194 @@
+'''
+Compiled index of region (junction library) reference names
+
+When reads are mapped to a junction library (or other set of regions), the
+name of each reference holds its genomic location: chrom:start-end, with
+more than one start-end for junctions (see bamutils convertregion). Parsing
+these names for every read is slow, and keeping the parsed names for a large
+junction library takes a lot of memory.
+
+This module parses the reference names from the BAM header once and writes
+the fragments (start, end) of each reference to a binary file
+(in.bam.ngsregions) with a sidecar index (in.bam.ngsregions.idx). The binary
+file holds numpy arrays: the offset of the fragments for each reference
+(tid), the start and end of each fragment, and the genomic chrom of each
+reference (as an index into the list of chrom names kept in the sidecar).
+The file is memory-mapped, so finding the fragments for a tid is a slice of
+the mapped arrays.
+
+The sidecar files are keyed on the size and mtime of the BAM file (see
+ngsutils.support.sidecar). If either changes, the index is regenerated. If
+the files can't be written next to the BAM file, the index is kept in a
+temporary file instead.
+'''
+
+import array
+import sys
+
+import numpy
+
+import ngsutils.bam
+from ngsutils.support import sidecar
+
+
+class RegionIndex(object):
+    '''
+    The genomic fragments for each reference in a BAM file that was mapped
+    to a junction library (or other region references).
+    '''
+    _version = 2
+
+    def __init__(self, bam, cache_enabled=True, quiet=False):
+        self.filename = bam.filename
+        self.datafile = '%s.ngsregions' % bam.filename
+        self.indexfile = '%s.ngsregions.idx' % bam.filename
+        self.built = False
+
+        self._mm = None
+        self._dataf = None
+
+        if not bam.filename:
+            cache_enabled = False
+
+        key = sidecar.file_key(bam.filename) if cache_enabled else None
+        cached = None
+        if cache_enabled:
+            cached = sidecar.load(self.indexfile, RegionIndex._version, key, self.datafile)
+
+        if not cached:
+            if not quiet:
+                sys.stderr.write('Indexing region references (%s)...\n' % self.filename)
+            cached = sidecar.build(self.datafile, self.indexfile, RegionIndex._version, key, lambda out: _compile_regions(bam.references, out), cache_enabled, quiet, 'region index')
+            self.built = True
+
+        (self.chroms, nrefs, nfrags), self._dataf, size = cached
+        self._mm = sidecar.map_file(self._dataf, size)
+
+        offset = 0
+        self._offsets = numpy.frombuffer(self._mm, dtype=numpy.int64, count=nrefs + 1, offset=offset)
+        offset += 8 * (nrefs + 1)
+        self._starts = numpy.frombuffer(self._mm, dtype=numpy.int64, count=nfrags, offset=offset)
+        offset += 8 * nfrags
+        self._ends = numpy.frombuffer(self._mm, dtype=numpy.int64, count=nfrags, offset=offset)
+        offset += 8 * nfrags
+        self._chrom_idx = numpy.frombuffer(self._mm, dtype=numpy.int32, count=nrefs, offset=offset)
+
+    def close(self):
+        self._offsets = self._starts = self._ends = self._chrom_idx = None
+        if self._mm:
+            self._mm.close()
+            self._mm = None
+        if self._dataf:
+            self._dataf.close()
+            self._dataf = None
+
+    def __len__(self):
+        return len(self._chrom_idx)
+
+    def fragments(self, tid):
+        'Returns the genomic chrom and the list of (start, end) fragments for a reference'
+        if tid < 0 or tid >= len(self._chrom_idx) or self._chrom_idx[tid] < 0:
+            raise ValueError("Reference %s isn't a region (chrom:start-end)" % tid)
+
+        start, end = self._offsets[tid:tid + 2]
+        return self.chroms[self._chrom_idx[tid]], zip(self._starts[start:end].tolist(), self._ends[start:end].tolist())
+
+    def convert(self, tid, pos, cigar):
+        '''
+        Converts a position and CIGAR alignment on a region reference to
+        genomic coordinates. Returns (chrom, pos, cigar), as
+        ngsutils.bam.region_pos_to_genomic_pos.
+        '''
+        chrom, fragments = self.fragments(tid)
+        return ngsutils.bam.region_fragments_to_genomic_pos(chrom, fragments, pos, cigar)
+
+    def convert_many(self, tids, positions, cigars):
+        '''
+        Converts a batch of alignments (for example, all of the mappings for
+        one read) at once. The fragments for all of the references are looked
+        up together. Returns a list of (chrom, pos, cigar).
+        '''
+        tids = numpy.asarray(tids, dtype=numpy.int64)
+        if len(tids) and (tids.min() < 0 or tids.max() >= len(self._chrom_idx)):
+            raise ValueError("Invalid reference in: %s" % tids.tolist())
+
+        chrom_idx = self._chrom_idx[tids].tolist()
+        starts = self._offsets[tids].tolist()
+        ends = self._offsets[tids + 1].tolist()
+
+        out = []
+        for tid, chrom, start, end, pos, cigar in zip(tids.tolist(), chrom_idx, starts, ends, positions, cigars):
+            if chrom < 0:
+                raise ValueError("Reference %s isn't a region (chrom:start-end)" % tid)
+            fragments = zip(self._starts[start:end].tolist(), self._ends[start:end].tolist())
+            out.append(ngsutils.bam.region_fragments_to_genomic_pos(self.chroms[chrom], fragments, pos, cigar))
+
+        return out
+
+
+def parse_region_name(name):
+    '''
+    Returns the chrom and the list of (start, end) fragments for a region
+    name, or (None, []) if the name isn't a region.
+
+    >>> parse_region_name('chr1:1000-1050,2000-2050,3000-4000')
+    ('chr1', [(1000, 1050), (2000, 2050), (3000, 4000)])
+    >>> parse_region_name('chr3R:17630851-17630897')
+    ('chr3R', [(17630851, 17630897)])
+    >>> parse_region_name('chr1')
+    (None, [])
+    >>> parse_region_name('chr1:foo')
+    (None, [])
+    '''
+    if not ':' in name:
+        return None, []
+
+    chrom, spans = name.rsplit(':', 1)
+    fragments = []
+    try:
+        for span in spans.split(','):
+            start, end = span.split('-')
+            fragments.append((int(start), int(end)))
+    except ValueError:
+        return None, []
+
+    return chrom, fragments
+
+
+def _compile_regions(references, out):
+    '''
+    Parses the region names and writes the fragment arrays to out. Returns
+    (the list of chrom names, the number of references, the number of
+    fragments) and the size of the file.
+    '''
+    chroms = []
+    chrom_ids = {}
+
+    offsets = array.array('l', [0])
+    starts = array.array('l')
+    ends = array.array('l')
+    chrom_idx = array.array('i')
+
+    for name in references:
+        chrom, fragments = parse_region_name(name)
+        if chrom is None:
+            chrom_idx.append(-1)
+        else:
+            if not chrom in chrom_ids:
+                chrom_ids[chrom] = len(chroms)
+                chroms.append(chrom)
+            chrom_idx.append(chrom_ids[chrom])
+
+            for start, end in fragments:
+                starts.append(start)
+                ends.append(end)
+
+        offsets.append(len(starts))
+
+    numpy.array(offsets, dtype=numpy.int64).tofile(out)
+    numpy.array(starts, dtype=numpy.int64).tofile(out)
+    numpy.array(ends, dtype=numpy.int64).tofile(out)
+    numpy.array(chrom_idx, dtype=numpy.int32).tofile(out)
+
+    size = 8 * (len(offsets) + len(starts) + len(ends)) + 4 * len(chrom_idx)
+    return (chroms, len(chrom_idx), len(starts)), size
@@ -13,29 +13,47 @@ that is included.
 
 import os
 import sys
-from ngsutils.bam import bam_iter
+import multiprocessing
+from ngsutils.bam import bam_iter, bam_open, bam_unmapped_iter
+from ngsutils.support import positive_int_arg
+from eta import ETA
 import pysam
 
 
 def usage():
     print __doc__
     print """
-Usage: bamutils split {-n num | -ref} in.bam out_template_name
+Usage: bamutils split {-n num | -ref {-p num} {-unmapped}} {-index} in.bam out_template_name
 
 out_template_name will be the template for the smaller BAM files.  They will
 be named "out_template_name.N.bam" where out_template_name is the given
 argument and N is the file number.
 
 Options:
-    -n      The number of reads to include in sub-files
-            (default: 1000000)
+    -n          The number of reads to include in sub-files
+                (default: 1000000)
 
-    -ref    Split by references
+    -ref        Split by references (out_template_name.ref.bam)
+
+    -p num      Split by references using {num} processes. Each reference
+                is read from the BAM index by its own process. (The BAM file
+                must be sorted and indexed.)
+
+    -unmapped   When splitting by references, also write the reads that
+                aren't placed on a reference to out_template_name.unmapped.bam
+
+    -index      Index each output file (.bai) after it is written
 """
     sys.exit(1)
 
 
-def bam_split(infile, out_template, read_count=1000000, reference=False, quiet=False):
+def bam_split(infile, out_template, read_count=1000000, reference=False, quiet=False, unmapped=False, index=False, procs=1):
+    if reference and procs > 1:
+        if os.path.exists('%s.bai' % infile):
+            return _bam_split_ref_parallel(infile, out_template, unmapped, index, procs, quiet)
+        if not quiet:
+            sys.stderr.write("Missing BAM index (%s.bai), splitting with one process\n" % infile)
+
     bamfile = pysam.Samfile(infile, "rb")
     outfile = None
 
@@ -48,11 +66,15 @@ def bam_split(infile, out_template, read_count=1000000, reference=False, quiet=F
         if not outfile or (not reference and count >= read_count) or (reference and lastref != read.tid):
             if outfile:
                 outfile.close()
+                if index:
+                    pysam.index(fname)
             file_count += 1
             count = 0
             if reference:
                 if read.tid >= 0:
                     fname = '%s.%s.bam' % (out_template, bamfile.getrname(read.tid))
+                elif unmapped:
+                    fname = '%s.unmapped.bam' % out_template
                 else:
                     fname = None
             else:
@@ -72,26 +94,116 @@ def bam_split(infile, out_template, read_count=1000000, reference=False, quiet=F
     bamfile.close()
     if outfile:
         outfile.close()
+        if index:
+            pysam.index(fname)
+    if not quiet:
+        sys.stderr.write("Split into %s files" % (file_count))
+
+
+def _bam_split_ref_parallel(infile, out_template, unmapped=False, index=False, procs=2, quiet=False):
+    '''
+    Splits a sorted and indexed BAM file by reference. Each reference (and the
+    unplaced reads at the end of the file) is read from the index and written
+    by a separate worker process.
+    '''
+    global _split_state
+
+    bamfile = bam_open(infile)
+    # the largest references first, so the workers stay busy
+    jobs = sorted(range(len(bamfile.references)), key=lambda tid: -bamfile.lengths[tid])
+    bamfile.close()
+
+    if unmapped:
+        jobs.append(-1)
+
+    _split_state = (infile, out_template, index)
+
+    if not quiet:
+        eta = ETA(len(jobs))
+    else:
+        eta = None
+
+    file_count = 0
+    pool = multiprocessing.Pool(procs)
+    try:
+        for i, (fname, count) in enumerate(pool.imap_unordered(_split_ref, jobs, 1)):
+            if eta:
+                eta.print_status(i, extra=fname)
+            if count:
+                file_count += 1
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _split_state = None
+
+    if eta:
+        eta.done()
+
     if not quiet:
         sys.stderr.write("Split into %s files" % (file_count))
 
 
+_split_state = None
+
+
+def _split_ref(tid):
+    'Worker process: writes the reads for one reference (or the unplaced reads if tid is -1)'
+    infile, out_template, index = _split_state
+
+    bamfile = bam_open(infile)
+    if tid >= 0:
+        fname = '%s.%s.bam' % (out_template, bamfile.references[tid])
+        reads = bamfile.fetch(bamfile.references[tid], 0, bamfile.lengths[tid])
+    else:
+        fname = '%s.unmapped.bam' % out_template
+        reads = bam_unmapped_iter(bamfile)
+
+    # the output file is only created if there are reads for this reference
+    outfile = None
+    count = 0
+    for read in reads:
+        if not outfile:
+            outfile = pysam.Samfile(fname, "wb", template=bamfile)
+        outfile.write(read)
+        count += 1
+
+    bamfile.close()
+
+    if outfile:
+        outfile.close()
+        if index:
+            pysam.index(fname)
+
+    return fname, count
+
+
 if __name__ == '__main__':
     infile = None
     outfile = None
     num = 1000000
     reference = False
+    unmapped = False
+    index = False
+    procs = 1
     last = None
 
     for arg in sys.argv[1:]:
         if last == '-n':
             num = int(arg)
             last = None
+        elif last == '-p':
+            procs = positive_int_arg('-p', arg, usage)
+            last = None
         elif arg == '-ref':
             reference = True
+        elif arg == '-unmapped':
+            unmapped = True
+        elif arg == '-index':
+            index = True
         elif arg == '-h':
                 usage()
-        elif arg in ['-n']:
+        elif arg in ['-n', '-p']:
             last = arg
         elif not infile:
             infile = arg
@@ -101,4 +213,6 @@ if __name__ == '__main__':
     if not infile or not outfile:
         usage()
     else:
-        bam_split(infile, outfile, num, reference=reference)
+        if procs > 1:
+            reference = True
+        bam_split(infile, outfile, num, reference=reference, unmapped=unmapped, index=index, procs=procs)
@@ -5,11 +5,16 @@
 Calculates simple stats for a BAM file
 """
 
+import copy
+import multiprocessing
 import os
 import sys
-from ngsutils.bam import read_calc_mismatches, bam_iter, bam_open
+import numpy
+from ngsutils.bam import read_calc_mismatches, bam_iter, bam_open, bam_unmapped_iter
+from ngsutils.bam.summary import BamSummary
 from ngsutils.gtf import GTF
 from ngsutils.support.regions import RegionTagger
+from ngsutils.support import positive_int_arg
 
 
 class FeatureBin(object):
@@ -93,6 +98,19 @@ class FeatureBin(object):
         if not self._max or self._max < val:
             self._max = val
 
+    def merge(self, other):
+        for val in other.bins:
+            if not val in self.bins:
+                self.bins[val] = 0
+                self._keys.append(val)
+            self.bins[val] += other.bins[val]
+
+        self.missing += other.missing
+        if other._min is not None and (not self._min or self._min > other._min):
+            self._min = other._min
+        if other._max is not None and (not self._max or self._max < other._max):
+            self._max = other._max
+
 
 def usage():
     print __doc__
@@ -149,6 +167,19 @@ Options:
 
             Note: For paired-end reads, only the first fragment is counted
                   regardless of the {-all} option above
+
+    -p num
+
+            Use {num} processes. Each reference of a sorted and indexed BAM
+            file is counted separately (with multiple files, all of the
+            files are counted at the same time).
+
+    -nocache
+
+            Don't use (or write) the summary file for the BAM file
+            (filename.bam.ngsstats). The summary file stores the whole-file
+            counts, so that they don't need to be recalculated each time.
+            It is regenerated automatically if the BAM file changes.
 """
     sys.exit(1)
 
@@ -178,19 +209,125 @@ class FlagCounts(object):
             if (fd & flag) > 0:
                 self.counts[fd] += 1
 
+    def merge(self, other):
+        for fd in flag_descriptions:
+            self.counts[fd] += other.counts[fd]
+
+
+class StatsCounts(object):
+    '''
+    The counts for a set of reads (the whole file, or one reference). Counts
+    for each reference can be merged together.
+    '''
+    def __init__(self, references, delim=None, tags=[], regiontagger=None):
+        self.total = 0
+        self.mapped = 0
+        self.unmapped = 0
+        self.flag_counts = FlagCounts()
+        self.regiontagger = regiontagger
+        self.delim = delim
+
+        self.refs = {}
+        for rname in references:
+            if delim:
+                self.refs[rname.split(delim)[0]] = 0
+            else:
+                self.refs[rname] = 0
+
+        self.tagbins = {}
+        for tag in tags:
+            self.tagbins[tag] = FeatureBin(tag)
+
+    def add(self, read, rname):
+        self.flag_counts.add(read.flag)
+
+        self.total += 1
+        if read.is_unmapped:
+            self.unmapped += 1
+            return
+
+        self.mapped += 1
+
+        if self.delim:
+            self.refs[rname.split(self.delim)[0]] += 1
+        else:
+            self.refs[rname] += 1
+
+        if self.regiontagger:
+            self.regiontagger.add_read(read, rname)
+
+        for tag in self.tagbins:
+            self.tagbins[tag].add(read)
+
+    def merge(self, other):
+        self.total += other.total
+        self.mapped += other.mapped
+        self.unmapped += other.unmapped
+        self.flag_counts.merge(other.flag_counts)
+
+        for k in other.refs:
+            self.refs[k] += other.refs[k]
+
+        for tag in other.tagbins:
+            self.tagbins[tag].merge(other.tagbins[tag])
+
+        if self.regiontagger and other.regiontagger:
+            self.regiontagger.merge(other.regiontagger)
+
+
+def _count_reads(bam, reads, counts, show_all=False, names=None, exclude=None):
+    '''
+    Adds reads to counts. Reads with multiple mappings (IH > 1) are only
+    counted once, using the set of (hashed) names that have already been
+    counted (names), and reads with these names are skipped if they are in
+    exclude (see _parallel_stats).
+
+    Returns the set of hashed names for the reads with multiple mappings.
+    '''
+    if names is None:
+        names = set()
+
+    for read in reads:
+        if not show_all and read.is_paired and not read.is_read1:
+            # only operate on the first fragment
+            continue
+
+        try:
+            if read.opt('IH') > 1:
+                h = hash(read.qname)
+                if h in names or (exclude and h in exclude):
+                    # reads only count once for this...
+                    continue
+                names.add(h)
+        except KeyError:
+            #missing IH tag - ignore
+            pass
+
+        counts.add(read, bam.getrname(read.tid) if not read.is_unmapped else None)
+
+    return names
+
 
 class BamStats(object):
-    def __init__(self, bamfile, gtf=None, region=None, delim=None, tags=[], show_all=False):
-        regiontagger = None
-        flag_counts = FlagCounts()
+    def __init__(self, bamfile, gtf=None, region=None, delim=None, tags=[], show_all=False, cache_enabled=True, procs=1, counts=None):
+        if counts:
+            # already calculated (bam_stats)
+            self._set_counts(counts)
+            return
+
+        if cache_enabled and bamfile.filename and not gtf and not region and not tags:
+            # the whole-file counts are stored in the BAM summary sidecar (.ngsstats)
+            self._load_summary(bamfile, delim, show_all)
+            return
+
+        if procs > 1 and not region and bamfile.filename:
+            self._set_counts(_parallel_stats([bamfile.filename], gtf, delim, tags, show_all, procs)[0])
+            return
 
         ref = None
         start = None
         end = None
 
-        if gtf:
-            regiontagger = RegionTagger(gtf, bamfile.references, only_first_fragment=True)
-
         if region:
             ref, startend = region.rsplit(':', 1)
             if '-' in startend:
@@ -202,82 +339,63 @@ class BamStats(object):
                 end = int(startend)
                 sys.stderr.write('Region: %s:%s\n' % (ref, start + 1))
 
-        total = 0
-        mapped = 0
-        unmapped = 0
-        names = set()
-        refs = {}
-
-        tagbins = {}
-        for tag in tags:
-            tagbins[tag] = FeatureBin(tag)
-
-        for rname in bamfile.references:
-            if delim:
-                refs[rname.split(delim)[0]] = 0
-            else:
-                refs[rname] = 0
-
-        # setup region or whole-file readers
-        def _foo1():
-            for read in bamfile.fetch(ref, start, end):
-                yield read
+        if gtf:
+            regiontagger = RegionTagger(gtf, bamfile.references, only_first_fragment=True)
+        else:
+            regiontagger = None
 
-        def _foo2():
-            for read in bam_iter(bamfile):
-                yield read
+        counts = StatsCounts(bamfile.references, delim, tags, regiontagger)
 
         if region:
-            read_gen = _foo1
+            reads = bamfile.fetch(ref, start, end)
         else:
-            read_gen = _foo2
+            reads = bam_iter(bamfile)
 
         try:
-            for read in read_gen():
-                if not show_all and read.is_paired and not read.is_read1:
-                    # only operate on the first fragment
-                    continue
-
-                try:
-                    if read.opt('IH') > 1:
-                        if read.qname in names:
-                            # reads only count once for this...
-                            continue
-                        names.add(read.qname)
-                except KeyError:
-                    #missing IH tag - ignore
-                    pass
-
-                flag_counts.add(read.flag)
-
-                total += 1
-                if read.is_unmapped:
-                    unmapped += 1
-                    continue
-
-                mapped += 1
+            _count_reads(bamfile, reads, counts, show_all)
+        except KeyboardInterrupt:
+            sys.stderr.write('*** Interrupted - displaying stats up to this point! ***\n\n')
 
-                if delim:
-                    refs[bamfile.getrname(read.rname).split(delim)[0]] += 1
-                else:
-                    refs[bamfile.getrname(read.rname)] += 1
+        self._set_counts(counts)
+
+    def _set_counts(self, counts):
+        self.total = counts.total
+        self.mapped = counts.mapped
+        self.unmapped = counts.unmapped
+        self.flag_counts = counts.flag_counts
+        self.tagbins = counts.tagbins
+        self.refs = counts.refs
+        self.regiontagger = counts.regiontagger
+
+    def _load_summary(self, bamfile, delim, show_all):
+        summary = BamSummary(bamfile.filename)
+        if show_all:
+            counts = summary.all
+        else:
+            counts = summary.first
 
-                if regiontagger:
-                    regiontagger.add_read(read, bamfile.getrname(read.rname))
+        flag_counts = FlagCounts()
+        for fd in flag_descriptions:
+            flag_counts.counts[fd] = counts.flags[fd]
 
-                for tag in tagbins:
-                    tagbins[tag].add(read)
+        refs = {}
+        for rname in bamfile.references:
+            if delim:
+                k = rname.split(delim)[0]
+            else:
+                k = rname
 
-        except KeyboardInterrupt:
-            sys.stderr.write('*** Interrupted - displaying stats up to this point! ***\n\n')
+            if not k in refs:
+                refs[k] = 0
+            refs[k] += counts.refs[rname]
 
-        self.total = total
-        self.mapped = mapped
-        self.unmapped = unmapped
+        self.total = counts.total
+        self.mapped = counts.mapped
+        self.unmapped = counts.unmapped
         self.flag_counts = flag_counts
-        self.tagbins = tagbins
+        self.tagbins = {}
         self.refs = refs
-        self.regiontagger = regiontagger
+        self.regiontagger = None
 
     def distribution_gen(self, tag):
         acc = 0.0
@@ -287,7 +405,144 @@ class BamStats(object):
             yield (val, count, pct)
 
 
-def bam_stats(infiles, gtf_file=None, region=None, delim=None, tags=[], show_all=False):
+def _parallel_stats(fnames, gtf=None, delim=None, tags=[], show_all=False, procs=2):
+    '''
+    Calculates the counts for each file, using a pool of worker processes.
+
+    If a BAM file is indexed, each reference (and the unplaced reads) is
+    counted separately. Otherwise, the file is counted by one worker. All
+    of the files are counted at the same time.
+
+    Reads with multiple mappings (IH > 1) should only be counted once (the
+    first time they are seen in the file). Each worker only keeps the names
+    for its reference, and returns them as a sorted array of 64-bit hashes.
+    If a name was already counted on an earlier reference, the later
+    reference is counted again, skipping those names.
+
+    Returns a StatsCounts for each file.
+    '''
+    global _stats_state
+
+    jobs = []
+    for i, fname in enumerate(fnames):
+        if os.path.exists('%s.bai' % fname):
+            bam = bam_open(fname)
+            for tid in xrange(len(bam.references)):
+                jobs.append((i, tid, None))
+            jobs.append((i, -1, None))
+            bam.close()
+        else:
+            jobs.append((i, None, None))
+
+    if gtf:
+        # built once here (instead of in each worker)
+        regiontagger = RegionTagger(gtf, only_first_fragment=True)
+    else:
+        regiontagger = None
+
+    _stats_state = (fnames, delim, tags, show_all, regiontagger)
+
+    pool = multiprocessing.Pool(procs)
+    try:
+        partials = {}
+        for key, counts, hashes in pool.imap_unordered(_stats_job, jobs):
+            partials[key] = (counts, hashes)
+
+        # find the names that were already counted on an earlier reference
+        recount = []
+        for i in xrange(len(fnames)):
+            file_jobs = [job for job in jobs if job[0] == i]
+            arrays = [partials[job[:2]][1] for job in file_jobs]
+            hashes = numpy.concatenate(arrays)
+            if not len(hashes):
+                continue
+
+            # the names in each job are unique, so any name that isn't at
+            # the index of its first occurrence was seen in an earlier job
+            job_idx = numpy.repeat(numpy.arange(len(arrays)), [len(x) for x in arrays])
+            uniq, first, inverse = numpy.unique(hashes, return_index=True, return_inverse=True)
+            dups = first[inverse] != numpy.arange(len(hashes))
+            if not dups.any():
+                continue
+
+            dup_jobs = job_idx[dups]
+            bounds = numpy.flatnonzero(numpy.diff(dup_jobs)) + 1
+            for j, exclude in zip(dup_jobs[numpy.concatenate([[0], bounds])].tolist(), numpy.split(hashes[dups], bounds)):
+                recount.append((i, file_jobs[j][1], exclude))
+
+        for key, counts, hashes in pool.imap_unordered(_stats_job, recount):
+            partials[key] = (counts, hashes)
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _stats_state = None
+
+    results = []
+    for i, fname in enumerate(fnames):
+        bam = bam_open(fname)
+        if regiontagger:
+            tagger = copy.copy(regiontagger)
+            tagger.counts = dict.fromkeys(regiontagger.counts, 0)
+        else:
+            tagger = None
+
+        counts = StatsCounts(bam.references, delim, tags, tagger)
+        bam.close()
+
+        for job in jobs:
+            if job[0] == i:
+                counts.merge(partials[job[:2]][0])
+
+        results.append(counts)
+
+    return results
+
+
+_stats_state = None
+
+
+class _RegionCounts(object):
+    'The counts from a RegionTagger (without the regions)'
+    def __init__(self, counts):
+        self.counts = counts
+
+
+def _stats_job(job):
+    'Worker process: counts the reads for one reference (tid), the unplaced reads (-1) or a whole file (None)'
+    file_num, tid, exclude = job
+    fnames, delim, tags, show_all, regiontagger = _stats_state
+
+    bam = bam_open(fnames[file_num])
+
+    if regiontagger:
+        regiontagger.counts = dict.fromkeys(regiontagger.counts, 0)
+
+    counts = StatsCounts(bam.references, delim, tags, regiontagger)
+
+    if tid is None:
+        reads = bam_iter(bam, quiet=True)
+    elif tid < 0:
+        reads = bam_unmapped_iter(bam)
+    else:
+        reads = bam.fetch(bam.references[tid], 0, bam.lengths[tid])
+
+    if exclude is not None:
+        exclude = set(exclude.tolist())
+
+    names = _count_reads(bam, reads, counts, show_all, exclude=exclude)
+    bam.close()
+
+    if regiontagger:
+        # only the counts are sent back
+        counts.regiontagger = _RegionCounts(regiontagger.counts)
+
+    hashes = numpy.array(sorted(names), dtype=numpy.int64)
+    return (file_num, tid), counts, hashes
+
+
+def bam_stats(infiles, gtf_file=None, region=None, delim=None, tags=[], show_all=False, cache_enabled=True, procs=1):
     if gtf_file:
         gtf = GTF(gtf_file)
     else:
@@ -295,7 +550,10 @@ def bam_stats(infiles, gtf_file=None, region=None, delim=None, tags=[], show_all
 
     sys.stderr.write('Calculating Read stats...\n')
 
-    stats = [BamStats(bam_open(x), gtf, region, delim, tags, show_all=show_all) for x in infiles]
+    if procs > 1 and not region and (gtf or tags or not cache_enabled):
+        stats = [BamStats(None, counts=x) for x in _parallel_stats(infiles, gtf, delim, tags, show_all, procs)]
+    else:
+        stats = [BamStats(bam_open(x), gtf, region, delim, tags, show_all=show_all, cache_enabled=cache_enabled) for x in infiles]
 
     sys.stdout.write('\t')
     for fname, stat in zip(infiles, stats):
@@ -451,6 +709,8 @@ if __name__ == '__main__':
     region = None
     delim = None
     show_all = False
+    cache_enabled = True
+    procs = 1
     tags = []
 
     last = None
@@ -471,7 +731,12 @@ if __name__ == '__main__':
             last = None
         elif arg == '-all':
             show_all = True
-        elif arg in ['-gtf', '-delim', '-tags', '-region']:
+        elif last == '-p':
+            procs = positive_int_arg('-p', arg, usage)
+            last = None
+        elif arg == '-nocache':
+            cache_enabled = False
+        elif arg in ['-gtf', '-delim', '-tags', '-region', '-p']:
             last = arg
         elif os.path.exists(arg):
             infiles.append(arg)
@@ -482,4 +747,4 @@ if __name__ == '__main__':
     if not infiles:
         usage()
     else:
-        bam_stats(infiles, gtf, region, delim, tags, show_all=show_all)
+        bam_stats(infiles, gtf, region, delim, tags, show_all=show_all, cache_enabled=cache_enabled, procs=procs)
@@ -0,0 +1,146 @@
+'''
+Summary sidecar files for BAM files
+
+Finding the number of mapped reads requires a full pass through a BAM file.
+This is needed to normalize counts (bamutils count -norm all) and for simple
+stats (bamutils stats). Instead of re-reading the BAM file each time, the
+totals are stored in a sidecar file next to the BAM file (sample.bam.ngsstats).
+
+The sidecar file is keyed on the size and mtime of the BAM file and a checksum
+of its header (see ngsutils.support.sidecar). If any of these change, the
+summary is regenerated.
+
+Stored values:
+    mapped_reads - number of mapped reads, where reads with multiple mappings
+                   (IH/NH > 1) are only counted once
+    all          - total / mapped / unmapped / flag / reference counts for
+                   all fragments
+    first        - the same counts, for only the first fragment of paired reads
+
+For the 'all' and 'first' counts, reads with an IH tag > 1 are only counted
+once (the same as bamutils stats).
+'''
+
+import hashlib
+import sys
+
+from ngsutils.bam import bam_iter, bam_open
+from ngsutils.support import sidecar
+
+
+flag_bits = [0x1, 0x2, 0x4, 0x8, 0x10, 0x20, 0x40, 0x80, 0x100, 0x200, 0x400]
+
+
+class SummaryCounts(object):
+    'Total, mapped, unmapped, flag, and reference counts for a BAM file'
+    def __init__(self, references):
+        self.total = 0
+        self.mapped = 0
+        self.unmapped = 0
+        self.flags = {}
+        self.refs = {}
+
+        for bit in flag_bits:
+            self.flags[bit] = 0
+
+        for ref in references:
+            self.refs[ref] = 0
+
+    def add(self, read, rname):
+        self.total += 1
+        for bit in flag_bits:
+            if read.flag & bit:
+                self.flags[bit] += 1
+
+        if read.is_unmapped:
+            self.unmapped += 1
+        else:
+            self.mapped += 1
+            self.refs[rname] += 1
+
+
+class BamSummary(object):
+    _version = 2
+
+    def __init__(self, fname, cache_enabled=True, quiet=False):
+        self.fname = fname
+        self.cachefile = '%s.ngsstats' % fname
+
+        bam = bam_open(fname)
+        key = _summary_key(fname, bam)
+
+        if not cache_enabled or not self._load_cache(key):
+            self._calc(bam, quiet)
+            if cache_enabled:
+                try:
+                    self._write_cache(key)
+                except Exception, e:
+                    if not quiet:
+                        sys.stderr.write("Error saving BAM summary: %s!\n" % str(e))
+
+        bam.close()
+
+    def _calc(self, bam, quiet=False):
+        if not quiet:
+            sys.stderr.write('Calculating BAM summary (%s)...\n' % self.fname)
+
+        self.mapped_reads = 0
+        self.all = SummaryCounts(bam.references)
+        self.first = SummaryCounts(bam.references)
+
+        multinames = set()
+        all_names = set()
+        first_names = set()
+
+        for read in bam_iter(bam, quiet=quiet):
+            rname = bam.getrname(read.tid) if not read.is_unmapped else None
+
+            try:
+                ih = int(read.opt('IH'))
+                has_ih = True
+            except KeyError:
+                has_ih = False
+                try:
+                    ih = int(read.opt('NH'))
+                except KeyError:
+                    ih = 1
+
+            # mapped reads (multiple mappings count once) for normalization
+            if not read.is_unmapped and not read.qname in multinames:
+                self.mapped_reads += 1
+                if ih > 1:
+                    multinames.add(read.qname)
+
+            # counts for bamutils stats (IH > 1 counted once)
+            if has_ih and ih > 1:
+                if not read.qname in all_names:
+                    all_names.add(read.qname)
+                    self.all.add(read, rname)
+            else:
+                self.all.add(read, rname)
+
+            if read.is_paired and not read.is_read1:
+                continue
+
+            if has_ih and ih > 1:
+                if not read.qname in first_names:
+                    first_names.add(read.qname)
+                    self.first.add(read, rname)
+            else:
+                self.first.add(read, rname)
+
+    def _load_cache(self, key):
+        values = sidecar.load(self.cachefile, BamSummary._version, key)
+        if not values:
+            return False
+
+        self.mapped_reads, self.all, self.first = values
+        return True
+
+    def _write_cache(self, key):
+        sidecar.save(self.cachefile, BamSummary._version, key, (self.mapped_reads, self.all, self.first))
+
+
+def _summary_key(fname, bam):
+    return sidecar.file_key(fname) + (hashlib.md5(bam.text).hexdigest(),)
+
@@ -107,7 +107,7 @@ class MockBam(object):
     def pileup(self, ref, start, end):
         ''' A cheap pileup knock-off using BamBaseCaller '''
 
-        basecaller = ngsutils.bam.basecall.BamBaseCaller(self, regions=ngsutils.bed.BedFile(region='%s:%s-%s' % (ref, start + 1, end)))
+        basecaller = ngsutils.bam.basecall.BamBaseCaller(self, regions=ngsutils.bed.BedFile(region='%s:%s-%s' % (ref, start + 1, end)), keep_reads=True)
         for basepos in basecaller.fetch():
             pileups = []
             for record in basepos.reads:
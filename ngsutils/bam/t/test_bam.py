@@ -8,13 +8,23 @@ import doctest
 
 import ngsutils.bam
 import ngsutils.bam.convertregion
+import ngsutils.bam.coverage
 import ngsutils.bam.count.count
+import ngsutils.bam.export
+import ngsutils.bam.peakheight
+import ngsutils.bam.regionindex
+import ngsutils.bam.tobedgraph
 
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(ngsutils.bam))
     tests.addTests(doctest.DocTestSuite(ngsutils.bam.convertregion))
+    tests.addTests(doctest.DocTestSuite(ngsutils.bam.coverage))
     tests.addTests(doctest.DocTestSuite(ngsutils.bam.count.count))
+    tests.addTests(doctest.DocTestSuite(ngsutils.bam.export))
+    tests.addTests(doctest.DocTestSuite(ngsutils.bam.peakheight))
+    tests.addTests(doctest.DocTestSuite(ngsutils.bam.regionindex))
+    tests.addTests(doctest.DocTestSuite(ngsutils.bam.tobedgraph))
     return tests
 
 if __name__ == '__main__':
@@ -10,6 +10,7 @@ import unittest
 from ngsutils.bam.t import MockBam
 from ngsutils.bed import BedFile
 import ngsutils.bam.basecall
+import ngsutils.bam.parallel
 
 
 class BaseCallTest(unittest.TestCase):
@@ -136,6 +137,32 @@ test2|5|A|4|A||1.0|1.87433193885|4|0|0|0|0|0|0|0||0.75|0.25|0.0|0.0|0.0|0.0|0.0|
 test2|6|T|4|T/C||1.0|2.94335833285|0|2|0|2|0|0|0|0||0.75|0.0|0.5|0.0|0.0|0.0|0.0|0.0
 test2|7|C|4|C|T|1.0|3.45990045591|0|3|0|1|0|0|0|0||0.75|0.0|0.333333333333|0.0|0.0|0.0|0.0|0.0
 test2|8|G|4|G||1.0|1.87433193885|0|0|4|0|0|0|0|0||0.75|0.0|0.0|0.25|0.0|0.0|0.0|0.0
+'''.replace('|', '\t')
+
+        self.assertEqual(valid, out.getvalue())
+
+    def testBaseCallRegionSpanning(self):
+        # foo1 is in both regions, but should only be counted once
+        bam = MockBam(['test2'])
+        bam.add_read('foo1', 'atatcg', '......', 0, 0, aend=12, cigar='2M6N4M')
+        bam.add_read('foo2', 'atcg', '....', 0, 8, cigar='4M')
+
+        bed = BedFile(fileobj=StringIO.StringIO('''\
+test2|0|2
+test2|8|11
+'''.replace('|', '\t')))
+
+        out = StringIO.StringIO('')
+        ngsutils.bam.basecall.bam_basecall(bam, os.path.join(os.path.dirname(__file__), 'test.fa'), regions=bed, showgaps=True, quiet=True, out=out)
+
+        valid = '''chrom|pos|ref|count|consensus call|minor call|ave mappings|entropy|A|C|G|T|N|Deletions|Gaps|Insertions|Inserts
+test2|1|A|1|A||1.0|0.91686730441|1|0|0|0|0|0|0|0|
+test2|2|T|1|T||1.0|3.25488750216|0|0|0|1|0|0|0|0|
+test2|3|C|0|N||0|0|0|0|0|0|0|0|1|0|
+test2|9|A|2|A||1.0|1.36179536943|2|0|0|0|0|0|0|0|
+test2|10|T|2|T||1.0|4.24102241591|0|0|0|2|0|0|0|0|
+test2|11|C|2|C||1.0|4.24102241591|0|2|0|0|0|0|0|0|
+test2|12|G|2|G||1.0|1.36179536943|0|0|2|0|0|0|0|0|
 '''.replace('|', '\t')
 
         self.assertEqual(valid, out.getvalue())
@@ -241,5 +268,26 @@ test2|12|G|2|G||1.5|1.36179536943|0|0|2|0|0|0|0|0|
         self.assertEqual(0.5, ngsutils.bam.basecall._calculate_heterozygosity(5, 5, 0, 0))
         self.assertEqual(0.1, ngsutils.bam.basecall._calculate_heterozygosity(9, 1, 0, 0))
 
+    def testBaseCallParallel(self):
+        bam = MockBam(['test1', 'test2'], lengths=[10, 16])
+        bam.add_read('foo1', 'aaaaTaaaa', '.........', 0, 0, cigar='5M1I3M')
+        bam.add_read('foo2', 'aaaaaaa', 'AAAAAAA', 0, 2, cigar='5M1D2M')
+        bam.add_read('foo3', 'atcgatcg', '........', 1, 0, cigar='8M')
+        bam.add_read('foo4', 'atcgatcg', 'AAAAAAAA', 1, 4, cigar='8M')
+
+        serial = StringIO.StringIO('')
+        ngsutils.bam.basecall.bam_basecall(bam, os.path.join(os.path.dirname(__file__), 'test.fa'), quiet=True, out=serial)
+
+        shard_size = ngsutils.bam.parallel.DEFAULT_SHARD_SIZE
+        ngsutils.bam.parallel.DEFAULT_SHARD_SIZE = 5
+        try:
+            parallel = StringIO.StringIO('')
+            ngsutils.bam.basecall.bam_basecall(bam, os.path.join(os.path.dirname(__file__), 'test.fa'), quiet=True, out=parallel, procs=2)
+        finally:
+            ngsutils.bam.parallel.DEFAULT_SHARD_SIZE = shard_size
+
+        self.assertEqual(len(serial.getvalue().split('\n')), 24)
+        self.assertEqual(serial.getvalue(), parallel.getvalue())
+
 if __name__ == '__main__':
     unittest.main()
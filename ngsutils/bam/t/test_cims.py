@@ -4,12 +4,60 @@ Tests for bamutils cims
 '''
 
 import unittest
+import StringIO
+
+from ngsutils.bam.t import MockBam, MockRead
+import ngsutils.bam.cims
 
 
 class CIMSTest(unittest.TestCase):
-    def testCIMS1(self):
-        'MISSING TEST/EXPERIMENTAL'
-        pass
+    def setUp(self):
+        self.bam = MockBam(['chr1', 'chr2'])
+        self.bam.add_read('A', tid=0, pos=100, cigar='10M2D10M', aend=122)
+        self.bam.add_read('B', tid=0, pos=102, cigar='18M')
+        self.bam.add_read('C', tid=0, pos=104, cigar='6M2D10M', aend=122)
+        self.bam.add_read('D', tid=0, pos=105, cigar='5M100N1D10M', aend=221)  # deletion after a gap isn't counted
+        self.bam.add_read('E', tid=0, pos=150, cigar='5M1D5M', aend=161, is_reverse=True)
+        self.bam.add_read('F', tid=0, pos=150, cigar='5M1D5M', aend=161, is_qcfail=True)
+        self.bam.add_read('G', tid=1, pos=10, cigar='5M1D5M', aend=21)
+        self.bam.add_read('H', tid=1, pos=10, cigar='11M', is_reverse=True)
+
+    def testHits(self):
+        hits = list(ngsutils.bam.cims._cims_hits(self.bam, self.bam.fetch(), ['+', '-'], 0.1))
+        self.assertEqual(sorted(hits), sorted([('+', 'chr1', 110), ('+', 'chr1', 111), ('-', 'chr1', 155), ('+', 'chr2', 15)]))
+
+        # 2 of 3 reads at chr1:110 and 111
+        hits = list(ngsutils.bam.cims._cims_hits(self.bam, self.bam.fetch(), ['+', '-'], 0.7))
+        self.assertEqual(sorted(hits), sorted([('-', 'chr1', 155), ('+', 'chr2', 15)]))
+
+        # unstranded, 1 of 2 reads at chr2:15
+        hits = list(ngsutils.bam.cims._cims_hits(self.bam, self.bam.fetch(), [''], 0.4))
+        self.assertEqual(sorted(hits), sorted([('', 'chr1', 110), ('', 'chr1', 111), ('', 'chr1', 155), ('', 'chr2', 15)]))
+
+    def testSpan(self):
+        hits = list(ngsutils.bam.cims._cims_hits(self.bam, self.bam.fetch(), ['+', '-'], 0.1, (111, 200)))
+        self.assertEqual(sorted(hits), sorted([('+', 'chr1', 111), ('-', 'chr1', 155)]))
+
+    def testWindow(self):
+        counts = ngsutils.bam.cims.StrandCounts(0, 4)
+        counts.add(MockRead('A', tid=0, pos=0, cigar='2M1D2M', aend=5))
+        self.assertEqual(counts.flush(0.1, 1), [])
+        counts.add(MockRead('B', tid=0, pos=1, cigar='1M100N1M1D2M', aend=106))
+        self.assertEqual(counts.flush(0.1, 3), [2])
+        self.assertEqual(counts.flush(0.1), [103])
+        self.assertEqual(counts.flush(0.1), [])
+
+    def testRegions(self):
+        out = StringIO.StringIO()
+        emitter = ngsutils.bam.cims.BEDEmitter(out)
+        hits = ngsutils.bam.cims._cims_hits(self.bam, self.bam.fetch(), ['+', '-'], 0.1)
+        ngsutils.bam.cims._cims_regions(emitter, hits, ['+', '-'], 20)
+        self.assertEqual(out.getvalue(), '''\
+chr1\t110\t111\tregion_1\t0\t+
+chr2\t15\t15\tregion_2\t0\t+
+chr1\t155\t155\tregion_3\t0\t-
+''')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -4,10 +4,13 @@ Tests for bamutils convertregion
 '''
 
 import os
+import shutil
+import tempfile
 import unittest
 
 import ngsutils.bam
 import ngsutils.bam.convertregion
+from ngsutils.bam.regionindex import RegionIndex
 
 infname = os.path.join(os.path.dirname(__file__), 'test3.bam')
 outfname = os.path.join(os.path.dirname(__file__), 'tmp-convert.bam')
@@ -69,7 +72,44 @@ class ConvertRegionTest(unittest.TestCase):
 
     def tearDown(self):
         outfname = os.path.join(os.path.dirname(__file__), 'tmp-convert.bam')
-        os.unlink(outfname)
+        if os.path.exists(outfname):
+            os.unlink(outfname)
+        for fname in ['%s.ngsregions' % infname, '%s.ngsregions.idx' % infname]:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+
+class RegionIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'test.bam')
+        shutil.copy(infname, self.fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testIndex(self):
+        bam = ngsutils.bam.bam_open(self.fname)
+        index = RegionIndex(bam, quiet=True)
+        self.assertTrue(index.built)
+        self.assertTrue(os.path.exists('%s.ngsregions' % self.fname))
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.fragments(0), ('chr1', [(100, 200), (300, 400)]))
+        self.assertEqual(index.convert(0, 74, [(0, 50)]), ('chr1', 174, [(0, 26), (3, 100), (0, 24)]))
+        self.assertEqual(index.convert_many([0, 0], [9, 97], [[(0, 50)], [(0, 50)]]), [('chr1', 109, [(0, 50)]), ('chr1', 197, [(0, 3), (3, 100), (0, 47)])])
+        self.assertRaises(ValueError, index.fragments, -1)
+        index.close()
+
+        index = RegionIndex(bam, quiet=True)
+        self.assertFalse(index.built)
+        self.assertEqual(index.fragments(0), ('chr1', [(100, 200), (300, 400)]))
+        index.close()
+
+        index = RegionIndex(bam, cache_enabled=False, quiet=True)
+        self.assertTrue(index.built)
+        self.assertEqual(index.fragments(0), ('chr1', [(100, 200), (300, 400)]))
+        index.close()
+        bam.close()
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,12 +3,16 @@
 Tests for bamutils count
 '''
 
+import os
+import shutil
+import tempfile
 import unittest
 import StringIO
 
 import ngsutils.bam
 import ngsutils.bam.count
 import ngsutils.bam.count.models
+import ngsutils.bam.count.count
 
 from ngsutils.bam.t import MockBam
 
@@ -336,6 +340,186 @@ chr1|300|350|foo|1|-|50|1
 
         self.assertEquals(out.getvalue(), valid)
 
+    def testCountBedSweep(self):
+        bed = '''
+chr1|120|140|foo|1|+
+chr1|110|230|bar|1|-
+chr1|210|240|baz|1|+
+chr1|320|330|qux|1|-
+chr1|500|600|empty|1|+
+chr2|10|20|missing|1|+
+'''.replace('|', '\t')
+
+        for kwargs in [{}, {'stranded': True}, {'uniq_only': True}, {'multiple': 'ignore'},
+                       {'start_only': True}, {'norm': 'mapped'}, {'coverage': True},
+                       {'blacklist': ['foo2', 'foo9']}, {'whitelist': ['foo2', 'foo3', 'foo11']}]:
+            out = StringIO.StringIO('')
+            ngsutils.bam.count.models['bed'](fileobj=StringIO.StringIO(bed)).count(testbam1, out=out, quiet=True, **kwargs)
+
+            sweep_out = StringIO.StringIO('')
+            ngsutils.bam.count.models['bed'](fileobj=StringIO.StringIO(bed)).count(testbam1, out=sweep_out, quiet=True, sweep=True, **kwargs)
+
+            self.assertEquals(sweep_out.getvalue(), out.getvalue())
+
+    def testSweepMultipleSpans(self):
+        regions = [('chr1', [110, 205, 310], [120, 215, 320], '+', ['a'], None),
+                   ('chr1', [105, 305], [112, 306], '-', ['b'], None),
+                   ('chr1', [210], [240], '+', ['c'], None),
+                   ('chr1', [1010, 120], [1020, 130], '+', ['d'], None)]
+
+        for stranded, uniq, multiple, start_only in [(False, False, 'complete', False),
+                                                     (True, False, 'complete', False),
+                                                     (False, True, 'complete', False),
+                                                     (False, True, 'partial', False),
+                                                     (False, False, 'partial', True)]:
+            fetched = list(ngsutils.bam.count.count._fetch_region_counts(testbam1, regions, stranded, multiple, uniq=uniq, start_only=start_only))
+            swept = list(ngsutils.bam.count.count._sweep_region_counts(testbam1, regions, stranded, multiple, uniq=uniq, start_only=start_only))
+            self.assertEquals(swept, fetched)
+
+    def testSweepUniqReplaced(self):
+        # A is seen first by the sweep (second span), but the per-span fetch
+        # sees B first (first span), so B is the read that is kept
+        bam = MockBam(['chr1'])
+        bam.add_read('A', 'A' * 5, tid=0, pos=100, cigar='5M')
+        bam.add_read('B', 'A' * 205, tid=0, pos=100, cigar='205M')
+        regions = [('chr1', [300, 100], [310, 110], '+', ['a'], None)]
+
+        fetched = list(ngsutils.bam.count.count._fetch_region_counts(bam, regions, False, 'complete', uniq=True))
+        swept = list(ngsutils.bam.count.count._sweep_region_counts(bam, regions, False, 'complete', uniq=True))
+        self.assertEquals(swept, fetched)
+        self.assertEquals(swept[0][-1], set(['B']))
+
+    def testCountBedParallel(self):
+        bam = ngsutils.bam.bam_open(os.path.join(os.path.dirname(__file__), 'test.bam'))
+        bed = '''
+chr1|90|160|foo|1|+
+chr2|100|200|bar|1|+
+chr1|150|250|baz|1|+
+chr3|100|200|missing|1|+
+chr1|400|900|qux|1|-
+'''.replace('|', '\t')
+
+        for kwargs in [{}, {'norm': 'all'}, {'norm': 'mapped'}, {'sweep': True}, {'stranded': True}]:
+            out = StringIO.StringIO('')
+            ngsutils.bam.count.models['bed'](fileobj=StringIO.StringIO(bed)).count(bam, out=out, quiet=True, **kwargs)
+
+            par_out = StringIO.StringIO('')
+            ngsutils.bam.count.models['bed'](fileobj=StringIO.StringIO(bed)).count(bam, out=par_out, quiet=True, procs=2, **kwargs)
+
+            self.assertEquals(par_out.getvalue(), out.getvalue())
+
+        bam.close()
+        if os.path.exists('%s.ngsstats' % bam.filename):
+            os.unlink('%s.ngsstats' % bam.filename)
+
+    def testCountParallelError(self):
+        '''
+        The shard files are removed if a worker fails
+        '''
+        class BadList(object):
+            def __contains__(self, qname):
+                raise ValueError(qname)
+
+        bam = ngsutils.bam.bam_open(os.path.join(os.path.dirname(__file__), 'test.bam'))
+        bed = 'chr1\t90\t160\tfoo\t1\t+\nchr2\t100\t200\tbar\t1\t+\n'
+
+        tmpdir = tempfile.mkdtemp()
+        orig_tempdir = tempfile.tempdir
+        tempfile.tempdir = tmpdir
+        try:
+            model = ngsutils.bam.count.models['bed'](fileobj=StringIO.StringIO(bed))
+            self.assertRaises(ValueError, model.count, bam, out=StringIO.StringIO(''), quiet=True, procs=2, blacklist=BadList())
+            self.assertEqual(os.listdir(tmpdir), [])
+        finally:
+            tempfile.tempdir = orig_tempdir
+            shutil.rmtree(tmpdir)
+            bam.close()
+
+    def testReadCache(self):
+        bam = ngsutils.bam.bam_open(os.path.join(os.path.dirname(__file__), 'test.bam'))
+        cache = ngsutils.bam.count.count.ReadCache(bam, 'chr1', 100, 760)
+
+        def _reads(src, starts, ends, exclusive):
+            count, reads = ngsutils.bam.count.count._fetch_reads(src, 'chr1', None, starts, ends, 'complete', exclusive)
+            return count, sorted(reads)
+
+        def _excluding(src, start, end):
+            count, reads = ngsutils.bam.count.count._fetch_reads_excluding(src, 'chr1', None, start, end, 'complete')
+            return count, sorted(reads)
+
+        for starts, ends in [([100], [150]), ([150], [420]), ([190], [420]), ([100, 430], [160, 700]), ([700], [760])]:
+            self.assertEqual(_reads(cache, starts, ends, False), _reads(bam, starts, ends, False))
+            self.assertEqual(_reads(cache, starts, ends, True), _reads(bam, starts, ends, True))
+
+        for start, end in [(190, 420), (210, 420), (430, 460), (490, 700)]:
+            self.assertEqual(_excluding(cache, start, end), _excluding(bam, start, end))
+
+        self.assertEqual(_excluding(cache, 210, 420), (1, ['E']))
+        bam.close()
+
+    def testBinCounts(self):
+        bam = ngsutils.bam.bam_open(os.path.join(os.path.dirname(__file__), 'test.bam'))
+
+        for stranded in [True, False]:
+            for multiple in ['complete', 'partial', 'ignore']:
+                for uniq in [True, False]:
+                    for start_only in [True, False]:
+                        bins = ngsutils.bam.count.count._bin_counts(bam, 'chr1', 2000, 100, stranded, multiple, uniq=uniq, start_only=start_only)
+                        for strand in (['+', '-'] if stranded else [None]):
+                            self.assertEqual(len(bins[strand]), 20)
+                            for i, start in enumerate(xrange(0, 2000, 100)):
+                                count, reads = ngsutils.bam.count.count._fetch_reads(bam, 'chr1', strand, [start], [start + 100], multiple, False, uniq=uniq, start_only=start_only)
+                                self.assertEqual(bins[strand][i], count)
+
+        bins = ngsutils.bam.count.count._bin_counts(bam, 'chr1', 2000, 100, False, 'complete')
+        self.assertEqual(bins[None][:8], [1, 3, 2, 2, 4, 2, 2, 3])
+
+        bam.close()
+
+    def testBinCountsChunks(self):
+        bam = MockBam(['chr1'])
+        for i, pos in enumerate([100, 100, 101, 120, 120, 150, 150, 150, 199, 210, 210, 260]):
+            bam.add_read('fwd%s' % i, 'A' * 50, tid=0, pos=pos, cigar='50M', tags=[('IH', 1 + i % 2)])
+            bam.add_read('rev%s' % i, 'A' * 50, tid=0, pos=pos - i % 3, cigar='50M', tags=[('IH', 1)], is_reverse=True)
+
+        for stranded in [True, False]:
+            for multiple in ['complete', 'partial', 'ignore']:
+                for uniq in [True, False]:
+                    for start_only in [True, False]:
+                        bins = ngsutils.bam.count.count._bin_counts(bam, 'chr1', 400, 50, stranded, multiple, uniq=uniq, start_only=start_only)
+                        for chunk_size in [1, 2, 5]:
+                            self.assertEqual(ngsutils.bam.count.count._bin_counts(bam, 'chr1', 400, 50, stranded, multiple, uniq=uniq, start_only=start_only, chunk_size=chunk_size), bins)
+
+        # duplicate starts are only counted once, even across chunks
+        self.assertEqual(ngsutils.bam.count.count._bin_counts(bam, 'chr1', 400, 50, False, 'complete', chunk_size=2), {None: [0, 2, 12, 13, 6, 6, 2, 0]})
+        self.assertEqual(ngsutils.bam.count.count._bin_counts(bam, 'chr1', 400, 50, False, 'complete', uniq=True, chunk_size=2), {None: [0, 1, 9, 10, 5, 5, 2, 0]})
+
+    def testCountBin(self):
+        bam = ngsutils.bam.bam_open(os.path.join(os.path.dirname(__file__), 'test.bam'))
+        out = StringIO.StringIO('')
+        ngsutils.bam.count.models['bin'](500).count(bam, stranded=True, out=out, quiet=True)
+
+        valid = '''chr1|0|500|+|500|5
+chr1|0|500|-|500|0
+chr1|500|1000|+|500|2
+chr1|500|1000|-|500|1
+chr1|1000|1500|+|500|0
+chr1|1000|1500|-|500|0
+chr1|1500|2000|+|500|0
+chr1|1500|2000|-|500|0
+chr2|0|500|+|500|0
+chr2|0|500|-|500|0
+chr2|500|1000|+|500|0
+chr2|500|1000|-|500|0
+chr2|1000|1500|+|500|0
+chr2|1000|1500|-|500|0
+chr2|1500|2000|+|500|0
+chr2|1500|2000|-|500|0
+'''.replace('|', '\t')
+
+        self.assertEqual(valid, ''.join([x for x in out.getvalue().splitlines(True) if x[0] != '#']))
+        bam.close()
+
 
 def dump(s, t):
     print 'valid:'
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.bam.coverage (and bamutils peakheight)
+'''
+
+import unittest
+import StringIO
+
+import ngsutils.bam.coverage
+import ngsutils.bam.peakheight
+
+from ngsutils.bam.t import MockBam
+
+testbam = MockBam(['chr1', 'chr2'])
+testbam.add_read('foo1', 'A' * 50, tid=0, pos=100, cigar='50M')
+testbam.add_read('foo2', 'A' * 50, tid=0, pos=110, cigar='50M', is_reverse=True)
+testbam.add_read('foo3', 'A' * 50, tid=0, pos=120, aend=270, cigar='10M10D10M100N30M')
+testbam.add_read('foo4', 'A' * 50, tid=0, pos=130, cigar='5S40M5S', is_qcfail=True)
+testbam.add_read('foo5', 'A' * 50, tid=1, pos=100, cigar='50M')
+
+
+class CoverageTest(unittest.TestCase):
+    def testDepth(self):
+        depth = ngsutils.bam.coverage.region_depth(testbam, 'chr1', 95, 175)
+        self.assertEqual(depth.tolist(), [0] * 5 + [1] * 10 + [2] * 10 + [3] * 10 + [2] * 10 + [3] * 10 + [1] * 10 + [0] * 15)
+
+    def testDepthStrand(self):
+        depth = ngsutils.bam.coverage.region_depth(testbam, 'chr1', 100, 130, strand='-')
+        self.assertEqual(depth.tolist(), [0] * 10 + [1] * 20)
+
+        depth = ngsutils.bam.coverage.region_depth(testbam, 'chr1', 100, 130, strand='+')
+        self.assertEqual(depth.tolist(), [1] * 20 + [2] * 10)
+
+    def testDepthSplice(self):
+        # deletions and introns aren't counted
+        reads = set()
+        depth = ngsutils.bam.coverage.region_depth(testbam, 'chr1', 160, 300, reads=reads)
+        self.assertEqual(depth.tolist(), [0] * 90 + [1] * 30 + [0] * 20)
+        self.assertEqual(reads, set(['foo3']))
+
+    def testDepthFilter(self):
+        depth = ngsutils.bam.coverage.region_depth(testbam, 'chr1', 135, 140, blacklist=set(['foo2']))
+        self.assertEqual(depth.tolist(), [1] * 5)
+
+        depth = ngsutils.bam.coverage.region_depth(testbam, 'chr1', 135, 140, whitelist=set(['foo2']))
+        self.assertEqual(depth.tolist(), [1] * 5)
+
+        depth = ngsutils.bam.coverage.region_depth(testbam, 'chr1', 135, 140, mask=0)
+        self.assertEqual(depth.tolist(), [3] * 5)
+
+    def testDepthMissing(self):
+        self.assertEqual(ngsutils.bam.coverage.region_depth(testbam, 'chr3', 100, 105).tolist(), [0] * 5)
+        self.assertEqual(ngsutils.bam.coverage.regions_depth(testbam, 'chr1', [100, 200], [105, 205]).tolist(), [1] * 5 + [0] * 5)
+
+    def testPeakHeight(self):
+        bed = StringIO.StringIO('chr1\t100\t150\tpeak1\nchr2\t90\t110\tpeak2\n')
+        out = StringIO.StringIO('')
+        ngsutils.bam.peakheight.bam_peakheight(testbam, bed, out=out)
+        self.assertEqual(out.getvalue(), 'chr1\t100\t150\tpeak1\t3\t3\t110\t2.2\nchr2\t90\t110\tpeak2\t1\t1\t10\t0.5\n')
+
+    def testPeakHeightOverlap(self):
+        # foo3 isn't counted for peak1 or peak5 (they are in its intron)
+        bed = StringIO.StringIO('chr1\t150\t170\tpeak1\nchr1\t100\t150\tpeak2\nchr3\t1\t5\tpeak3\nchr1\t145\t155\tpeak4\nchr1\t200\t230\tpeak5\n')
+        out = StringIO.StringIO('')
+        ngsutils.bam.peakheight.bam_peakheight([testbam, testbam], bed, out=out)
+        self.assertEqual(out.getvalue(), '''\
+chr1\t150\t170\tpeak1\t1\t1\t10\t0.5\t1\t1\t10\t0.5
+chr1\t100\t150\tpeak2\t3\t3\t110\t2.2\t3\t3\t110\t2.2
+chr3\t1\t5\tpeak3\t0\t0\t0\t0.0\t0\t0\t0\t0.0
+chr1\t145\t155\tpeak4\t3\t3\t20\t2.0\t3\t3\t20\t2.0
+chr1\t200\t230\tpeak5\t0\t0\t0\t0.0\t0\t0\t0\t0.0
+''')
+
+    def testPeakHeightFetch(self):
+        # the reads for each chromosome are fetched once, not once per cluster
+        fetches = []
+
+        class CountingBam(object):
+            references = testbam.references
+
+            def fetch(self, *args):
+                fetches.append(args)
+                return testbam.fetch(*args)
+
+        bed = StringIO.StringIO('chr1\t100\t110\tpeak1\nchr1\t130\t140\tpeak2\nchr1\t240\t260\tpeak3\nchr2\t90\t110\tpeak4\n')
+        out = StringIO.StringIO('')
+        ngsutils.bam.peakheight.bam_peakheight(CountingBam(), bed, out=out)
+        self.assertEqual(sorted(fetches), [('chr1', 100, 260), ('chr2', 90, 110)])
+        self.assertEqual(out.getvalue(), '''\
+chr1\t100\t110\tpeak1\t1\t1\t10\t1.0
+chr1\t130\t140\tpeak2\t2\t2\t20\t2.0
+chr1\t240\t260\tpeak3\t1\t1\t10\t0.5
+chr2\t90\t110\tpeak4\t1\t1\t10\t0.5
+''')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,8 +4,13 @@ Tests for bamutils export
 '''
 
 import StringIO
+import os
+import shutil
+import tempfile
 import unittest
 
+import numpy
+
 import ngsutils.bam
 import ngsutils.bam.export
 
@@ -61,6 +66,57 @@ class ExportTest(unittest.TestCase):
         self._run_test(testbam3, ['baz1|ZZ:Z:foo|ZY:i:100|ZX:f:1.0|ZW:A:a'], fields=['-name', '-tag:*'])
         self._run_test(testbam3, ['baz1|foo'], fields=['-name', '-tag:ZZ'])
 
+    def testMissing(self):
+        testbam = MockBam(['chr1'])
+        testbam.add_read('r1', tid=0, pos=0, aend=8, cigar='8M', tags=[('AS', 5)])
+        testbam.add_read('r2', tid=0, pos=10, aend=18, cigar='8M')
+        for read in testbam:
+            read.seq = None
+            read.qual = None
+            if read.qname == 'r2':
+                read.tags = []
+
+        self._run_test(testbam, ['r1|5|||1', 'r2||||11'], fields=['-name', '-tag:AS', '-seq', '-qual', '-pos'])
+        self._run_test(testbam, ['r1|AS:i:5|1', 'r2|11'], fields=['-name', '-tag:*', '-pos'])
+
+    def testCompile(self):
+        extractors = ngsutils.bam.export.compile_fields(testbam1, ['-name', '-strand', '-pos'])
+        self.assertEqual(len(extractors), 3)
+        self.assertEqual(sorted([[func(read) for func in extractors] for read in testbam1]), [['foo1', '+', 1], ['foo2', '-', 5], ['foo3', '+', 0]])
+        self.assertRaises(ValueError, ngsutils.bam.export.compile_fields, testbam1, ['-name', '-foo'])
+
+    def testColumns(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'out.npz')
+            ngsutils.bam.export.bam_export(testbam3, fields=['-name', '-pos', '-mapq', '-tag:ZY'], npz=fname, quiet=True)
+            arrays = numpy.load(fname)
+            self.assertEqual(sorted(arrays.files), ['mapq', 'name', 'pos', 'tag_ZY'])
+            self.assertEqual(arrays['name'].tolist(), ['baz1'])
+            self.assertEqual(arrays['pos'].tolist(), [1])
+            self.assertEqual(arrays['mapq'].tolist(), [10])
+            self.assertEqual(arrays['tag_ZY'].tolist(), ['100'])
+            arrays.close()
+
+            self.assertRaises(ValueError, ngsutils.bam.export.bam_export, testbam3, fields=['-tag:*'], npz=fname, quiet=True)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testParallel(self):
+        fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+        fields = ['-name', '-ref', '-pos', '-cigar', '-tag:*']
+
+        for kwargs in [{}, {'mapped': False}, {'unmapped': False}, {'whitelist': ['A', 'Z']}]:
+            bam = ngsutils.bam.bam_open(fname)
+            serial = StringIO.StringIO()
+            ngsutils.bam.export.bam_export(bam, fields=fields, out=serial, quiet=True, **kwargs)
+            parallel = StringIO.StringIO()
+            ngsutils.bam.export.bam_export(bam, fields=fields, out=parallel, quiet=True, procs=2, **kwargs)
+            bam.close()
+
+            self.assertTrue(serial.getvalue())
+            self.assertEqual(serial.getvalue(), parallel.getvalue())
+
 
     def _run_test(self, testbam, valid, *args, **kwargs):
         out = StringIO.StringIO('')
@@ -9,6 +9,8 @@ import unittest
 
 import ngsutils.bam
 import ngsutils.bam.expressed
+import ngsutils.bam.parallel
+from ngsutils.bam.t import MockBam
 
 infname = os.path.join(os.path.dirname(__file__), 'test4.bam')
 
@@ -34,6 +36,38 @@ class ExpressedTest(unittest.TestCase):
     def testExpressedLongMerge(self):
         self._run_test(['chr1|100|259|+', 'chr1|500|570|+', 'chr1|800|911|+'], merge_distance=11)
 
+    def testExpressedParallel(self):
+        shard_size = ngsutils.bam.parallel.DEFAULT_SHARD_SIZE
+        ngsutils.bam.parallel.DEFAULT_SHARD_SIZE = 100
+        try:
+            for kwargs in [{}, {'nostrand': True}, {'min_read_count': 1}, {'only_uniq_starts': True, 'merge_distance': 50}]:
+                ngsutils.bam.expressed.ExpressedRegion._count = 0
+                serial = StringIO.StringIO('')
+                ngsutils.bam.expressed.bam_find_regions(infname, out=serial, **kwargs)
+
+                ngsutils.bam.expressed.ExpressedRegion._count = 0
+                parallel = StringIO.StringIO('')
+                ngsutils.bam.expressed.bam_find_regions(infname, out=parallel, procs=2, **kwargs)
+
+                self.assertEqual(serial.getvalue(), parallel.getvalue())
+        finally:
+            ngsutils.bam.parallel.DEFAULT_SHARD_SIZE = shard_size
+
+    def testExpressedSpliced(self):
+        'The second block of a spliced read is added after reads that start before it'
+        bam = MockBam(['chr1'])
+        bam.add_read('A', tid=0, pos=100, cigar='20M200N20M')
+        bam.add_read('B', tid=0, pos=150, cigar='30M')
+        bam.add_read('C', tid=0, pos=325, cigar='20M')
+        bam.add_read('D', tid=0, pos=330, cigar='5M', is_qcfail=True)
+
+        ngsutils.bam.expressed.ExpressedRegion._count = 0
+        out = StringIO.StringIO('')
+        for strand, region, nextregion in ngsutils.bam.expressed._find_regions(bam, ngsutils.bam.expressed._aligned_blocks(bam.fetch())):
+            region.write(out)
+
+        self.assertEqual(out.getvalue(), 'chr1\t100\t120\tregion_1\t1\t+\nchr1\t150\t180\tregion_2\t1\t+\nchr1\t320\t345\tregion_3\t2\t+\n')
+
     def _run_test(self, valid, *args, **kwargs):
         out = StringIO.StringIO('')
         ngsutils.bam.expressed.bam_find_regions(infname, out=out, *args, **kwargs)
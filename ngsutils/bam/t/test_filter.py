@@ -4,7 +4,9 @@ Tests for bamutils filter
 '''
 
 import os
+import sys
 import unittest
+import StringIO
 
 import ngsutils.bam
 import ngsutils.bam.filter
@@ -129,6 +131,7 @@ class FilterTest(unittest.TestCase):
         self.assertFalse(excludefilter.filter(bam, read3))
         self.assertTrue(excludefilter.filter(bam, read4))
         self.assertTrue(excludefilter.filter(bam, read5))
+        self.assertFalse(excludefilter.filter(bam, MockRead('foo6', tid=0, pos=50, aend=200)))  # spans the region
         excludefilter.close()
 
         includefilter = ngsutils.bam.filter.IncludeRegion(region)
@@ -174,8 +177,18 @@ class FilterTest(unittest.TestCase):
         self.assertFalse(exclude3.filter(bam, read4))
         self.assertTrue(exclude3.filter(bam, read5))
 
+        self.assertFalse(exclude3.filter(bam, MockRead('foo6', tid=0, pos=50, aend=300)))  # spans both regions
         exclude3.close()
 
+        with open(tmp_fname, 'w') as f:
+            f.write('chr1\t99000\t101000\n')
+
+        exclude_bins = ngsutils.bam.filter.ExcludeBED(tmp_fname, 'nostrand')
+        self.assertFalse(exclude_bins.filter(bam, MockRead('foo7', tid=0, pos=99500, aend=99550)))
+        self.assertFalse(exclude_bins.filter(bam, MockRead('foo8', tid=0, pos=100500, aend=100550)))
+        self.assertTrue(exclude_bins.filter(bam, MockRead('foo9', tid=0, pos=101500, aend=101550)))
+        exclude_bins.close()
+
         tmp_fname = os.path.join(os.path.dirname(__file__), 'tmp_list')
         with open(tmp_fname, 'w') as f:
             f.write('chr1\t100\t150\tfoo\t1\t+\nchr1\t200\t250\tfoo\t1\t-\nchr1\t1000\t1250\tfoo\t1\t+\n')
@@ -202,6 +215,76 @@ class FilterTest(unittest.TestCase):
 
         os.unlink(tmp_fname)
 
+    def testRegionPlan(self):
+        'Reading -includebed regions from the index'
+
+        tmp_fname = os.path.join(os.path.dirname(__file__), 'tmp_list')
+        with open(tmp_fname, 'w') as f:
+            f.write('chr1\t700\t730\nchr1\t150\t200\nchr1\t470\t480\nchr1\t190\t195\nchr3\t1\t10\n')
+
+        bam = MockBam(['chr1', 'chr2'])
+        include = ngsutils.bam.filter.IncludeBED(tmp_fname, 'nostrand')
+
+        self.assertEqual(ngsutils.bam.filter._region_plan(bam, [ngsutils.bam.filter.Mapped(), include]), [(0, 149, 201), (0, 469, 481), (0, 699, 731)])
+        self.assertEqual(ngsutils.bam.filter._region_plan(bam, [include, ngsutils.bam.filter.ExcludeRef('chr1')]), [])
+        self.assertEqual(ngsutils.bam.filter._region_plan(bam, [ngsutils.bam.filter.UniqueStart(), include]), None)
+        self.assertEqual(ngsutils.bam.filter._region_plan(bam, [ngsutils.bam.filter.Mapped()]), None)
+
+        inbam = os.path.join(os.path.dirname(__file__), 'test.bam')
+        outbam = os.path.join(os.path.dirname(__file__), 'tmp.bam')
+
+        results = []
+        for use_index in [True, False]:
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO('')
+            try:
+                ngsutils.bam.filter.bam_filter(inbam, outbam, [include], use_index=use_index)
+                summary = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+
+            bam = ngsutils.bam.bam_open(outbam)
+            results.append(([read.qname for read in bam], summary))
+            bam.close()
+
+        os.unlink(outbam)
+        os.unlink(tmp_fname)
+
+        self.assertEqual(results[0], (['B', 'E', 'C', 'D', 'F'], '5 kept\n2 failed\n'))
+        self.assertEqual(results[0], results[1])
+
+    def testFilterChain(self):
+        'Reordering the criteria'
+
+        bam = MockBam(['chr1'])
+        reads = [MockRead('foo%s' % i, 'A' * (10 + i % 5), tid=0 if i % 4 else -1, pos=i, aend=i + 10) for i in xrange(20)]
+
+        length = ngsutils.bam.filter.ReadMinLength(12)  # rejects 8
+        mapped = ngsutils.bam.filter.Mapped()           # rejects 5
+        uniq = ngsutils.bam.filter.UniqueStart()
+        maxlen = ngsutils.bam.filter.ReadMaxLength(20)  # rejects none
+        mask = ngsutils.bam.filter.MaskFlag(0x4)
+
+        criteria = [maxlen, length, mapped, uniq, maxlen, mask]
+        chain = ngsutils.bam.filter.FilterChain(criteria, sample_size=10)
+        self.assertEqual(chain.segments, [[0, 1, 2], [3], [4, 5]])
+
+        failed = [chain.filter(bam, read) for read in reads]
+        self.assertEqual(chain.order[3], 3)
+        self.assertEqual(sorted(chain.order[:3]), [0, 1, 2])
+        self.assertEqual(chain.order[2], 0)  # never rejects, so it is last
+
+        # the same reads pass, in any order
+        nochain = ngsutils.bam.filter.FilterChain(criteria, reorder=False)
+        self.assertEqual([x is None for x in failed], [nochain.filter(bam, read) is None for read in reads])
+        self.assertEqual(nochain.order, [0, 1, 2, 3, 4, 5])
+
+        # all criteria are checked for the sample (10 reads), and then
+        # maxlen only sees the reads that pass the others (5 reads)
+        self.assertEqual(chain.evaluations[chain.order[0]], 20)
+        self.assertEqual(chain.evaluations[0], 15)
+        self.assertEqual(chain.rejections[1] + chain.rejections[2], 12)
+
     def testMismatchRef(self):
         mismatch = ngsutils.bam.filter.MismatchRef(1, os.path.join(os.path.dirname(__file__), 'test.fa'))
 
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+'''
+Tests for bamutils keepbest (and ngsutils.bam.bam_read_groups)
+'''
+
+import unittest
+
+import ngsutils.bam
+import ngsutils.bam.keepbest
+from ngsutils.bam.t import MockBam
+
+
+class KeepBestTest(unittest.TestCase):
+    def setUp(self):
+        self.bam = MockBam(['chr1'])
+        self.bam.add_read('foo1', tid=0, pos=100, mapq=10, tags=[('AS', 10), ('IH', 2)])
+        self.bam.add_read('foo1', tid=0, pos=110, mapq=20, tags=[('AS', 8), ('IH', 2)])
+        self.bam.add_read('foo2', tid=0, pos=150, mapq=10, tags=[('AS', 5)])
+        self.bam.add_read('foo2', tid=0, pos=160, mapq=10, tags=[('AS', 5)])
+        self.bam.add_read('foo2', tid=0, pos=170, mapq=10, tags=[('NM', 1)])
+        self.bam.add_read('foo3', tid=0, pos=300, mapq=0, tags=[('AS', 1)])
+
+    def testGroups(self):
+        groups = []
+        for group in ngsutils.bam.bam_read_groups(self.bam):
+            groups.append((group.qname, [x.pos for x in group], group.tag_values('AS'), group.tag(0, 'IH'), group.tag(0, 'MAPQ')))
+
+        self.assertEqual(groups, [('foo1', [100, 110], [10, 8], 2, 10),
+                                  ('foo2', [150, 160, 170], [5, 5, None], None, 10),
+                                  ('foo3', [300], [1], None, 0)])
+
+    def testGroupsThreads(self):
+        self.assertEqual([(x.qname, len(x)) for x in ngsutils.bam.bam_read_groups(self.bam, threads=True)], [('foo1', 2), ('foo2', 3), ('foo3', 1)])
+
+    def testKeepBest(self):
+        out = MockBam(['chr1'])
+        for group in ngsutils.bam.bam_read_groups(self.bam):
+            ngsutils.bam.keepbest._output_best(group, 'AS', out)
+        self.assertEqual([(x.qname, x.pos) for x in out], [('foo1', 100), ('foo2', 150), ('foo2', 160), ('foo3', 300)])
+
+    def testKeepBestMapq(self):
+        out = MockBam(['chr1'])
+        for group in ngsutils.bam.bam_read_groups(self.bam):
+            ngsutils.bam.keepbest._output_best(group, 'MAPQ', out)
+        self.assertEqual([(x.qname, x.pos) for x in out], [('foo1', 110), ('foo2', 150), ('foo2', 160), ('foo2', 170), ('foo3', 300)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,11 +15,32 @@ class MergeTest(unittest.TestCase):
         '''
         Merge test.bam and test2.bam to tmp.bam
         '''
+        self._testMerge()
+
+    def testMergeThreads(self):
+        '''
+        Merge test.bam and test2.bam to tmp.bam, reading and compressing in threads
+        '''
+        self._testMerge(threads=2)
+
+    def testMergeUnwritable(self):
+        '''
+        Merging to a missing directory raises an error (and doesn't wait on the compression thread)
+        '''
+        fname1 = os.path.join(os.path.dirname(__file__), 'test.bam')
+        fname2 = os.path.join(os.path.dirname(__file__), 'test2.bam')
+        outfname = os.path.join(os.path.dirname(__file__), 'missing', 'tmp.bam')
+
+        for threads in [1, 2]:
+            self.assertRaises((IOError, OSError, ValueError), ngsutils.bam.merge.bam_merge, outfname, [fname1, fname2], quiet=True, threads=threads)
+
+    def _testMerge(self, threads=1):
         fname1 = os.path.join(os.path.dirname(__file__), 'test.bam')
         fname2 = os.path.join(os.path.dirname(__file__), 'test2.bam')
         outfname = os.path.join(os.path.dirname(__file__), 'tmp.bam')
 
-        ngsutils.bam.merge.bam_merge(outfname, [fname1, fname2], quiet=True)
+        ngsutils.bam.merge.bam_merge(outfname, [fname1, fname2], quiet=True, threads=threads)
+        self.assertFalse(os.path.exists('%s.tmp' % outfname))
 
         bam = ngsutils.bam.bam_open(outfname)
         for read in ngsutils.bam.bam_iter(bam):
@@ -40,7 +61,8 @@ class MergeTest(unittest.TestCase):
 
     def tearDown(self):
         outfname = os.path.join(os.path.dirname(__file__), 'tmp.bam')
-        os.unlink(outfname)
+        if os.path.exists(outfname):
+            os.unlink(outfname)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.bam.parallel
+'''
+
+import os
+import unittest
+import StringIO
+
+import ngsutils.bam
+import ngsutils.bam.parallel
+from ngsutils.bed import BedFile
+
+from ngsutils.bam.t import MockBam
+
+
+def _read_starts(bam, shard):
+    for read in bam.fetch(shard.chrom, shard.start, shard.end):
+        if shard.start <= read.pos < shard.end:
+            yield (read.qname, shard.chrom, read.pos)
+
+
+class ParallelTest(unittest.TestCase):
+    def testGenomeShards(self):
+        bam = MockBam(['chr1', 'chr2'], lengths=[250, 100])
+        shards = ngsutils.bam.parallel.genome_shards(bam, 100)
+        self.assertEqual([(x.chrom, x.start, x.end, x.regions) for x in shards], [('chr1', 0, 100, None), ('chr1', 100, 200, None), ('chr1', 200, 250, None), ('chr2', 0, 100, None)])
+
+    def testRegionShards(self):
+        bed = BedFile(fileobj=StringIO.StringIO('chr1\t10\t20\nchr1\t50\t60\nchr2\t10\t20\n'))
+        shards = ngsutils.bam.parallel.region_shards(bed)
+        self.assertEqual([(x.chrom, x.start, x.end, len(x.regions)) for x in shards], [('chr1', 10, 60, 2), ('chr2', 10, 20, 1)])
+
+    def testShardMapInProcess(self):
+        bam = MockBam(['chr1', 'chr2'])
+        bam.add_read('foo1', 'A' * 10, tid=0, pos=10, cigar='10M')
+        bam.add_read('foo2', 'A' * 10, tid=0, pos=150, cigar='10M')
+        bam.add_read('foo3', 'A' * 10, tid=1, pos=10, cigar='10M')
+
+        shards = ngsutils.bam.parallel.genome_shards(bam, 100)
+        vals = list(ngsutils.bam.parallel.shard_map(bam, _read_starts, shards, procs=2, quiet=True))
+        self.assertEqual(vals, [('foo1', 'chr1', 10), ('foo2', 'chr1', 150), ('foo3', 'chr2', 10)])
+
+    def testShardMap(self):
+        bam = ngsutils.bam.bam_open(os.path.join(os.path.dirname(__file__), 'test.bam'))
+        valid = [(x.qname, bam.getrname(x.tid), x.pos) for x in bam.fetch() if not x.is_unmapped]
+
+        shards = ngsutils.bam.parallel.genome_shards(bam, 100)
+        self.assertEqual(list(ngsutils.bam.parallel.shard_map(bam, _read_starts, shards, procs=2, quiet=True)), valid)
+        bam.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
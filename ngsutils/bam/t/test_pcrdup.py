@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+'''
+Tests for bamutils pcrdup
+'''
+
+import sys
+import unittest
+import StringIO
+
+import ngsutils.bam.pcrdup
+from ngsutils.bam.t import MockBam
+
+
+def _pair(bam, name, tid, pos, mtid, mpos, mapq=20, rev=False):
+    bam.add_read(name, 'A' * 10, tid=tid, pos=pos, cigar='10M', mapq=mapq, rnext=mtid, pnext=mpos, is_paired=True, is_read1=True, is_reverse=rev, mate_is_reverse=not rev)
+    if mtid > -1:
+        bam.add_read(name, 'A' * 10, tid=mtid, pos=mpos, cigar='10M', mapq=mapq, rnext=tid, pnext=pos, is_paired=True, is_read2=True, is_reverse=not rev, mate_is_reverse=rev)
+
+
+testbam = MockBam(['chr1', 'chr2'])
+_pair(testbam, 'pairA', 0, 100, 0, 200, mapq=30)
+_pair(testbam, 'pairB', 0, 100, 0, 200, mapq=10)
+_pair(testbam, 'pairC', 0, 100, 0, 210)                 # different mate pos
+_pair(testbam, 'pairD', 0, 100, 0, 200, rev=True)       # different strand
+_pair(testbam, 'pairE', 0, 120, 1, 50, mapq=30)         # mates on chr2
+_pair(testbam, 'pairF', 0, 120, 1, 50, mapq=10)
+_pair(testbam, 'pairG', 0, 130, 0, 130, mapq=30)        # same position
+_pair(testbam, 'pairH', 0, 130, 0, 130, mapq=10)
+_pair(testbam, 'pairI', 0, 150, 0, 300, mapq=30)
+testbam.add_read('pairJ', 'A' * 10, tid=0, pos=150, cigar='10M', mapq=10, rnext=0, pnext=300, is_paired=True, is_read1=True, mate_is_reverse=True)  # mate missing
+testbam.add_read('single', 'A' * 10, tid=1, pos=10, cigar='10M')
+
+
+class PCRDupTest(unittest.TestCase):
+    def _run(self, cache_size):
+        outbam = MockBam(['chr1', 'chr2'])
+        counts = StringIO.StringIO('')
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO('')
+        try:
+            ngsutils.bam.pcrdup.pcrdup_mark_mates(testbam, outbam, counts, cache_size)
+            summary = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        dups = set()
+        names = []
+        for read in outbam.fetch():
+            names.append(read.qname)
+            if getattr(read, 'is_duplicate', False):
+                dups.add((read.qname, 1 if read.is_read1 else 2))
+
+        return dups, names, counts.getvalue(), summary
+
+    def testMates(self):
+        dups, names, counts, summary = self._run(100)
+        self.assertEqual(dups, set([('pairB', 1), ('pairB', 2), ('pairF', 1), ('pairF', 2), ('pairH', 1), ('pairH', 2), ('pairJ', 1)]))
+        self.assertEqual(len(names), 20)
+        self.assertEqual(sorted(counts.strip().split('\n')), ['chr1\t100\t0\t1', 'chr1\t100\t0\t1', 'chr1\t100\t0\t2', 'chr1\t120\t0\t2', 'chr1\t130\t0\t2', 'chr1\t150\t0\t2', 'chr2\t10\t0\t1'])
+        self.assertTrue('PCR duplicates:\t4\n' in summary)
+        self.assertTrue('Peak mate cache:\t3\n' in summary)
+        self.assertTrue('Missing mates:\t1\n' in summary)
+
+    def testSpill(self):
+        self.assertEqual(self._run(1)[:3], self._run(100)[:3])
+
+        summary = self._run(1)[3]
+        self.assertTrue('Mates cached on disk:\t2\n' in summary)
+        self.assertTrue('Missing mates:\t1\n' in summary)
+
+    def testCache(self):
+        cache = ngsutils.bam.pcrdup.MateCache(2)
+        cache.add('foo', 0, 10)
+        cache.add('bar', 0, 20)
+        cache.add('baz', 1, 5)  # spilled
+
+        cache.advance(0, 10)
+        self.assertTrue(cache.pop('foo', 0, 10))
+        self.assertFalse(cache.pop('foo', 0, 10))
+
+        cache.advance(1, 5)
+        self.assertTrue(cache.pop('baz', 1, 5))
+        self.assertEqual(cache.missing, 1)
+        self.assertEqual(cache.spilled, 3)
+        self.assertEqual(cache.peak, 3)
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@
 Tests for bamutils split
 '''
 
+import glob
 import os
 import unittest
 
@@ -50,12 +51,46 @@ class SplitTest(unittest.TestCase):
         self.assertTrue(foundE)
         self.assertFalse(foundOther)
 
-    def tearDown(self):
-        outfname1 = os.path.join(os.path.dirname(__file__), 'tmp.1.bam')
-        outfname2 = os.path.join(os.path.dirname(__file__), 'tmp.2.bam')
+    def _split_names(self, **kwargs):
+        fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+        outfname = os.path.join(os.path.dirname(__file__), 'tmp')
+
+        ngsutils.bam.split.bam_split(fname, outfname, reference=True, quiet=True, **kwargs)
+
+        names = {}
+        for fname in sorted(glob.glob('%s.*.bam' % outfname)):
+            bam = ngsutils.bam.bam_open(fname)
+            names[os.path.basename(fname)] = [read.qname for read in ngsutils.bam.bam_iter(bam, quiet=True)]
+            bam.close()
+            os.unlink(fname)
+            if os.path.exists('%s.bai' % fname):
+                os.unlink('%s.bai' % fname)
+
+        return names
 
-        os.unlink(outfname1)
-        os.unlink(outfname2)
+    def testSplitRef(self):
+        names = self._split_names()
+        self.assertTrue('tmp.chr1.bam' in names)
+        self.assertFalse('tmp.unmapped.bam' in names)
+        self.assertEqual(sum([len(x) for x in names.values()]), 6)
+
+        self.assertEqual(self._split_names(unmapped=True), dict(names, **{'tmp.unmapped.bam': ['Z']}))
+
+    def testSplitRefParallel(self):
+        serial = self._split_names(unmapped=True)
+        self.assertEqual(self._split_names(unmapped=True, procs=2), serial)
+        self.assertEqual(self._split_names(procs=2), dict([(k, v) for k, v in serial.items() if k != 'tmp.unmapped.bam']))
+
+    def testSplitRefIndex(self):
+        fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+        outfname = os.path.join(os.path.dirname(__file__), 'tmp')
+
+        ngsutils.bam.split.bam_split(fname, outfname, reference=True, quiet=True, index=True, procs=2)
+        self.assertTrue(os.path.exists('%s.chr1.bam.bai' % outfname))
+
+    def tearDown(self):
+        for fname in glob.glob(os.path.join(os.path.dirname(__file__), 'tmp.*.bam*')):
+            os.unlink(fname)
 
 if __name__ == '__main__':
     unittest.main()
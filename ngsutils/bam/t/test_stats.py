@@ -4,10 +4,15 @@ Tests for bamutils stats
 '''
 
 import os
+import shutil
+import tempfile
 import unittest
 
+import pysam
+
 import ngsutils.bam
 import ngsutils.bam.stats
+import ngsutils.bam.summary
 
 
 class StatsTest(unittest.TestCase):
@@ -16,6 +21,8 @@ class StatsTest(unittest.TestCase):
 
     def tearDown(self):
         self.bam.close()
+        if os.path.exists('%s.ngsstats' % self.bam.filename):
+            os.unlink('%s.ngsstats' % self.bam.filename)
 
     def testStats(self):
         stats = ngsutils.bam.stats.BamStats(self.bam)
@@ -28,6 +35,93 @@ class StatsTest(unittest.TestCase):
         self.assertTrue('chr1' in stats.refs)   # 6 on chr1
         self.assertTrue('chr3' not in stats.refs)
 
+    def testStatsNoCache(self):
+        stats = ngsutils.bam.stats.BamStats(self.bam, cache_enabled=False)
+        self.assertFalse(os.path.exists('%s.ngsstats' % self.bam.filename))
+        self.assertEqual(7, stats.total)
+        self.assertEqual(6, stats.mapped)
+        self.assertEqual(1, stats.unmapped)
+        self.assertEqual(1, stats.flag_counts.counts[0x10])
+        self.assertEqual(1, stats.flag_counts.counts[0x4])
+
+    def testStatsSummary(self):
+        scanned = ngsutils.bam.stats.BamStats(self.bam, cache_enabled=False, delim=':', show_all=True)
+        summary = ngsutils.bam.stats.BamStats(self.bam, delim=':', show_all=True)
+        self.assertTrue(os.path.exists('%s.ngsstats' % self.bam.filename))
+
+        self.assertEqual(scanned.total, summary.total)
+        self.assertEqual(scanned.mapped, summary.mapped)
+        self.assertEqual(scanned.unmapped, summary.unmapped)
+        self.assertEqual(scanned.flag_counts.counts, summary.flag_counts.counts)
+        self.assertEqual(scanned.refs, summary.refs)
+
+    def testSummaryStale(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'test.bam')
+            shutil.copy(self.bam.filename, fname)
+
+            summary = ngsutils.bam.summary.BamSummary(fname, quiet=True)
+            self.assertEqual(6, summary.mapped_reads)
+            self.assertEqual(6, summary.all.refs['chr1'])
+            self.assertTrue(os.path.exists('%s.ngsstats' % fname))
+
+            # cached values are used if the BAM file hasn't changed
+            summary.mapped_reads = 100
+            summary._write_cache(ngsutils.bam.summary._summary_key(fname, self.bam))
+            self.assertEqual(100, ngsutils.bam.summary.BamSummary(fname, quiet=True).mapped_reads)
+
+            # ... and recalculated if it has
+            os.utime(fname, (0, 0))
+            self.assertEqual(6, ngsutils.bam.summary.BamSummary(fname, quiet=True).mapped_reads)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _multi_bam(self, tmpdir):
+        'A sorted, indexed BAM file with reads that map to more than one reference'
+        samname = os.path.join(tmpdir, 'multi.sam')
+        with open(samname, 'w') as f:
+            f.write('@HD\tVN:1.0\tSO:coordinate\n@SQ\tSN:chr1\tLN:1000\n@SQ\tSN:chr2\tLN:1000\n@SQ\tSN:chr3\tLN:1000\n')
+            reads = [('A', 'chr1', 10, 2), ('B', 'chr1', 20, 1), ('C', 'chr1', 30, 2),
+                     ('C', 'chr1', 40, 2), ('A', 'chr2', 10, 2), ('D', 'chr2', 20, 3),
+                     ('D', 'chr3', 10, 3), ('E', 'chr3', 20, 1), ('D', 'chr3', 30, 3)]
+            for name, chrom, pos, ih in reads:
+                f.write('%s\t0\t%s\t%s\t30\t10M\t*\t0\t0\tAAAAAAAAAA\tIIIIIIIIII\tIH:i:%s\n' % (name, chrom, pos, ih))
+            f.write('F\t4\t*\t0\t0\t*\t*\t0\t0\tAAAAAAAAAA\tIIIIIIIIII\n')
+
+        sam = pysam.Samfile(samname, 'r')
+        fname = os.path.join(tmpdir, 'multi.bam')
+        out = pysam.Samfile(fname, 'wb', template=sam)
+        for read in sam:
+            out.write(read)
+        out.close()
+        sam.close()
+        pysam.index(fname)
+        return fname
+
+    def testStatsParallel(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = self._multi_bam(tmpdir)
+            bam = ngsutils.bam.bam_open(fname)
+            serial = ngsutils.bam.stats.BamStats(bam, tags=['IH'], cache_enabled=False)
+            parallel = ngsutils.bam.stats.BamStats(bam, tags=['IH'], cache_enabled=False, procs=2)
+            bam.close()
+
+            # A, B, C, D, E (multiple mappings count once), F (unmapped)
+            self.assertEqual(6, serial.total)
+            self.assertEqual({'chr1': 3, 'chr2': 1, 'chr3': 1}, serial.refs)
+
+            for stats in [parallel] + ngsutils.bam.stats._parallel_stats([fname, fname], tags=['IH'], procs=2):
+                self.assertEqual(serial.total, stats.total)
+                self.assertEqual(serial.mapped, stats.mapped)
+                self.assertEqual(serial.unmapped, stats.unmapped)
+                self.assertEqual(serial.flag_counts.counts, stats.flag_counts.counts)
+                self.assertEqual(serial.refs, stats.refs)
+                self.assertEqual(list(serial.tagbins['IH']), list(stats.tagbins['IH']))
+        finally:
+            shutil.rmtree(tmpdir)
+
     def testStatsGTF(self):
         # Add a test with a mock GTF file
         pass
@@ -7,6 +7,7 @@ import os
 import unittest
 
 import ngsutils.bam
+import ngsutils.bam.parallel
 import ngsutils.bam.tobedgraph
 import StringIO
 
@@ -48,5 +49,26 @@ chr1\t724\t774\t1
 ''')
         sio.close()
 
+    def testBEDGraphParallel(self):
+        shard_size = ngsutils.bam.parallel.DEFAULT_SHARD_SIZE
+        ngsutils.bam.parallel.DEFAULT_SHARD_SIZE = 100
+        try:
+            parallel = StringIO.StringIO("")
+            ngsutils.bam.tobedgraph.bam_tobedgraph(self.bam, out=parallel, procs=2)
+            self.assertEqual(parallel.getvalue(), '''\
+chr1\t99\t149\t1
+chr1\t174\t724\t2
+chr1\t724\t774\t1
+''')
+
+            for strand in [None, '+', '-']:
+                serial = StringIO.StringIO("")
+                ngsutils.bam.tobedgraph.bam_tobedgraph(self.bam, strand=strand, out=serial)
+                parallel = StringIO.StringIO("")
+                ngsutils.bam.tobedgraph.bam_tobedgraph(self.bam, strand=strand, out=parallel, procs=2)
+                self.assertEqual(serial.getvalue(), parallel.getvalue())
+        finally:
+            ngsutils.bam.parallel.DEFAULT_SHARD_SIZE = shard_size
+
 if __name__ == '__main__':
     unittest.main()
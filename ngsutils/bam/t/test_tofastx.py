@@ -3,6 +3,10 @@
 Tests for bamutils tofasta / tofastq
 '''
 
+import gzip
+import os
+import shutil
+import tempfile
 import unittest
 from ngsutils.bam.t import MockRead
 
@@ -38,5 +42,55 @@ class FASTXTest(unittest.TestCase):
         sio.close()
 
 
+class PairedTest(unittest.TestCase):
+    def setUp(self):
+        # coordinate sorted: mates are apart, bar has no mate, baz isn't paired
+        self.reads = [MockRead('foo1', 'AAAA', 'IIII', tid=0, pos=10, is_paired=True, is_read1=True),
+                      MockRead('foo2', 'CCCC', 'IIII', tid=0, pos=20, is_paired=True, is_read2=True),
+                      MockRead('bar', 'GGGG', 'IIII', tid=0, pos=30, is_paired=True, is_read1=True),
+                      MockRead('foo2', 'GGGG', 'IIII', tid=0, pos=35, is_paired=True, is_read1=True, is_secondary=True),
+                      MockRead('foo1', 'TTTT', 'IIII', tid=0, pos=40, is_paired=True, is_read2=True),
+                      MockRead('baz', 'ACGT', 'IIII', tid=0, pos=50),
+                      MockRead('foo2', 'ACAC', 'IIII', tid=0, pos=60, is_paired=True, is_read1=True)]
+
+    def _write_pairs(self, max_buffer):
+        outs = [StringIO.StringIO() for x in xrange(3)]
+        reads = ngsutils.bam.tofastq._filter_reads(self.reads, True, True, False)
+        counts = ngsutils.bam.tofastq.write_pairs(reads, outs[0], outs[1], outs[2], max_buffer=max_buffer)
+        return counts, [x.getvalue() for x in outs]
+
+    def testPairs(self):
+        counts, (r1, r2, single) = self._write_pairs(100)
+        self.assertEqual(counts, (2, 2))
+        self.assertEqual(r1, '@foo1\nAAAA\n+\nIIII\n@foo2\nACAC\n+\nIIII\n')
+        self.assertEqual(r2, '@foo1\nTTTT\n+\nIIII\n@foo2\nCCCC\n+\nIIII\n')
+        self.assertEqual(single, '@baz\nACGT\n+\nIIII\n@bar\nGGGG\n+\nIIII\n')
+
+    def testPairsSpill(self):
+        counts, (r1, r2, single) = self._write_pairs(1)
+        self.assertEqual(counts, (2, 2))
+
+        r1 = r1.split('\n')
+        r2 = r2.split('\n')
+        pairs = sorted([(r1[i], r1[i + 1], r2[i], r2[i + 1]) for i in xrange(0, len(r1) - 1, 4)])
+        self.assertEqual(pairs, [('@foo1', 'AAAA', '@foo1', 'TTTT'), ('@foo2', 'ACAC', '@foo2', 'CCCC')])
+        self.assertEqual(sorted(single.split('\n')[::4]), ['', '@bar', '@baz'])
+
+    def testWriterCompress(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'out.fastq.gz')
+            out = ngsutils.bam.tofastq.RecordWriter(fname, compress=True, threads=2)
+            for i in xrange(10000):
+                out.write(ngsutils.bam.tofastq.fastq_record(MockRead('read%s' % i, 'ACGT', 'IIII')))
+            out.close()
+
+            lines = gzip.open(fname).read().split('\n')
+            self.assertEqual(len(lines), 40001)
+            self.assertEqual(lines[-5:], ['@read9999', 'ACGT', '+', 'IIII', ''])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -14,6 +14,9 @@ normalize the counts by a given factor.
 import sys
 import os
 from ngsutils.bam import bam_pileup_iter, cigar_tostr, read_cigar_at_pos
+from ngsutils.bam.summary import BamSummary
+import ngsutils.bam.parallel
+from ngsutils.support import positive_int_arg
 import pysam
 
 
@@ -25,18 +28,60 @@ def write_bedgraph(chrom, start, end, count, normalize=None, out=sys.stdout):
             out.write('%s\t%s\t%s\t%s\n' % (chrom, start, end, count))
 
 
-def bam_tobedgraph(bamfile, strand=None, normalize=None, nogaps=False, out=sys.stdout):
+def bam_tobedgraph(bamfile, strand=None, normalize=None, nogaps=False, out=sys.stdout, procs=1):
+    if procs > 1:
+        shards = ngsutils.bam.parallel.genome_shards(bamfile)
+        runs = ngsutils.bam.parallel.shard_map(bamfile, _bedgraph_shard, shards, procs, (strand, nogaps))
+    else:
+        runs = _bedgraph_runs(bamfile, bam_pileup_iter(bamfile), strand, nogaps)
+
+    for chrom, start, end, count in _merge_runs(runs):
+        write_bedgraph(chrom, start, end, count, normalize, out)
+
+
+def _bedgraph_shard(bamfile, shard, strand, nogaps):
+    'Worker: the runs for one shard of the genome (see bam_tobedgraph)'
+    return _bedgraph_runs(bamfile, ngsutils.bam.parallel.shard_pileup(bamfile, shard), strand, nogaps)
+
+
+def _merge_runs(runs):
+    '''
+    Joins runs that were split at the edge of a shard
+
+    >>> list(_merge_runs([('chr1', 10, 20, 1), ('chr1', 20, 30, 1), ('chr1', 30, 40, 2), ('chr2', 40, 50, 2)]))
+    [('chr1', 10, 30, 1), ('chr1', 30, 40, 2), ('chr2', 40, 50, 2)]
+    '''
+    last = None
+    for run in runs:
+        if last and last[0] == run[0] and last[2] == run[1] and last[3] == run[3]:
+            last = (last[0], last[1], run[2], last[3])
+            continue
+
+        if last:
+            yield last
+        last = run
+
+    if last:
+        yield last
+
+
+def _bedgraph_runs(bamfile, pileups, strand=None, nogaps=False):
+    '''
+    Yields (chrom, start, end, count) for each run of consecutive positions
+    with the same (non-zero) count.
+    '''
     last_chrom = None
     last_count = 0
     last_start = None
     last_end = None
 
-    for pileup in bam_pileup_iter(bamfile):
+    for pileup in pileups:
         # sys.stdin.readline()
         chrom = bamfile.getrname(pileup.tid)
 
         if chrom != last_chrom and last_count > 0 and last_end:
-            write_bedgraph(last_chrom, last_start, last_end + 1, last_count, normalize, out)
+            if last_start:
+                yield (last_chrom, last_start, last_end + 1, last_count)
             last_count = 0
             last_start = None
             last_end = None
@@ -73,8 +118,8 @@ def bam_tobedgraph(bamfile, strand=None, normalize=None, nogaps=False, out=sys.s
 
             # print pileup.pos,count,last_start,last_end
         if count != last_count or not last_end or (pileup.pos - last_end) > 1:
-            if last_count > 0:
-                write_bedgraph(last_chrom, last_start, last_end + 1, last_count, normalize, out)
+            if last_count > 0 and last_start:
+                yield (last_chrom, last_start, last_end + 1, last_count)
 
             if count == 0:
                 last_start = None
@@ -87,13 +132,14 @@ def bam_tobedgraph(bamfile, strand=None, normalize=None, nogaps=False, out=sys.s
         last_count = count
         last_chrom = chrom
 
-    write_bedgraph(last_chrom, last_start, last_end + 1, last_count, normalize, out)
+    if last_count > 0 and last_start:
+        yield (last_chrom, last_start, last_end + 1, last_count)
 
 
 def usage():
     print __doc__
     print """\
-Usage: bamutils tobedgraph [-plus | -minus] {-norm N} bamfile
+Usage: bamutils tobedgraph [-plus | -minus] {-norm N | -cpm} {-p N} bamfile
 
 Options:
     -plus             only count reads on the plus strand
@@ -103,8 +149,15 @@ Options:
     -norm VAL         the count at every position is calculated as:
                       floor(count * VAL).
 
+    -cpm              normalize counts to counts per million mapped reads
+                      (reads with multiple mappings are counted once; the
+                      number of mapped reads is stored in filename.bam.ngsstats)
+
     -nogaps           Don't include gaps across splice-junctions (RNA-seq)
                       Warning: adds significant processing time!
+
+    -p N              Use N processes (the genome is split into shards that
+                      are processed in parallel) (default: 1)
 """
     sys.exit(1)
 
@@ -112,7 +165,9 @@ if __name__ == "__main__":
     bam = None
     strand = None
     norm = None
+    cpm = False
     nogaps = False
+    procs = 1
 
     last = None
     for arg in sys.argv[1:]:
@@ -121,8 +176,13 @@ if __name__ == "__main__":
         if last == '-norm':
             norm = float(arg)
             last = None
-        elif arg in ['-norm']:
+        elif last == '-p':
+            procs = positive_int_arg('-p', arg, usage)
+            last = None
+        elif arg in ['-norm', '-p']:
             last = arg
+        elif arg == '-cpm':
+            cpm = True
         elif arg == '-nogaps':
             nogaps = True
         elif arg == '-plus':
@@ -138,6 +198,9 @@ if __name__ == "__main__":
     if not bam:
         usage()
 
+    if cpm:
+        norm = 1000000.0 / BamSummary(bam).mapped_reads
+
     bamfile = pysam.Samfile(bam, "rb")
-    bam_tobedgraph(bamfile, strand, norm, nogaps, out=sys.stdout)
+    bam_tobedgraph(bamfile, strand, norm, nogaps, out=sys.stdout, procs=procs)
     bamfile.close()
@@ -3,11 +3,44 @@
 ## desc Convert BAM reads back to FASTQ sequences
 '''
 Convert BAM reads back to FASTA/FASTQ sequences (mapped or unmapped)
+
+Paired-end reads can also be written to separate files for the first and
+second reads (out_R1.fastq, out_R2.fastq), with reads that are missing their
+mate written to a third file (out_single.fastq). The files are written in the
+same order, so they can be used directly by an aligner. These files can be
+compressed (bgzip, which can be read as a normal gzip file) using a pool of
+threads for each file.
+
+If the BAM file isn't sorted by read name, the first read of a pair is kept
+in memory until its mate is found. Only a limited number of reads are kept in
+memory. When there are more, the oldest are moved to temporary files, which
+are paired up after the BAM file has been read.
 '''
 
 import sys
 import os
+import collections
+import shutil
+import tempfile
+
 from ngsutils.bam import bam_iter, bam_open
+from ngsutils.support import positive_int_arg
+from ngsutils.support.bgzip import BGZipWriter
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+# records are written out in batches of this size
+_BATCH_SIZE = 4096
+
+# the number of unpaired reads kept in memory (-buffer)
+_MAX_BUFFER = 1000000
+
+# reads that are moved out of memory are split into this many temporary
+# files (by read name), so that each can be paired up in memory
+_SPILL_FILES = 64
 
 
 def bam_tofastx(fname, colorspace=False, show_mapped=True, show_unmapped=True, fastq=True, read1=True, read2=True, proper=False):
@@ -48,8 +81,197 @@ def bam_tofastx(fname, colorspace=False, show_mapped=True, show_unmapped=True, f
         last_key = k
 
 
+def bam_tofastx_paired(fname, out_template, colorspace=False, show_mapped=True, show_unmapped=True, fastq=True, proper=False, compress=False, threads=1, max_buffer=_MAX_BUFFER, quiet=False):
+    '''
+    Writes the first and second reads of each pair to separate files
+    (out_template_R1.fastq, out_template_R2.fastq), and reads without a mate
+    to out_template_single.fastq. Only primary alignments are written.
+    '''
+    if show_mapped is False and show_unmapped is False:
+        return
 
-def write_fasta(read, out=sys.stdout, colorspace=False):
+    ext = 'fastq' if fastq else 'fasta'
+    if compress:
+        ext += '.gz'
+
+    outs = [RecordWriter('%s_%s.%s' % (out_template, x, ext), compress, threads) for x in ['R1', 'R2', 'single']]
+
+    sam = bam_open(fname)
+    reads = _filter_reads(bam_iter(sam, quiet=quiet), show_mapped, show_unmapped, proper)
+    pairs, singles = write_pairs(reads, outs[0], outs[1], outs[2], fastq, colorspace, max_buffer)
+    sam.close()
+
+    for out in outs:
+        out.close()
+
+    if not quiet:
+        sys.stderr.write('Wrote %s pairs, %s single reads\n' % (pairs, singles))
+
+
+def _filter_reads(reads, show_mapped, show_unmapped, proper):
+    for read in reads:
+        if read.is_secondary or read.flag & 0x800:
+            continue
+        if proper and not read.is_proper_pair:
+            continue
+        if read.is_unmapped:
+            if not show_unmapped:
+                continue
+        elif not show_mapped:
+            continue
+
+        yield read
+
+
+def write_pairs(reads, out1, out2, single, fastq=True, colorspace=False, max_buffer=_MAX_BUFFER):
+    '''
+    Writes the first and second reads of each pair to out1 and out2, and
+    reads without a mate to single. Reads are kept in memory until their
+    mate is found (at most max_buffer reads, the rest are moved to temporary
+    files). Returns the number of pairs and single reads written.
+    '''
+    format_read = fastq_record if fastq else fasta_record
+
+    # qname -> [read1 record, read2 record]
+    buf = collections.OrderedDict()
+    spill = None
+    pairs = 0
+    singles = 0
+
+    for read in reads:
+        record = format_read(read, colorspace)
+
+        if not read.is_paired or not (read.is_read1 or read.is_read2):
+            single.write(record)
+            singles += 1
+            continue
+
+        mate = 0 if read.is_read1 else 1
+
+        if read.qname in buf:
+            recs = buf[read.qname]
+            if recs[mate] is None:
+                recs[mate] = record
+                del buf[read.qname]
+                out1.write(recs[0])
+                out2.write(recs[1])
+                pairs += 1
+            continue
+
+        recs = [None, None]
+        recs[mate] = record
+        buf[read.qname] = recs
+
+        if len(buf) > max_buffer:
+            if not spill:
+                spill = _SpillFiles()
+            # move the oldest half out of memory
+            for i in xrange(len(buf) // 2):
+                spill.add(*buf.popitem(last=False))
+
+    if spill:
+        while buf:
+            spill.add(*buf.popitem(last=False))
+        for recs in spill.pairs():
+            if recs[0] is not None and recs[1] is not None:
+                out1.write(recs[0])
+                out2.write(recs[1])
+                pairs += 1
+            else:
+                single.write(recs[0] if recs[0] is not None else recs[1])
+                singles += 1
+        spill.close()
+    else:
+        for recs in buf.itervalues():
+            single.write(recs[0] if recs[0] is not None else recs[1])
+            singles += 1
+
+    return pairs, singles
+
+
+class _SpillFiles(object):
+    '''
+    Temporary files for unpaired reads that can't be kept in memory. Reads
+    are split into files by read name, so both reads of a pair end up in the
+    same file.
+    '''
+    def __init__(self, num=_SPILL_FILES):
+        self.tmpdir = tempfile.mkdtemp(prefix='.ngsutils_tofastq')
+        self.fnames = [os.path.join(self.tmpdir, 'spill%s' % i) for i in xrange(num)]
+        self._batches = [[] for i in xrange(num)]
+
+    def add(self, qname, recs):
+        idx = hash(qname) % len(self._batches)
+        self._batches[idx].append((qname, recs))
+        if len(self._batches[idx]) >= _BATCH_SIZE:
+            self._flush(idx)
+
+    def _flush(self, idx):
+        with open(self.fnames[idx], 'ab') as f:
+            pickle.dump(self._batches[idx], f, pickle.HIGHEST_PROTOCOL)
+        self._batches[idx] = []
+
+    def pairs(self):
+        'Yields the [read1, read2] records for each read name (either may be None)'
+        for idx, fname in enumerate(self.fnames):
+            if self._batches[idx]:
+                self._flush(idx)
+            if not os.path.exists(fname):
+                continue
+
+            recs = collections.OrderedDict()
+            with open(fname, 'rb') as f:
+                while True:
+                    try:
+                        batch = pickle.load(f)
+                    except EOFError:
+                        break
+                    for qname, (rec1, rec2) in batch:
+                        if qname in recs:
+                            cur = recs[qname]
+                            if cur[0] is None:
+                                cur[0] = rec1
+                            if cur[1] is None:
+                                cur[1] = rec2
+                        else:
+                            recs[qname] = [rec1, rec2]
+
+            os.unlink(fname)
+            for val in recs.itervalues():
+                yield val
+
+    def close(self):
+        shutil.rmtree(self.tmpdir, True)
+
+
+class RecordWriter(object):
+    '''
+    Writes FASTA/FASTQ records to a file in batches. If compress is True, the
+    file is written with bgzip, using threads threads to compress blocks.
+    '''
+    def __init__(self, fname, compress=False, threads=1):
+        if compress:
+            self.out = BGZipWriter(fname, threads=threads)
+        else:
+            self.out = open(fname, 'w')
+        self._records = []
+
+    def write(self, record):
+        self._records.append(record)
+        if len(self._records) >= _BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._records:
+            self.out.write(''.join(self._records))
+            self._records = []
+
+    def close(self):
+        self.flush()
+        self.out.close()
+
+
+def fasta_record(read, colorspace=False):
     if colorspace:
         seq = read.opt('CS')
     else:
@@ -58,10 +280,10 @@ def write_fasta(read, out=sys.stdout, colorspace=False):
     if not read.is_unmapped and read.is_reverse:
         seq = seq[::-1]
 
-    out.write('>%s\n%s\n' % (read.qname, seq))
+    return '>%s\n%s\n' % (read.qname, seq)
 
 
-def write_fastq(read, out=sys.stdout, colorspace=False):
+def fastq_record(read, colorspace=False):
     if colorspace:
         seq = read.opt('CS')
         qual = read.opt('CQ')
@@ -73,8 +295,15 @@ def write_fastq(read, out=sys.stdout, colorspace=False):
         seq = seq[::-1]
         qual = qual[::-1]
 
-    out.write('@%s\n%s\n+\n%s\n' % (read.qname, seq, qual))
+    return '@%s\n%s\n+\n%s\n' % (read.qname, seq, qual)
+
 
+def write_fasta(read, out=sys.stdout, colorspace=False):
+    out.write(fasta_record(read, colorspace))
+
+
+def write_fastq(read, out=sys.stdout, colorspace=False):
+    out.write(fastq_record(read, colorspace))
 
 def usage(fastq=True):
     print __doc__
@@ -90,10 +319,21 @@ Options:
     -mapped    Only output mapped sequences
     -unmapped  Only output unmapped sequences
 
-    -read1     Only output the first read (paired-end)
-    -read2     Only output the second read (paired-end)
+    -read1     Only output the first read (paired-end, not with -o)
+    -read2     Only output the second read (paired-end, not with -o)
     -proper    Only output proper-pairs (both mapped)
-"""
+
+Paired-end output:
+    -o out_template  Write the first and second reads of each pair to
+                     out_template_R1.fastq and out_template_R2.fastq, and
+                     reads without a mate to out_template_single.fastq.
+                     Only primary alignments are written.
+
+    -gz              Compress the output files (bgzip)
+    -t num           Use {num} threads to compress each file (default: 1)
+    -buffer num      Keep at most {num} unpaired reads in memory
+                     (default: %s)
+""" % _MAX_BUFFER
     sys.exit(1)
 
 
@@ -108,9 +348,27 @@ def main(fastq=True):
     read1 = True
     read2 = True
     proper = False
+    out_template = None
+    compress = False
+    threads = 1
+    max_buffer = _MAX_BUFFER
+    last = None
 
     for arg in sys.argv[1:]:
-        if arg == '-cs':
+        if last == '-o':
+            out_template = arg
+            last = None
+        elif last == '-t':
+            threads = positive_int_arg('-t', arg, lambda: usage(fastq))
+            last = None
+        elif last == '-buffer':
+            max_buffer = positive_int_arg('-buffer', arg, lambda: usage(fastq))
+            last = None
+        elif arg in ['-o', '-t', '-buffer']:
+            last = arg
+        elif arg == '-gz':
+            compress = True
+        elif arg == '-cs':
             cs = True
         elif arg == '-read1':
             read2 = False
@@ -131,7 +389,12 @@ def main(fastq=True):
     if not samf:
         usage()
 
-    bam_tofastx(samf, cs, mapped, unmapped, fastq, read1, read2, proper)
+    if out_template:
+        if not read1 or not read2:
+            sys.stderr.write('Warning: -read1 and -read2 are ignored with -o\n')
+        bam_tofastx_paired(samf, out_template, cs, mapped, unmapped, fastq, proper, compress, threads, max_buffer)
+    else:
+        bam_tofastx(samf, cs, mapped, unmapped, fastq, read1, read2, proper)
 
 if __name__ == '__main__':
     main()
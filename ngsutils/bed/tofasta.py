@@ -9,19 +9,12 @@ import sys
 import os
 from ngsutils.bed import BedFile
 from ngsutils.support import revcomp
-import pysam
+from ngsutils.support.reference import open_reference
 
 
 def bed_tofasta(bed, ref_fasta, min_size=50, stranded=True, out=sys.stdout):
-    if not os.path.exists('%s.fai' % ref_fasta):
-        pysam.faidx(ref_fasta)
-
-    fasta = pysam.Fastafile(ref_fasta)
-
-    refs = set()
-    with open('%s.fai' % ref_fasta) as f:
-        for line in f:
-            refs.add(line.split('\t')[0].strip())
+    fasta = open_reference(ref_fasta)
+    refs = set(fasta.references)
 
     for region in bed:
         if region.end - region.start >= min_size and region.chrom in refs:
@@ -5,7 +5,7 @@ import gzip
 import re
 import math
 import collections
-from eta import ETA
+from ngsutils.support.metrics import Progress
 
 
 class FASTQRead(collections.namedtuple('FASTQRead', 'name comment seq qual')):
@@ -84,23 +84,21 @@ class FASTQ(object):
         self.fileobj.seek(pos, whence)
 
     def fetch(self, quiet=False):
-        if self.fname and not quiet:
-            eta = ETA(os.stat(self.fname).st_size, fileobj=self.fileobj)
+        if self.fname and self.fname != '-':
+            progress = Progress(os.stat(self.fname).st_size, fileobj=self.fileobj, extra=lambda read: read.name, stage='fastq', quiet=quiet)
         else:
-            eta = None
+            progress = Progress(stage='fastq', quiet=True)
 
         while True:
             try:
                 read = fastq_read_file(self.fileobj)
-                if eta:
-                    eta.print_status(extra=read.name)
+                progress.update(read)
                 yield read
 
             except:
                 break
 
-        if eta:
-            eta.done()
+        progress.done()
 
     def close(self):
         if self.fileobj != sys.stdout:
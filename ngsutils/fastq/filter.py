@@ -10,6 +10,7 @@ import sys
 import os
 
 from ngsutils.fastq import FASTQ
+from ngsutils.support import metrics
 
 
 def fastq_filter(filter_chain, stats_fname=None, out=sys.stdout, quiet=False):
@@ -25,6 +26,11 @@ def fastq_filter(filter_chain, stats_fname=None, out=sys.stdout, quiet=False):
         stats.insert(0, (p.__class__.__name__, p.kept, p.altered, p.removed))
         p = p.parent
 
+    for name, kept, altered, removed in stats:
+        metrics.count('filter', '%s kept' % name, kept)
+        metrics.count('filter', '%s altered' % name, altered)
+        metrics.count('filter', '%s removed' % name, removed)
+
     if not quiet:
         sys.stderr.write('Criteria\tKept\tAltered\tRemoved\n')
         for name, kept, altered, removed in stats:
@@ -18,19 +18,14 @@ sufficient overlap with the junction is established when reads are mapped.
 
 import os
 import sys
-import pysam
 from ngsutils.gtf import GTF
+from ngsutils.support.reference import open_reference
 from eta import ETA
 
 
 def gtf_junctions(gtf, refname, fragment_size, min_size, max_exons=5, known=False, out=sys.stdout, quiet=False):
-    ref = pysam.Fastafile(refname)
-
-    references = []
-    with open('%s.fai' % refname) as f:
-        for line in f:
-            cols = line.split('\t')
-            references.append(cols[0])
+    ref = open_reference(refname, quiet=quiet)
+    references = set(ref.references)
 
     if not quiet:
         eta = ETA(gtf.fsize(), fileobj=gtf)
@@ -132,8 +127,8 @@ Usage: gtfutils junctions {opts} genes.gtf{.gz} genome.fasta
 
 Arguments
   genes.txt       Gene model in GTF format
-  genome.fasta    Reference genome in FASTA or RAGZ format
-                  (samtools indexed ref.fasta.fai req'd)
+  genome.fasta    Reference genome in FASTA format
+                  (converted to genome.fasta.ngs2bit on first use)
 
 Options
   -frag size      Number of bases on either side of the junction to include
@@ -168,8 +163,6 @@ if __name__ == '__main__':
         elif gtf is None and os.path.exists(arg):
             gtf = arg
         elif fasta is None and os.path.exists(arg):
-            if not os.path.exists('%s.fai' % arg):
-                usage('Missing .fai FASTA index for file: %s' % arg)
             fasta = arg
 
     if not gtf or not fasta:
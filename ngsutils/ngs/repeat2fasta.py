@@ -10,7 +10,7 @@ simple repeats, etc...)
 import sys
 import os
 import gzip
-import pysam
+from ngsutils.support.reference import open_reference
 
 
 def repeat2fasta(repeat_fname, ref_fname, repeat_family=None):
@@ -19,7 +19,7 @@ def repeat2fasta(repeat_fname, ref_fname, repeat_family=None):
     else:
         repeat_f = open(repeat_fname)
     
-    ref = pysam.Fastafile(ref_fname)
+    ref = open_reference(ref_fname)
     repeat_f.next()
     repeat_f.next()
     repeat_f.next()
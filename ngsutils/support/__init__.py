@@ -3,7 +3,9 @@ import gzip
 import os
 import sys
 import re
-from eta import ETA
+import threading
+import Queue
+from ngsutils.support.metrics import Progress
 
 
 class FASTARead(collections.namedtuple('FASTARecord', 'name comment seq')):
@@ -62,10 +64,10 @@ class FASTA(object):
         comment = ''
         seq = ''
 
-        if not quiet and self.fname and self.fname != '-':
-            eta = ETA(os.stat(self.fname).st_size, fileobj=self.fileobj)
+        if self.fname and self.fname != '-':
+            progress = Progress(os.stat(self.fname).st_size, fileobj=self.fileobj, extra=str, stage='fasta', quiet=quiet)
         else:
-            eta = None
+            progress = Progress(stage='fasta', quiet=True)
 
         for line in self.fileobj:
             line = line.strip()
@@ -76,8 +78,7 @@ class FASTA(object):
 
             if line[0] == '>':
                 if name and seq:
-                    if eta:
-                        eta.print_status(extra=name)
+                    progress.update(name)
                     yield FASTARead(name, comment, seq)
 
                 spl = re.split(r'[ \t]', line[1:], maxsplit=1)
@@ -95,12 +96,10 @@ class FASTA(object):
                     seq += line
 
         if name and seq:
-            if eta:
-                eta.print_status(extra=name)
+            progress.update(name)
             yield FASTARead(name, comment, seq)
 
-        if eta:
-            eta.done()
+        progress.done()
 
 
 def gzip_reader(fname, quiet=False, callback=None, done_callback=None):
@@ -111,19 +110,18 @@ def gzip_reader(fname, quiet=False, callback=None, done_callback=None):
     else:
         f = open(os.path.expanduser(fname))
 
-    if quiet or fname == '-':
-        eta = None
+    if callback:
+        extra = lambda line: callback()
     else:
-        eta = ETA(os.stat(fname).st_size, fileobj=f)
+        extra = None
 
-    for line in f:
-        if eta:
-            if callback:
-                extra = callback()
-            else:
-                extra = ''
+    if fname == '-':
+        progress = Progress(stage='text', quiet=True)
+    else:
+        progress = Progress(os.stat(fname).st_size, fileobj=f, extra=extra, stage='text', quiet=quiet)
 
-            eta.print_status(extra=extra)
+    for line in f:
+        progress.update(line)
         yield line
 
         if done_callback and done_callback():
@@ -132,8 +130,46 @@ def gzip_reader(fname, quiet=False, callback=None, done_callback=None):
     if f != sys.stdout:
         f.close()
 
-    if eta:
-        eta.done()
+    progress.done()
+
+
+def prefetch(gen, size=16, chunk=64):
+    '''
+    Runs a generator in its own thread, reading ahead of the caller. Values
+    are passed to the caller in lists of (up to) chunk values, and at most
+    size lists are read ahead. Any exception raised by the generator is
+    re-raised in the caller.
+
+    >>> list(prefetch(iter(xrange(10)), size=2, chunk=3))
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+    '''
+    queue = Queue.Queue(size)
+
+    def _reader():
+        try:
+            buf = []
+            for val in gen:
+                buf.append(val)
+                if len(buf) >= chunk:
+                    queue.put((buf, None))
+                    buf = []
+            queue.put((buf, None))
+            queue.put((None, None))
+        except Exception:
+            queue.put((None, sys.exc_info()))
+
+    thread = threading.Thread(target=_reader)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        buf, exc_info = queue.get()
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if buf is None:
+            break
+        for val in buf:
+            yield val
 
 
 class Symbolize(object):
@@ -213,3 +249,23 @@ def memoize(func):
         return __cache[k]
 
     return inner
+
+
+def positive_int_arg(opt, arg, usage):
+    '''
+    Returns the value of a command-line option that must be a positive
+    integer (such as -p num). Otherwise, shows an error and calls usage().
+
+    >>> positive_int_arg('-p', '4', None)
+    4
+    '''
+    try:
+        val = int(arg)
+    except ValueError:
+        val = 0
+
+    if val < 1:
+        print "Error: Invalid value for %s: %s" % (opt, arg)
+        usage()
+
+    return val
@@ -4,11 +4,27 @@ Extract the blocks from a BGZip file.
 
 BAM files are stored as blocks in a bgzip archive. This class
 will load the bgzip archive and output the block information.
+
+BGZipWriter writes a bgzip file, compressing the blocks with a pool of
+threads (zlib releases the GIL while compressing). BGZipPipe streams another
+writer's bgzip output (such as an uncompressed BAM file from pysam) through a
+BGZipWriter.
 '''
 
 import sys
 import os
+import shutil
 import struct
+import tempfile
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+
+# the most uncompressed data in one block (the same as samtools)
+_BLOCK_SIZE = 0xff00
+
+# the empty block that marks the end of a bgzip file
+_EOF_BLOCK = '1f8b08040000000000ff0600424302001b0003000000000000000000'.decode('hex')
 
 
 class BGZip(object):
@@ -133,5 +149,191 @@ class BGZip(object):
         self.pos += size
         return struct.unpack(field_types, self.fileobj.read(size))
 
+class BGZipWriter(object):
+    '''
+    Writes a bgzip file. Data is split into blocks, and batches of blocks are
+    compressed by threads threads. Blocks are always written in order.
+    '''
+    def __init__(self, fname, threads=1, level=6):
+        self.fileobj = open(fname, 'wb')
+        self.level = level
+        self.threads = threads
+        self._buf = []
+        self._buflen = 0
+        self._blocks = []
+
+        if threads > 1:
+            self._pool = ThreadPool(threads)
+        else:
+            self._pool = None
+
+    def write(self, data):
+        self._buf.append(data)
+        self._buflen += len(data)
+
+        if self._buflen >= _BLOCK_SIZE:
+            data = ''.join(self._buf)
+            pos = 0
+            while len(data) - pos >= _BLOCK_SIZE:
+                self._blocks.append(data[pos:pos + _BLOCK_SIZE])
+                pos += _BLOCK_SIZE
+            self._buf = [data[pos:]]
+            self._buflen = len(data) - pos
+
+            if len(self._blocks) >= self.threads * 4:
+                self._flush()
+
+    def _flush(self):
+        if self._pool:
+            blocks = self._pool.map(self._compress, self._blocks)
+        else:
+            blocks = [self._compress(x) for x in self._blocks]
+
+        for block in blocks:
+            self.fileobj.write(block)
+
+        self._blocks = []
+
+    def _compress(self, data):
+        return bgzip_block(data, self.level)
+
+    def close(self):
+        if self._buflen:
+            self._blocks.append(''.join(self._buf))
+            self._buf = []
+            self._buflen = 0
+
+        self._flush()
+        self.fileobj.write(_EOF_BLOCK)
+        self.fileobj.close()
+
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+
+
+class BGZipPipe(object):
+    '''
+    A named pipe (FIFO) that recompresses the bgzip data written to it (for
+    example, a BAM file written by pysam with mode 'wbu') to fname, using a
+    BGZipWriter in a separate thread. The data is streamed, so the
+    uncompressed data is never written to disk.
+
+    Open and write to .path, then call close() once that file is closed. The
+    output file is created here, so an error opening it is raised before
+    anything waits on the pipe.
+    '''
+    def __init__(self, fname, threads=1, level=6):
+        self._out = BGZipWriter(fname, threads, level)
+        self._tmpdir = tempfile.mkdtemp(prefix='.ngsutils_bgzip')
+        self.path = os.path.join(self._tmpdir, 'pipe')
+        os.mkfifo(self.path)
+
+        self._error = None
+        self._opened = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with open(self.path, 'rb') as f:
+                self._opened = True
+                for data in bgzip_blocks(f):
+                    self._out.write(data)
+            self._out.close()
+        except Exception, e:
+            self._error = e
+            self._out.fileobj.close()
+
+    def abort(self):
+        '''
+        Stops the writing thread and removes the pipe, without raising any
+        errors. This is for cleaning up after an error (the file written to
+        .path must be closed first).
+        '''
+        if not self._thread:
+            return
+
+        # if .path was never opened, the thread is still waiting for a writer
+        while self._thread.is_alive():
+            if not self._opened:
+                try:
+                    os.close(os.open(self.path, os.O_WRONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+            self._thread.join(0.1)
+        self._thread = None
+        shutil.rmtree(self._tmpdir, True)
+
+    def close(self):
+        self.abort()
+        if self._error:
+            raise self._error
+
+
+def bgzip_block(data, level=6):
+    '''
+    Compresses data (at most 64K) into one bgzip block
+
+    >>> import gzip, StringIO
+    >>> gzip.GzipFile(fileobj=StringIO.StringIO(bgzip_block('foo bar'))).read()
+    'foo bar'
+    '''
+    comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = comp.compress(data) + comp.flush()
+
+    # BSIZE is the total block size - 1 (18 header bytes, 8 footer bytes)
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+    return '%s%s%s' % (header, cdata, footer)
+
+
+def bgzip_blocks(fileobj):
+    '''
+    Yields the uncompressed data for each block of a bgzip file
+    '''
+    while True:
+        header = fileobj.read(12)
+        if not header:
+            break
+
+        if len(header) < 12 or header[:2] != '\x1f\x8b':
+            raise ValueError('Invalid bgzip block')
+
+        xlen, = struct.unpack('<H', header[10:12])
+        extra = fileobj.read(xlen)
+
+        bsize = None
+        pos = 0
+        while pos < xlen:
+            si1, si2, slen = struct.unpack('<BBH', extra[pos:pos + 4])
+            if si1 == 66 and si2 == 67:
+                bsize, = struct.unpack('<H', extra[pos + 4:pos + 6])
+            pos += 4 + slen
+
+        if bsize is None:
+            raise ValueError('Invalid bgzip block (missing block size)')
+
+        cdata = fileobj.read(bsize - xlen - 19)
+        fileobj.read(8)  # crc32, isize
+
+        data = zlib.decompress(cdata, -15)
+        if data:
+            yield data
+
+
+def bgzip_recompress(infname, outfname, threads=1, level=6):
+    '''
+    Recompresses a bgzip file (such as an uncompressed BAM file, written with
+    mode 'wbu') using threads threads.
+    '''
+    out = BGZipWriter(outfname, threads, level)
+    with open(infname, 'rb') as f:
+        for data in bgzip_blocks(f):
+            out.write(data)
+    out.close()
+
+
 if __name__ == '__main__':
     print BGZip(sys.argv[1]).dump()
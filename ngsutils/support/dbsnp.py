@@ -1,12 +1,44 @@
 '''
 Support package for processing a dbSNP tabix dump from UCSC.
+
+Looking up each variation with its own tabix query is slow for a sorted BAM
+file, where the same region is queried over and over. If a window size is
+given, all of the SNPs in a window (1Mb) are loaded at once into sorted
+arrays, and each variation is found by binary search. The window is moved
+forward as the queries move forward. Queries before the current window
+(or on a reference that has already been passed) use tabix directly. If most
+queries miss the window (the input isn't sorted), windows aren't used
+anymore.
 '''
 
 import pysam
 import collections
 import sys
+import numpy
 from ngsutils.support import revcomp
 
+DEFAULT_WINDOW = 1000000
+
+# new windows start this far before the query that triggered the load, so
+# that variations from overlapping reads are still in the window
+_WINDOW_OVERLAP = 10000
+
+# windows are disabled if more than half of the queries miss (after this
+# many queries)
+_MIN_QUERIES = 1000
+
+_VALID_CLASSES = ['single', 'mixed', 'in-del', 'insertion', 'deletion']
+
+# the ops (0: match/mismatch, 1: insertion, 2: deletion) that each class of
+# SNP can match
+_CLASS_OPS = {
+    'single': 1 << 0,
+    'mixed': (1 << 0) | (1 << 1) | (1 << 2),
+    'in-del': (1 << 1) | (1 << 2),
+    'insertion': 1 << 1,
+    'deletion': 1 << 2,
+}
+
 
 class SNPRecord(collections.namedtuple('SNPRecord', '''bin
 chrom
@@ -39,20 +71,30 @@ bitfields
 
     @property
     def alleles(self):
-        alts = []
-        for alt in self.observed.split('/'):
-            if alt != '-' and self.strand == '-':
-                alt = revcomp(alt)
-
-            alts.append(alt)
-
-        return alts
+        return _alleles(self.observed, self.strand)
 
     @property
     def snp_length(self):
         return self.chromEnd - self.chromStart
 
 
+def _alleles(observed, strand):
+    '''
+    >>> _alleles('A/G', '+')
+    ['A', 'G']
+    >>> _alleles('-/AC', '-')
+    ['-', 'GT']
+    '''
+    alts = []
+    for alt in observed.split('/'):
+        if alt != '-' and strand == '-':
+            alt = revcomp(alt)
+
+        alts.append(alt)
+
+    return alts
+
+
 def autotype(ar, length=26):
     out = []
     for el in ar:
@@ -75,11 +117,83 @@ def autotype(ar, length=26):
     return out
 
 
+class _SNPWindow(object):
+    '''
+    The SNPs for one window of a reference. The positions are kept in a
+    sorted array, along with the ops each SNP can match and an index into a
+    table of the allele sets (most SNPs share the same few allele sets).
+    '''
+    def __init__(self, dbsnp, chrom, start, end, parser):
+        self.chrom = chrom
+        self.start = start
+        self.end = end
+
+        positions = []
+        ops = []
+        allele_ids = []
+        self.allele_sets = []
+        allele_set_ids = {}
+
+        if chrom in dbsnp.contigs:
+            for tup in dbsnp.fetch(chrom, start, end, parser=parser):
+                if len(tup) < 12:
+                    raise TypeError("Invalid dbSNP file! We need at least 12 columns to work with.")
+
+                pos = int(tup[2])
+                observed = tup[9]
+                clazz = tup[11]
+
+                if pos < start or not '/' in observed or not clazz in _CLASS_OPS:
+                    continue
+
+                alleles = frozenset(_alleles(observed, tup[6]))
+                if clazz in ['deletion', 'mixed', 'in-del'] and not '-' in alleles:
+                    # deletions need to have a '-' allele
+                    op_mask = _CLASS_OPS[clazz] & ~(1 << 2)
+                else:
+                    op_mask = _CLASS_OPS[clazz]
+
+                if not alleles in allele_set_ids:
+                    allele_set_ids[alleles] = len(self.allele_sets)
+                    self.allele_sets.append(alleles)
+
+                positions.append(pos)
+                ops.append(op_mask)
+                allele_ids.append(allele_set_ids[alleles])
+
+        order = numpy.argsort(numpy.array(positions, dtype=numpy.int64), kind='mergesort')
+        self.positions = numpy.array(positions, dtype=numpy.int64)[order]
+        self.ops = numpy.array(ops, dtype=numpy.uint8)[order]
+        self.allele_ids = numpy.array(allele_ids, dtype=numpy.int32)[order]
+
+    def __contains__(self, pos):
+        return self.start <= pos < self.end
+
+    def is_valid_variation(self, op, pos, seq):
+        i = self.positions.searchsorted(pos, 'left')
+        while i < len(self.positions) and self.positions[i] == pos:
+            if self.ops[i] & (1 << op) and seq in self.allele_sets[self.allele_ids[i]]:
+                return True
+            i += 1
+        return False
+
+
 class DBSNP(object):
-    def __init__(self, fname):
+    '''
+    A tabix indexed dbSNP dump. If window is given (in bases), SNPs are
+    loaded a window at a time (see above).
+    '''
+    def __init__(self, fname, window=None):
         self.dbsnp = pysam.Tabixfile(fname)
         self.asTup = pysam.asTuple()
 
+        self.window_size = window
+        self._window = None
+        self._passed_chroms = set()
+        self.window_hits = 0
+        self.window_misses = 0
+        self.window_loads = 0
+
     def fetch(self, chrom, pos):
         'Note: pos is 0-based'
 
@@ -102,9 +216,44 @@ class DBSNP(object):
         if exit:
             sys.exit(1)
 
+    def _get_window(self, chrom, pos):
+        '''
+        Returns the window for this position (loading a new window if the
+        queries have moved forward), or None if the position should be
+        looked up directly.
+        '''
+        window = self._window
+        if window and window.chrom == chrom and pos in window:
+            self.window_hits += 1
+            return window
+
+        self.window_misses += 1
+        if self.window_misses > _MIN_QUERIES and self.window_misses > self.window_hits:
+            # the input isn't sorted, so stop using windows
+            self.window_size = None
+            self._window = None
+            return None
+
+        if window and window.chrom == chrom and pos < window.start:
+            return None
+
+        if window and window.chrom != chrom:
+            if chrom in self._passed_chroms:
+                return None
+            self._passed_chroms.add(window.chrom)
+
+        self.window_loads += 1
+        self._window = _SNPWindow(self.dbsnp, chrom, max(0, pos - _WINDOW_OVERLAP), pos + self.window_size, self.asTup)
+        return self._window
+
     def is_valid_variation(self, chrom, op, pos, seq, verbose=False):
+        if self.window_size and not verbose:
+            window = self._get_window(chrom, pos)
+            if window:
+                return window.is_valid_variation(op, pos, seq)
+
         for snp in self.fetch(chrom, pos):
-            if not '/' in snp.observed or snp.clazz not in ['single', 'mixed', 'in-del', 'insertion', 'deletion']:
+            if not '/' in snp.observed or snp.clazz not in _VALID_CLASSES:
                 # these are odd variations that we can't deal with... (microsatellites, tooLongToDisplay members, etc)
                 continue
 
@@ -0,0 +1,129 @@
+'''
+Fast overlap checks for a fixed set of genomic intervals
+
+The intervals for each reference (tid) and strand are kept in arrays sorted
+by their start position, along with the running maximum of their end
+positions. An interval [start, end] overlaps a query if its start is <= the
+end of the query and its end is >= the start of the query. So for a query,
+the intervals with a start <= the end of the query are found (bisect), and
+the maximum end of these intervals is compared to the start of the query.
+
+Queries are usually made in order (reads from a sorted BAM file), so the
+last position found for each reference / strand is kept as a cursor. If the
+next query ends in the same gap between interval starts, no search is
+needed.
+
+Intervals are closed (inclusive of both start and end), the same as
+BedFile.fetch().
+'''
+
+import bisect
+
+
+class _SortedIntervals(object):
+    __slots__ = ['starts', 'maxends', 'cursor']
+
+    def __init__(self, intervals):
+        intervals.sort()
+        self.starts = [start for start, end in intervals]
+        self.maxends = []
+        self.cursor = 0
+
+        maxend = None
+        for start, end in intervals:
+            if maxend is None or end > maxend:
+                maxend = end
+            self.maxends.append(maxend)
+
+
+class IntervalIndex(object):
+    '''
+    An index of intervals (by reference and strand) that can be checked for
+    overlaps. Intervals can be added by reference name or tid, but are
+    queried by tid (the names are converted using the list of references).
+
+    >>> index = IntervalIndex(['chr1', 'chr2'])
+    >>> index.add('chr1', 100, 150, '+')
+    >>> index.add('chr1', 200, 250)
+    >>> index.add(1, 10, 20, '-')
+    >>> index.add('chrX', 10, 20)
+    >>> len(index)
+    3
+    >>> index.overlaps(0, 140, 160)
+    True
+    >>> index.overlaps(0, 151, 199)
+    False
+    >>> index.overlaps(0, 250, 300)
+    True
+    >>> index.overlaps(0, 140, 160, '+')
+    True
+    >>> index.overlaps(0, 140, 160, '-')
+    False
+    >>> index.overlaps(0, 210, 220, '+')
+    False
+    >>> index.overlaps(1, 1, 50, '-')
+    True
+    >>> index.overlaps(2, 10, 20)
+    False
+    '''
+    def __init__(self, references=None):
+        if references:
+            self._tids = dict([(ref, tid) for tid, ref in enumerate(references)])
+        else:
+            self._tids = {}
+
+        self._intervals = {}
+        self._index = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, chrom, start, end, strand=None):
+        '''
+        Adds an interval. chrom can be a reference name or a tid. Intervals on
+        references that aren't in the list of references are ignored.
+        '''
+        if chrom in self._tids:
+            tid = self._tids[chrom]
+        elif isinstance(chrom, int):
+            tid = chrom
+        else:
+            return
+
+        # each interval is added to the index for any strand, and the index
+        # for its own strand (if it has one)
+        for key in set([(tid, None), (tid, strand)]):
+            if not key in self._intervals:
+                self._intervals[key] = []
+            self._intervals[key].append((start, end))
+
+        self._count += 1
+        self._index = None
+
+    def overlaps(self, tid, start, end, strand=None):
+        '''
+        Returns True if any interval on this reference overlaps [start, end].
+        If strand is given, only intervals on that strand are checked.
+        '''
+        if self._index is None:
+            self._build()
+
+        intervals = self._index.get((tid, strand))
+        if intervals is None:
+            return False
+
+        starts = intervals.starts
+
+        # i is the number of intervals that start at or before the end
+        i = intervals.cursor
+        if (i > 0 and starts[i - 1] > end) or (i < len(starts) and starts[i] <= end):
+            i = bisect.bisect_right(starts, end)
+            intervals.cursor = i
+
+        return i > 0 and intervals.maxends[i - 1] >= start
+
+    def _build(self):
+        self._index = {}
+        for key in self._intervals:
+            self._index[key] = _SortedIntervals(self._intervals[key][:])
@@ -0,0 +1,241 @@
+'''
+Progress meters and run metrics
+
+When reading a file record by record, the progress meter (ETA) only needs to
+be updated a few times a second (or less if stderr isn't a terminal). A
+Progress object counts each record, but only checks the time every so often,
+and only calls the ETA (and builds the status string for the record) when an
+update is actually due. The number of records between time checks is
+adjusted to the speed of the reader, so slow readers still update on time.
+
+Each Progress object belongs to a stage (bam, pileup, fastq, fasta, etc). When
+it is done, its totals (records, bytes read and time) are added to the
+metrics for that stage. Commands can also keep their own counters (such as
+the number of reads kept or dropped by a filter) with count().
+
+To save the metrics for a command, add "--metrics out.json" to the command
+line of bamutils, bedutils, fastqutils, or gtfutils. The command is then run
+with this module (as with "profile"), and the metrics are written to
+out.json when the command exits:
+
+    python -m ngsutils.support.metrics out.json command.py {args}
+'''
+
+import json
+import os
+import resource
+import runpy
+import sys
+import time
+import weakref
+
+from eta import ETA
+
+# the number of records between time checks is adjusted to keep the time
+# between checks in this range (seconds)
+_CHECK_MIN = 0.01
+_CHECK_MAX = 0.1
+_CHECK_EVERY_MAX = 65536
+
+_stages = {}
+_counters = {}
+_active = weakref.WeakSet()
+
+
+class Progress(object):
+    '''
+    A throttled progress meter (ETA) that also counts records for the metrics.
+
+    total     - the total size (bytes or records)
+    fileobj   - the file that is being read (the ETA uses fileobj.tell())
+    position  - function that returns the current position (if not fileobj)
+    extra     - function that returns the status string for a record (only
+                called when the status is shown)
+    stage     - the name of the stage for the metrics
+    quiet     - don't show a progress meter (records are still counted)
+    interval  - the minimum number of seconds between status updates
+                (default: 0.2 if stderr is a terminal, otherwise 10)
+    '''
+    def __init__(self, total=0, fileobj=None, position=None, extra=None, stage=None, quiet=False, interval=None):
+        self.fileobj = fileobj
+        self.position = position
+        self.extra = extra
+        self.stage = stage
+
+        if quiet:
+            self.eta = None
+        else:
+            self.eta = ETA(total, fileobj=fileobj)
+
+        if interval is None:
+            if sys.stderr.isatty():
+                interval = 0.2
+            else:
+                interval = 10
+
+        self.interval = interval
+        self.records = 0
+        self.started = time.time()
+
+        self._check_every = 1
+        self._next_check = 1
+        self._last_check = self.started
+        self._last_update = 0
+        self._done = False
+
+        _active.add(self)
+
+    def update(self, record=None, current=None):
+        '''
+        Counts one record. If an update is due, the status is shown for this
+        record (at position current, or the position of the file).
+        '''
+        self.records += 1
+        if self.records < self._next_check:
+            return
+
+        now = time.time()
+        elapsed = now - self._last_check
+        if elapsed < _CHECK_MIN and self._check_every < _CHECK_EVERY_MAX:
+            self._check_every *= 2
+        elif elapsed > _CHECK_MAX and self._check_every > 1:
+            self._check_every /= 2
+
+        self._last_check = now
+        self._next_check = self.records + self._check_every
+
+        if self.eta and now - self._last_update >= self.interval:
+            self._last_update = now
+            if current is None and self.position:
+                current = self.position()
+
+            if self.extra and record is not None:
+                self.eta.print_status(current, extra=self.extra(record))
+            else:
+                self.eta.print_status(current)
+
+    def done(self):
+        'Finishes the progress meter and adds the totals to the metrics'
+        if self._done:
+            return
+
+        self._done = True
+        _active.discard(self)
+        self._add_stage()
+
+        if self.eta:
+            self.eta.done()
+
+    def tell(self):
+        'The current position (compressed bytes if known)'
+        try:
+            if self.position:
+                return self.position()
+            if self.fileobj:
+                try:
+                    return self.fileobj.fileobj.tell()
+                except AttributeError:
+                    return self.fileobj.tell()
+        except (IOError, ValueError):
+            pass
+        return 0
+
+    def _add_stage(self):
+        if not self.stage:
+            return
+
+        if not self.stage in _stages:
+            _stages[self.stage] = {'records': 0, 'bytes': 0, 'seconds': 0.0}
+
+        _stages[self.stage]['records'] += self.records
+        _stages[self.stage]['bytes'] += self.tell()
+        _stages[self.stage]['seconds'] += time.time() - self.started
+
+
+def count(stage, key, n=1):
+    'Adds n to a counter (for example, the number of reads dropped by a filter)'
+    if not stage in _counters:
+        _counters[stage] = {}
+    if not key in _counters[stage]:
+        _counters[stage][key] = 0
+    _counters[stage][key] += n
+
+
+def metrics():
+    '''
+    Returns the metrics collected so far, with the rates (per second) for each
+    stage. Progress meters that haven't finished yet are included.
+    '''
+    for progress in list(_active):
+        progress.done()
+
+    stages = {}
+    for stage in _stages:
+        vals = dict(_stages[stage])
+        if vals['seconds'] > 0:
+            vals['records_per_sec'] = vals['records'] / vals['seconds']
+            vals['bytes_per_sec'] = vals['bytes'] / vals['seconds']
+        else:
+            vals['records_per_sec'] = 0.0
+            vals['bytes_per_sec'] = 0.0
+        stages[stage] = vals
+
+    counters = {}
+    for stage in _counters:
+        counters[stage] = dict(_counters[stage])
+
+    return {'stages': stages, 'counters': counters}
+
+
+def reset():
+    'Clears the metrics'
+    _stages.clear()
+    _counters.clear()
+
+
+def write_metrics(fname, extra=None):
+    'Writes the metrics (and any extra values) to a JSON file'
+    vals = metrics()
+    if extra:
+        vals.update(extra)
+
+    with open(fname, 'w') as out:
+        json.dump(vals, out, indent=2, sort_keys=True)
+        out.write('\n')
+
+
+def run(fname, script, args):
+    '''
+    Runs a command script (as __main__) and writes the metrics to fname when it
+    exits, along with the command line, the run time, CPU time and memory used.
+    '''
+    sys.argv = [script] + list(args)
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+
+    started = time.time()
+    code = 0
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit, e:
+        code = e.code
+    finally:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        write_metrics(fname, {'command': [os.path.basename(script)] + list(args),
+                              'exit_code': code,
+                              'seconds': time.time() - started,
+                              'cpu_seconds': usage.ru_utime + usage.ru_stime,
+                              'max_rss_kb': usage.ru_maxrss})
+
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    # use the imported module (not __main__), so that the commands see the
+    # same counters
+    import ngsutils.support.metrics
+
+    if len(sys.argv) < 3:
+        sys.stderr.write('Usage: python -m ngsutils.support.metrics out.json command.py {args}\n')
+        sys.exit(1)
+
+    ngsutils.support.metrics.run(sys.argv[1], sys.argv[2], sys.argv[3:])
@@ -0,0 +1,363 @@
+'''
+Packed 2-bit reference genome accessor
+
+pysam.Fastafile runs a faidx lookup (and file seek) for each fetch, which is
+slow for the many tiny fetches made by things like bamutils basecall or the
+-mismatchref filters. This module converts a FASTA file once into a packed
+2-bit file (ref.fa.ngs2bit) and a sidecar index (ref.fa.ngs2bit.idx). The
+index holds the name, length and offset of each reference, along with the
+blocks of N's and lowercase bases for each reference. The packed file is
+memory-mapped, so a fetch is a slice of the mapped file and a table lookup to
+decode the bases.
+
+The sidecar files are keyed on the size and mtime of the FASTA file. If
+either changes, the packed file is regenerated. If the files can't be written
+next to the FASTA file, the packed sequence is kept in a temporary file
+instead.
+
+Reference can be used in place of a pysam.Fastafile. As with
+pysam.Fastafile, fetching from an unknown reference returns ''. Reference
+names are also matched with or without a 'chr' prefix (1 <=> chr1,
+MT <=> chrM), so that EBI/Ensembl style names can be used with a UCSC style
+reference (or vice versa).
+
+Note: only A, C, G, T and N are stored. Other IUPAC codes are returned as N.
+'''
+
+import gzip
+import sys
+
+import numpy
+
+from ngsutils.support import sidecar
+
+# bases are converted in chunks of this size
+_CHUNK_SIZE = 1 << 20
+
+# fetch_many decodes one span for all of the regions on a reference if they
+# are within this many bases of each other
+_BATCH_SPAN = 1 << 16
+
+_N_CODE = 4
+
+# ASCII -> 2-bit code (A/C/G/T: 0-3, everything else is an N)
+_ENCODE = numpy.empty(256, dtype=numpy.uint8)
+_ENCODE.fill(_N_CODE)
+for _i, _base in enumerate('ACGT'):
+    _ENCODE[ord(_base)] = _i
+    _ENCODE[ord(_base.lower())] = _i
+
+# packed byte -> four ASCII bases
+_UNPACK = numpy.array([[ord('ACGT'[(_i >> _shift) & 3]) for _shift in (6, 4, 2, 0)] for _i in xrange(256)], dtype=numpy.uint8)
+
+
+class Reference(object):
+    '''
+    A reference FASTA file, backed by a memory-mapped 2-bit file (see above).
+
+    References are fetched with 0-based, half-open coordinates, like
+    pysam.Fastafile.
+    '''
+    _version = 1
+
+    def __init__(self, fname, cache_enabled=True, quiet=False):
+        self.filename = fname
+        self.packfile = '%s.ngs2bit' % fname
+        self.indexfile = '%s.ngs2bit.idx' % fname
+        self.built = False
+
+        self._mm = None
+        self._packf = None
+
+        key = sidecar.file_key(fname)
+        cached = None
+        if cache_enabled:
+            cached = sidecar.load(self.indexfile, Reference._version, key, self.packfile)
+
+        if not cached:
+            if not quiet:
+                sys.stderr.write('Converting reference to 2-bit (%s)...\n' % self.filename)
+            cached = sidecar.build(self.packfile, self.indexfile, Reference._version, key, lambda out: _pack_fasta(self.filename, out), cache_enabled, quiet, '2-bit reference')
+            self.built = True
+
+        self._seqs, self._packf, size = cached
+        self._mm = sidecar.map_file(self._packf, size)
+        if self._mm:
+            self._data = numpy.frombuffer(self._mm, dtype=numpy.uint8)
+        else:
+            self._data = numpy.zeros(0, dtype=numpy.uint8)
+
+        self.references = [x[0] for x in self._seqs]
+        self.lengths = [x[1] for x in self._seqs]
+        self.nreferences = len(self._seqs)
+
+        self._names = {}
+        for seq in self._seqs:
+            self._names[seq[0]] = seq
+
+    def close(self):
+        self._data = None
+        if self._mm:
+            self._mm.close()
+            self._mm = None
+        if self._packf:
+            self._packf.close()
+            self._packf = None
+
+    def _lookup(self, reference):
+        'Find a reference by name, adding or removing a chr prefix if needed'
+        if reference in self._names:
+            return self._names[reference]
+
+        if reference.startswith('chr'):
+            alt = reference[3:]
+            if alt == 'M':
+                alt = 'MT'
+        elif reference == 'MT':
+            alt = 'chrM'
+        else:
+            alt = 'chr%s' % reference
+
+        seq = self._names.get(alt)
+
+        # remember the answer (even if it isn't found)
+        self._names[reference] = seq
+        return seq
+
+    def get_reference_length(self, reference):
+        seq = self._lookup(reference)
+        if not seq:
+            raise KeyError(reference)
+        return seq[1]
+
+    def fetch(self, reference, start=None, end=None):
+        seq = self._lookup(reference)
+        if not seq:
+            return ''
+
+        start, end = _clip(seq[1], start, end)
+        if start >= end:
+            return ''
+
+        return self._decode(seq, start, end).tostring()
+
+    def fetch_many(self, regions):
+        '''
+        Returns the sequences for a list of (reference, start, end) regions (in
+        the same order). Runs of regions on the same reference that are close
+        together are decoded at once.
+        '''
+        out = []
+        run = []
+
+        for region in regions:
+            if run and (region[0] != run[0][0] or abs(region[1] - run[0][1]) > _BATCH_SPAN):
+                out.extend(self._fetch_run(run))
+                run = []
+            run.append(region)
+
+        if run:
+            out.extend(self._fetch_run(run))
+
+        return out
+
+    def _fetch_run(self, run):
+        seq = self._lookup(run[0][0])
+        if not seq:
+            return [''] * len(run)
+
+        spans = [_clip(seq[1], start, end) for ref, start, end in run]
+        span_start = min([x[0] for x in spans])
+        span_end = max([x[1] for x in spans])
+
+        if span_start >= span_end:
+            return [''] * len(run)
+
+        bases = self._decode(seq, span_start, span_end)
+        out = []
+        for start, end in spans:
+            if start >= end:
+                out.append('')
+            else:
+                out.append(bases[start - span_start:end - span_start].tostring())
+        return out
+
+    def _decode(self, seq, start, end):
+        'Returns the bases for [start, end) of a reference as an ASCII array'
+        name, length, offset, nblocks, lowerblocks = seq
+
+        first = start // 4
+        last = (end + 3) // 4
+        skip = start - (first * 4)
+
+        bases = _UNPACK[self._data[offset + first:offset + last]].ravel()[skip:skip + end - start]
+
+        for block_start, block_end in _overlapping(nblocks, start, end):
+            bases[block_start:block_end] = ord('N')
+
+        for block_start, block_end in _overlapping(lowerblocks, start, end):
+            bases[block_start:block_end] |= 0x20
+
+        return bases
+
+
+def open_reference(ref, quiet=False):
+    '''
+    Returns a Reference for a FASTA filename. Anything else (an already open
+    Reference or pysam.Fastafile) is returned as-is.
+    '''
+    if isinstance(ref, basestring):
+        return Reference(ref, quiet=quiet)
+    return ref
+
+
+def _clip(length, start, end):
+    if start is None or start < 0:
+        start = 0
+    if end is None or end > length:
+        end = length
+    return start, end
+
+
+def _overlapping(blocks, start, end):
+    '''
+    Yields the parts of the blocks that overlap [start, end), relative to start
+
+    >>> list(_overlapping((numpy.array([0, 10, 20]), numpy.array([5, 15, 25])), 3, 22))
+    [(0, 2), (7, 12), (17, 19)]
+    >>> list(_overlapping((numpy.array([0, 10, 20]), numpy.array([5, 15, 25])), 5, 10))
+    []
+    '''
+    starts, ends = blocks
+    i = ends.searchsorted(start, 'right')
+    j = starts.searchsorted(end, 'left')
+    for k in xrange(i, j):
+        yield max(starts[k], start) - start, min(ends[k], end) - start
+
+
+def _runs(mask, offset):
+    '''
+    Returns the (starts, ends) of the runs of True values in a boolean array
+
+    >>> _runs(numpy.array([True, True, False, True]), 10)
+    (array([10, 13]), array([12, 14]))
+    '''
+    edges = numpy.diff(numpy.concatenate(([0], mask.view(numpy.int8), [0])))
+    return (numpy.flatnonzero(edges == 1) + offset, numpy.flatnonzero(edges == -1) + offset)
+
+
+def _merge_runs(starts, ends):
+    '''
+    Joins lists of runs (from each chunk), merging runs that touch
+
+    >>> _merge_runs([numpy.array([0, 8]), numpy.array([10])], [numpy.array([2, 10]), numpy.array([12])])
+    (array([0, 8]), array([ 2, 12]))
+    '''
+    if not starts:
+        return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64))
+
+    starts = numpy.concatenate(starts).astype(numpy.int64)
+    ends = numpy.concatenate(ends).astype(numpy.int64)
+
+    if len(starts) > 1:
+        keep = numpy.concatenate(([True], starts[1:] != ends[:-1]))
+        ends = ends[numpy.concatenate((keep[1:], [True]))]
+        starts = starts[keep]
+
+    return (starts, ends)
+
+
+class _SeqPacker(object):
+    'Packs the bases for one reference, keeping track of the N and lowercase blocks'
+    def __init__(self, name, offset, out):
+        self.name = name
+        self.offset = offset
+        self.out = out
+        self.length = 0
+        self.size = 0
+
+        self._lines = []
+        self._buffered = 0
+        self._carry = numpy.zeros(0, dtype=numpy.uint8)
+        self._nblocks = ([], [])
+        self._lowerblocks = ([], [])
+
+    def add(self, line):
+        self._lines.append(line)
+        self._buffered += len(line)
+        if self._buffered >= _CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._lines:
+            return
+
+        chunk = numpy.fromstring(''.join(self._lines), dtype=numpy.uint8)
+        self._lines = []
+        self._buffered = 0
+
+        codes = _ENCODE[chunk]
+        nmask = codes == _N_CODE
+        codes[nmask] = 0
+
+        for blocks, mask in [(self._nblocks, nmask), (self._lowerblocks, chunk >= ord('a'))]:
+            if mask.any():
+                starts, ends = _runs(mask, self.length)
+                blocks[0].append(starts)
+                blocks[1].append(ends)
+
+        self.length += len(chunk)
+
+        codes = numpy.concatenate((self._carry, codes))
+        whole = (len(codes) // 4) * 4
+        self._write(codes[:whole])
+        self._carry = codes[whole:]
+
+    def _write(self, codes):
+        if len(codes):
+            packed = (codes[0::4] << 6) | (codes[1::4] << 4) | (codes[2::4] << 2) | codes[3::4]
+            self.out.write(packed.tostring())
+            self.size += len(packed)
+
+    def close(self):
+        'Returns the index entry for this reference'
+        self._flush()
+        if len(self._carry):
+            self._write(numpy.concatenate((self._carry, numpy.zeros(4 - len(self._carry), dtype=numpy.uint8))))
+
+        return (self.name, self.length, self.offset, _merge_runs(*self._nblocks), _merge_runs(*self._lowerblocks))
+
+
+def _pack_fasta(fname, out):
+    '''
+    Writes the packed bases for each reference in a FASTA file to out. Returns
+    the index entries for each reference and the total size written.
+    '''
+    if fname[-3:] == '.gz' or fname[-4:] == '.bgz':
+        f = gzip.open(fname)
+    else:
+        f = open(fname)
+
+    seqs = []
+    packer = None
+    size = 0
+
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+
+        if line[0] == '>':
+            if packer:
+                seqs.append(packer.close())
+                size += packer.size
+            packer = _SeqPacker(line[1:].split()[0], size, out)
+        elif packer:
+            packer.add(line)
+
+    if packer:
+        seqs.append(packer.close())
+        size += packer.size
+
+    f.close()
+    return seqs, size
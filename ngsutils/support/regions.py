@@ -141,6 +141,11 @@ class RegionTagger(object):
 
         return tag
 
+    def merge(self, other):
+        'Adds the counts from another RegionTagger'
+        for k in other.counts:
+            self.counts[k] += other.counts[k]
+
     def tag_region(self, chrom, start, end, strand):
         tag = None
         is_rev = False
@@ -0,0 +1,109 @@
+'''
+Sidecar cache files
+
+Values that are slow to calculate from an input file (a packed 2-bit
+reference, the region index of a junction library BAM file, a BAM summary)
+are kept in sidecar files next to the input file. Each cache has an index
+file: a pickle of the cache version, a key, the size of the data file (if
+there is one), and the cached values. The key is usually file_key() of the
+input file, so the cache is regenerated if the input file changes.
+
+Files are written to temporary files first and then renamed, so that a
+partial file is never read. If the data file can't be written next to the
+input file, it is written to an anonymous temporary file instead.
+'''
+
+import mmap
+import os
+import sys
+import tempfile
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+
+def file_key(fname):
+    'The cache key for a file (size and mtime)'
+    st = os.stat(fname)
+    return (st.st_size, st.st_mtime)
+
+
+def load(indexfile, version, key, datafile=None):
+    '''
+    Returns the cached values from an index file, or None if the files are
+    missing or unreadable, or the cache is for a different version or key.
+
+    If there is a data file, it must be the same size as when it was
+    written, and (values, fileobj, size) is returned, with fileobj open for
+    reading.
+    '''
+    if not os.path.exists(indexfile) or (datafile and not os.path.exists(datafile)):
+        return None
+
+    try:
+        with open(indexfile, 'rb') as f:
+            cache_version, cache_key, size, values = pickle.load(f)
+    except:
+        return None
+
+    if cache_version != version or cache_key != key:
+        return None
+
+    if not datafile:
+        return values
+
+    if os.stat(datafile).st_size != size:
+        return None
+
+    return values, open(datafile, 'rb'), size
+
+
+def save(indexfile, version, key, values, size=None):
+    'Writes the values to an index file'
+    tmpname = '%s.tmp%s' % (indexfile, os.getpid())
+    try:
+        with open(tmpname, 'wb') as f:
+            pickle.dump((version, key, size, values), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, indexfile)
+    finally:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+
+
+def build(datafile, indexfile, version, key, write_func, cache_enabled=True, quiet=False, desc='cache'):
+    '''
+    Writes a data file using write_func(out), which returns the values to
+    cache and the size of the data written. Returns (values, fileobj, size),
+    with fileobj open for reading.
+
+    If cache_enabled is False, or the files can't be saved, the data is
+    written to a temporary file instead.
+    '''
+    if cache_enabled:
+        datatmp = '%s.tmp%s' % (datafile, os.getpid())
+        try:
+            with open(datatmp, 'wb') as out:
+                values, size = write_func(out)
+            os.rename(datatmp, datafile)
+            save(indexfile, version, key, values, size)
+            return values, open(datafile, 'rb'), size
+
+        except (IOError, OSError), e:
+            if not quiet:
+                sys.stderr.write("Error saving %s: %s!\n" % (desc, str(e)))
+            if os.path.exists(datatmp):
+                os.unlink(datatmp)
+
+    out = tempfile.TemporaryFile()
+    values, size = write_func(out)
+    out.flush()
+    return values, out, size
+
+
+def map_file(fileobj, size):
+    'Memory-maps (read-only) the first size bytes of a file, or returns None if size is 0'
+    if not size:
+        return None
+    return mmap.mmap(fileobj.fileno(), size, access=mmap.ACCESS_READ)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.bgzip
+'''
+
+import gzip
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import doctest
+
+import ngsutils.support.bgzip
+from ngsutils.support.bgzip import BGZipPipe, BGZipWriter, bgzip_blocks, bgzip_recompress
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.support.bgzip))
+    return tests
+
+
+class BGZipWriterTest(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(1)
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = ''.join([rand.choice(['ACGT', 'read\t', chr(rand.randint(0, 255))]) for i in xrange(100000)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, fname, threads):
+        out = BGZipWriter(fname, threads=threads)
+        for i in xrange(0, len(self.data), 1000):
+            out.write(self.data[i:i + 1000])
+        out.close()
+
+    def testWriter(self):
+        for threads in [1, 3]:
+            fname = os.path.join(self.tmpdir, 'test%s.gz' % threads)
+            self._write(fname, threads)
+            self.assertEqual(gzip.open(fname).read(), self.data)
+
+            with open(fname, 'rb') as f:
+                blocks = list(bgzip_blocks(f))
+            self.assertTrue(len(blocks) > 1)
+            self.assertEqual(''.join(blocks), self.data)
+
+    def testRecompress(self):
+        fname = os.path.join(self.tmpdir, 'test.gz')
+        out = BGZipWriter(fname, level=0)
+        out.write(self.data)
+        out.close()
+
+        outfname = os.path.join(self.tmpdir, 'test2.gz')
+        bgzip_recompress(fname, outfname, threads=2)
+        self.assertEqual(gzip.open(outfname).read(), self.data)
+        self.assertTrue(os.stat(outfname).st_size < os.stat(fname).st_size)
+
+    def testPipe(self):
+        outfname = os.path.join(self.tmpdir, 'test.gz')
+        pipe = BGZipPipe(outfname, threads=2)
+        self.assertTrue(os.path.exists(pipe.path))
+
+        out = BGZipWriter(pipe.path, level=0)
+        for i in xrange(0, len(self.data), 1000):
+            out.write(self.data[i:i + 1000])
+        out.close()
+        pipe.close()
+
+        self.assertFalse(os.path.exists(pipe.path))
+        self.assertEqual(gzip.open(outfname).read(), self.data)
+        self.assertTrue(os.stat(outfname).st_size < len(self.data))
+
+    def testPipeErrors(self):
+        self.assertRaises(IOError, BGZipPipe, os.path.join(self.tmpdir, 'missing', 'test.gz'))
+
+        # the pipe is removed even if it was never opened
+        pipe = BGZipPipe(os.path.join(self.tmpdir, 'test.gz'))
+        pipe.abort()
+        self.assertFalse(os.path.exists(pipe.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.dbsnp
+'''
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import doctest
+
+import pysam
+import ngsutils.support.dbsnp
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.support.dbsnp))
+    return tests
+
+
+class DBSNPTest(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(1)
+        self.tmpdir = tempfile.mkdtemp()
+
+        fname = os.path.join(self.tmpdir, 'snp.txt')
+        with open(fname, 'w') as f:
+            for chrom in ['chr1', 'chr2']:
+                for i in xrange(500):
+                    pos = i * 10 + rand.randint(0, 2)
+                    clazz, observed = rand.choice([('single', 'A/G'), ('single', 'C/T'), ('mixed', '-/A/C'), ('in-del', '-/AC'), ('insertion', '-/T'), ('deletion', '-/G'), ('microsatellite', '(CA)5/6')])
+                    strand = rand.choice('+-')
+                    cols = ['0', chrom, pos, pos + 1, 'rs%s' % i, 0, strand, 'A', 'A', observed, 'genomic', clazz, 'unknown', 0, 0, 'unknown', 'exact', 1]
+                    f.write('%s\n' % '\t'.join([str(x) for x in cols]))
+
+        self.fname = pysam.tabix_index(fname, seq_col=1, start_col=2, end_col=3, zerobased=True)
+
+        queries = []
+        for chrom in ['chr1', 'chr2']:
+            for pos in xrange(0, 5020, 13):
+                for op, seq in [(0, 'A'), (0, 'T'), (1, 'AC'), (1, 'T'), (2, 'G')]:
+                    queries.append((chrom, op, pos, seq))
+        self.queries = queries
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check(self, queries, window):
+        direct = ngsutils.support.dbsnp.DBSNP(self.fname)
+        windowed = ngsutils.support.dbsnp.DBSNP(self.fname, window=window)
+
+        found = 0
+        for chrom, op, pos, seq in queries:
+            expected = direct.is_valid_variation(chrom, op, pos, seq)
+            self.assertEqual(windowed.is_valid_variation(chrom, op, pos, seq), expected, (chrom, op, pos, seq))
+            if expected:
+                found += 1
+
+        self.assertTrue(found > 20)
+        direct.close()
+        windowed.close()
+        return windowed
+
+    def testSorted(self):
+        dbsnp = self._check(self.queries, 1000)
+        self.assertEqual(dbsnp.window_loads, 12)
+        self.assertEqual(dbsnp.window_size, 1000)
+
+    def testBackwards(self):
+        'queries for earlier positions and passed references are looked up directly'
+        queries = self.queries + [x for x in self.queries if x[0] == 'chr1'][:1000]
+        dbsnp = self._check(queries, 1000)
+        self.assertEqual(dbsnp.window_loads, 12)
+
+    def testUnsorted(self):
+        queries = self.queries[:]
+        random.Random(2).shuffle(queries)
+        dbsnp = self._check(queries, 100)
+        self.assertEqual(dbsnp.window_size, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
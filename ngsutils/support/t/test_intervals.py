@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.intervals
+'''
+
+import unittest
+import doctest
+import random
+
+import ngsutils.support.intervals
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.support.intervals))
+    return tests
+
+
+class IntervalIndexTest(unittest.TestCase):
+    def testRandom(self):
+        'Compare to checking every interval'
+        rand = random.Random(1)
+
+        intervals = []
+        index = ngsutils.support.intervals.IntervalIndex(['chr1', 'chr2'])
+        for i in xrange(200):
+            chrom = rand.choice(['chr1', 'chr2'])
+            start = rand.randint(0, 10000)
+            end = start + rand.randint(0, rand.choice([10, 1000]))
+            strand = rand.choice(['+', '-', None])
+            intervals.append((chrom, start, end, strand))
+            index.add(chrom, start, end, strand)
+
+        # sorted queries (using the cursor), then random queries
+        queries = []
+        for i in xrange(2000):
+            tid = rand.randint(0, 1)
+            start = rand.randint(0, 11000)
+            queries.append((tid, start, start + rand.randint(0, 200), rand.choice(['+', '-', None])))
+
+        for query in sorted(queries) + queries:
+            tid, start, end, strand = query
+            expected = False
+            for chrom, istart, iend, istrand in intervals:
+                if chrom == ['chr1', 'chr2'][tid] and istart <= end and iend >= start and (strand is None or strand == istrand):
+                    expected = True
+                    break
+
+            self.assertEqual(index.overlaps(tid, start, end, strand), expected, query)
+
+    def testAdd(self):
+        'Adding intervals after a query'
+        index = ngsutils.support.intervals.IntervalIndex(['chr1'])
+        index.add('chr1', 10, 20)
+        self.assertFalse(index.overlaps(0, 30, 40))
+        index.add('chr1', 35, 50)
+        self.assertTrue(index.overlaps(0, 30, 40))
+
+
+if __name__ == '__main__':
+    unittest.main()
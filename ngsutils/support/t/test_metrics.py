@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.metrics
+'''
+
+import json
+import os
+import tempfile
+import unittest
+import StringIO
+
+import ngsutils.support.metrics
+import ngsutils.fastq
+from ngsutils.support.metrics import Progress
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        ngsutils.support.metrics.reset()
+
+    def tearDown(self):
+        ngsutils.support.metrics.reset()
+
+    def testProgress(self):
+        extras = []
+        progress = Progress(100, stage='test', quiet=True, extra=extras.append)
+        for i in xrange(1000):
+            progress.update(i)
+        progress.done()
+        progress.done()
+
+        # quiet, so the status is never built
+        self.assertEqual(extras, [])
+
+        vals = ngsutils.support.metrics.metrics()
+        self.assertEqual(vals['stages']['test']['records'], 1000)
+
+    def testProgressThrottle(self):
+        checked = []
+        progress = Progress(100, stage='test', quiet=True, position=lambda: checked.append(1))
+        for i in xrange(10000):
+            progress.update(i)
+
+        # the time is only checked every so often, and position() is only
+        # called when the status is shown
+        self.assertTrue(progress._check_every > 1)
+        self.assertEqual(checked, [])
+
+    def testUnfinished(self):
+        progress = Progress(stage='test', quiet=True)
+        progress.update()
+        progress.update()
+
+        vals = ngsutils.support.metrics.metrics()
+        self.assertEqual(vals['stages']['test']['records'], 2)
+
+    def testCount(self):
+        ngsutils.support.metrics.count('filter', 'kept', 10)
+        ngsutils.support.metrics.count('filter', 'removed')
+        ngsutils.support.metrics.count('filter', 'removed')
+
+        vals = ngsutils.support.metrics.metrics()
+        self.assertEqual(vals['counters'], {'filter': {'kept': 10, 'removed': 2}})
+
+    def testFASTQ(self):
+        fq = ngsutils.fastq.FASTQ(fileobj=StringIO.StringIO('@foo\nACGT\n+\nIIII\n@bar\nACGT\n+\nIIII\n'))
+        self.assertEqual([x.name for x in fq.fetch(quiet=True)], ['foo', 'bar'])
+
+        vals = ngsutils.support.metrics.metrics()
+        self.assertEqual(vals['stages']['fastq']['records'], 2)
+
+    def testWrite(self):
+        ngsutils.support.metrics.count('filter', 'kept', 3)
+
+        fd, fname = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            ngsutils.support.metrics.write_metrics(fname, {'command': ['test']})
+            with open(fname) as f:
+                vals = json.load(f)
+        finally:
+            os.unlink(fname)
+
+        self.assertEqual(vals['command'], ['test'])
+        self.assertEqual(vals['counters'], {'filter': {'kept': 3}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.reference
+'''
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import doctest
+
+import ngsutils.support.reference
+from ngsutils.support.reference import Reference, open_reference
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.support.reference))
+    return tests
+
+
+class ReferenceTest(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(1)
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'ref.fa')
+
+        self.seqs = {}
+        with open(self.fname, 'w') as f:
+            for name, length in [('chr1', 1003), ('chr2', 250), ('chrM', 17), ('empty', 0)]:
+                seq = ''.join([rand.choice('ACGTacgtN') for i in xrange(length)])
+                if length > 200:
+                    seq = '%s%s%s%s' % (seq[:50], 'N' * 40, 'nnnacgt', seq[97:])
+                self.seqs[name] = seq
+
+                f.write('>%s description\n' % name)
+                for i in xrange(0, len(seq), 60):
+                    f.write('%s\n' % seq[i:i + 60])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testFetch(self):
+        rand = random.Random(2)
+        ref = Reference(self.fname, quiet=True)
+        self.assertEqual(ref.references, ['chr1', 'chr2', 'chrM', 'empty'])
+        self.assertEqual(ref.lengths, [1003, 250, 17, 0])
+
+        for name in ref.references:
+            seq = self.seqs[name]
+            self.assertEqual(ref.fetch(name), seq)
+            for i in xrange(200):
+                start = rand.randint(-2, len(seq) + 2)
+                end = rand.randint(max(start, 0), len(seq) + 5)
+                self.assertEqual(ref.fetch(name, start, end), seq[max(start, 0):end], (name, start, end))
+
+        self.assertEqual(ref.fetch('missing', 0, 10), '')
+        ref.close()
+
+    def testIUPAC(self):
+        with open(self.fname, 'w') as f:
+            f.write('>test\nACGTRYacgtry\n')
+
+        ref = Reference(self.fname, quiet=True)
+        self.assertEqual(ref.fetch('test'), 'ACGTNNacgtnn')
+        ref.close()
+
+    def testChrPrefix(self):
+        ref = Reference(self.fname, quiet=True)
+        self.assertEqual(ref.fetch('1', 10, 20), self.seqs['chr1'][10:20])
+        self.assertEqual(ref.fetch('MT', 0, 5), self.seqs['chrM'][0:5])
+        self.assertEqual(ref.get_reference_length('2'), 250)
+        ref.close()
+
+    def testFetchMany(self):
+        ref = Reference(self.fname, quiet=True)
+        regions = [('chr1', 10, 20), ('chr1', 5, 6), ('chr2', 0, 300), ('missing', 0, 5), ('chr1', 990, 1010), ('chr1', 20, 10)]
+        self.assertEqual(ref.fetch_many(regions), [ref.fetch(*x) for x in regions])
+        ref.close()
+
+    def testCache(self):
+        ref = Reference(self.fname, quiet=True)
+        self.assertTrue(ref.built)
+        self.assertTrue(os.path.exists('%s.ngs2bit' % self.fname))
+        self.assertTrue(os.path.exists('%s.ngs2bit.idx' % self.fname))
+        ref.close()
+
+        ref = open_reference(self.fname, quiet=True)
+        self.assertFalse(ref.built)
+        self.assertEqual(ref.fetch('chr1'), self.seqs['chr1'])
+        self.assertTrue(open_reference(ref) is ref)
+        ref.close()
+
+        # changing the FASTA file regenerates the 2-bit file
+        with open(self.fname, 'w') as f:
+            f.write('>test\nACGTACGTNNNN\n')
+
+        ref = Reference(self.fname, quiet=True)
+        self.assertTrue(ref.built)
+        self.assertEqual(ref.references, ['test'])
+        ref.close()
+
+    def testNoCache(self):
+        ref = Reference(self.fname, cache_enabled=False, quiet=True)
+        self.assertEqual(ref.fetch('chr2'), self.seqs['chr2'])
+        self.assertFalse(os.path.exists('%s.ngs2bit' % self.fname))
+        ref.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
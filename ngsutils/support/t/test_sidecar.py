@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.sidecar
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ngsutils.support import sidecar
+
+
+class SidecarTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'input.txt')
+        with open(self.fname, 'w') as f:
+            f.write('foo\n')
+
+        self.datafile = '%s.data' % self.fname
+        self.indexfile = '%s.data.idx' % self.fname
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, out):
+        out.write('bar baz')
+        return ['values'], 7
+
+    def testSave(self):
+        key = sidecar.file_key(self.fname)
+        sidecar.save(self.indexfile, 1, key, {'foo': 1})
+        self.assertEqual(sidecar.load(self.indexfile, 1, key), {'foo': 1})
+        self.assertEqual(sidecar.load(self.indexfile, 2, key), None)
+        self.assertEqual(sidecar.load(self.indexfile, 1, (0, 0)), None)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['input.txt', 'input.txt.data.idx'])
+
+    def testBuild(self):
+        key = sidecar.file_key(self.fname)
+        self.assertEqual(sidecar.load(self.indexfile, 1, key, self.datafile), None)
+
+        values, fileobj, size = sidecar.build(self.datafile, self.indexfile, 1, key, self._write, quiet=True)
+        self.assertEqual((values, fileobj.read(), size), (['values'], 'bar baz', 7))
+        fileobj.close()
+
+        values, fileobj, size = sidecar.load(self.indexfile, 1, key, self.datafile)
+        self.assertEqual((values, fileobj.read(), size), (['values'], 'bar baz', 7))
+        mm = sidecar.map_file(fileobj, size)
+        self.assertEqual(mm[:], 'bar baz')
+        mm.close()
+        fileobj.close()
+
+        # a data file that has changed isn't used
+        with open(self.datafile, 'a') as f:
+            f.write('!')
+        self.assertEqual(sidecar.load(self.indexfile, 1, key, self.datafile), None)
+
+    def testNoCache(self):
+        values, fileobj, size = sidecar.build(self.datafile, self.indexfile, 1, None, self._write, cache_enabled=False)
+        self.assertEqual((values, size), (['values'], 7))
+        fileobj.seek(0)
+        self.assertEqual(fileobj.read(), 'bar baz')
+        fileobj.close()
+        self.assertFalse(os.path.exists(self.datafile))
+
+        # a data file that can't be written falls back to a temporary file
+        badfile = os.path.join(self.tmpdir, 'missing', 'input.txt.data')
+        values, fileobj, size = sidecar.build(badfile, '%s.idx' % badfile, 1, None, self._write, quiet=True)
+        self.assertEqual((values, size), (['values'], 7))
+        fileobj.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
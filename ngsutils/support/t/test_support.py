@@ -41,5 +41,28 @@ class CountsTest(unittest.TestCase):
 
         self.assertTrue(counts.mean(), 2)
 
+
+class PrefetchTest(unittest.TestCase):
+    def testPrefetch(self):
+        self.assertEqual(list(ngsutils.support.prefetch(iter(xrange(1000)))), range(1000))
+        self.assertEqual(list(ngsutils.support.prefetch(iter([]))), [])
+
+    def testError(self):
+        def gen():
+            yield 1
+            raise ValueError('bad value')
+
+        self.assertRaises(ValueError, list, ngsutils.support.prefetch(gen()))
+
+
+class PositiveIntArgTest(unittest.TestCase):
+    def testInvalid(self):
+        def usage():
+            raise SystemExit(1)
+
+        self.assertEqual(ngsutils.support.positive_int_arg('-p', '2', usage), 2)
+        for arg in ['0', '-1', 'x', '']:
+            self.assertRaises(SystemExit, ngsutils.support.positive_int_arg, '-p', arg, usage)
+
 if __name__ == '__main__':
     unittest.main()